@@ -1,6 +1,26 @@
+import os
+import sys
+import threading
+
 from django.apps import AppConfig
 
 
+def _serving():
+    # True unless this is a management command other than runserver
+    # (migrate, test, the workers), which have no use for the index
+    if os.path.basename(sys.argv[0]) not in ('manage.py', 'django-admin', '__main__.py'):
+        return True
+    return len(sys.argv) > 1 and sys.argv[1] == 'runserver'
+
+
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
+
+    def ready(self):
+        from . import availability, signals  # noqa: F401
+
+        # Load the taken usernames and emails before the first registration
+        # form check rather than during it
+        if _serving():
+            threading.Thread(target=availability.warm, name='availability-warm', daemon=True).start()
@@ -0,0 +1,215 @@
+"""
+Cheap answers for the validate-username and validate-email endpoints,
+which the registration form calls on every keystroke.
+
+Taken usernames and emails are kept per process as sorted arrays of 64-bit
+hashes (8 bytes per user), loaded in the background when a server process
+starts (see ``AuthenticationConfig.ready``) and kept current by the
+``User`` signals in ``authentication.signals``. Users created by other
+processes are picked up by a query for rows past the highest id seen, at
+most once every ``AVAILABILITY_REFRESH_INTERVAL`` seconds, so a lookup
+itself never queries the database. Users deleted or renamed by other
+processes are only dropped by a full reload, done at most once every
+``AVAILABILITY_REBUILD_INTERVAL`` seconds in place of a refresh; lookups
+made meanwhile are answered from the loaded index. The index is advisory:
+a stale answer is caught by the authoritative check in
+``RegistrationView.post``.
+
+``check_email`` runs ``email_validator`` (which may do DNS lookups) once
+per address per ``EMAIL_CHECK_CACHE_TIMEOUT`` seconds, and concurrent
+requests for the same address share one run.
+"""
+import hashlib
+import threading
+import time
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from email_validator import EmailNotValidError, validate_email
+
+from expenses import metrics
+
+MERGE_SIZE = 1024
+
+
+def _hash(value):
+    return np.uint64(int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little'))
+
+
+class TakenIndex:
+    """The values of one ``User`` field, as a compact set of hashes."""
+
+    def __init__(self, field):
+        self.field = field
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._hashes = None
+        self._recent = set()
+        self._max_pk = 0
+        self._checked = 0.0
+        self._built = 0.0
+
+    def __contains__(self, value):
+        self._refresh()
+        key = _hash(value)
+        if key in self._recent:
+            return True
+        hashes = self._hashes
+        found = np.searchsorted(hashes, key)
+        return bool(found < len(hashes) and hashes[found] == key)
+
+    def add(self, value):
+        if value:
+            with self._lock:
+                self._recent.add(_hash(value))
+                if len(self._recent) >= MERGE_SIZE:
+                    self._merge()
+
+    def discard(self, value):
+        if value:
+            key = _hash(value)
+            with self._lock:
+                self._recent.discard(key)
+                if self._hashes is not None:
+                    self._hashes = self._hashes[self._hashes != key]
+
+    def needs_refresh(self):
+        interval = getattr(settings, 'AVAILABILITY_REFRESH_INTERVAL', 5)
+        return self._hashes is None or time.monotonic() - self._checked >= interval
+
+    def _needs_rebuild(self):
+        interval = getattr(settings, 'AVAILABILITY_REBUILD_INTERVAL', 10 * 60)
+        return self._hashes is None or time.monotonic() - self._built >= interval
+
+    def _refresh(self):
+        if not self.needs_refresh():
+            return
+        if self._hashes is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(blocking=False):
+            # Another thread is refreshing; answer from what is loaded
+            return
+        try:
+            if not self.needs_refresh():
+                return
+            if self._needs_rebuild():
+                self._rebuild()
+            else:
+                for pk, value in self._rows(self._max_pk):
+                    self._recent.add(_hash(value))
+                    self._max_pk = pk
+                if len(self._recent) >= MERGE_SIZE:
+                    self._merge()
+            self._checked = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def _rows(self, after):
+        rows = (User.objects.filter(pk__gt=after).exclude(**{self.field: ''})
+                .order_by('pk').values_list('pk', self.field))
+        return rows.iterator(chunk_size=10000)
+
+    def _rebuild(self):
+        # Load every value afresh, then swap it in whole; called with the lock held
+        hashes, max_pk = [], 0
+        for pk, value in self._rows(0):
+            hashes.append(_hash(value))
+            max_pk = pk
+        self._hashes = np.unique(np.array(hashes, dtype=np.uint64))
+        self._recent = set()
+        self._max_pk = max_pk
+        self._built = time.monotonic()
+
+    def _merge(self):
+        # Fold the recent additions into the sorted array; called with the lock held
+        recent = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+        hashes = self._hashes if self._hashes is not None else np.empty(0, dtype=np.uint64)
+        self._hashes = np.union1d(hashes, recent)
+        self._recent = set()
+
+
+usernames = TakenIndex('username')
+emails = TakenIndex('email')
+
+
+def warm():
+    """Load both indexes once the app registry is ready; run in a thread at startup."""
+    apps.ready_event.wait()
+    try:
+        for index in (usernames, emails):
+            index._refresh()
+    except DatabaseError:
+        # Not migrated yet, or the database is down: the first lookup loads it instead
+        pass
+    finally:
+        connection.close()
+
+
+async def ais_taken(index, value):
+    """``value in index`` for async views: only a due refresh leaves the event loop."""
+    if index.needs_refresh():
+        return await sync_to_async(index.__contains__)(value)
+    return value in index
+
+
+class SingleFlight:
+    """Run ``fn`` once for concurrent callers asking for the same ``key``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+_email_checks = SingleFlight()
+
+
+def check_email(email):
+    """Return why ``email`` is not a usable address, or None if it is."""
+    key = 'email-check:' + hashlib.sha256(email.encode()).hexdigest()
+
+    def run():
+        # '' marks a valid address, so it is cached too
+        result = cache.get(key)
+        if result is None:
+            try:
+                validate_email(email, check_deliverability=getattr(settings, 'EMAIL_CHECK_DELIVERABILITY', True))
+                result = ''
+            except EmailNotValidError as e:
+                result = str(e)
+            cache.set(key, result, getattr(settings, 'EMAIL_CHECK_CACHE_TIMEOUT', 5 * 60))
+        return result
+
+    result = cache.get(key)
+    metrics.cache_lookup('email_check', result is not None)
+    if result is None:
+        result = _email_checks.do(key, run)
+    return result or None
@@ -0,0 +1,45 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from authentication import outbox
+
+
+class Command(BaseCommand):
+    help = 'Send queued outbox emails over one reused connection, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of messages claimed at a time')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--purge-interval', type=float, default=3600.0,
+                            help='Seconds between deletions of old sent messages')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no message is due')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        connection = get_connection()
+        last_purge = None
+        self.stdout.write('Outbox delivery started')
+        try:
+            while True:
+                close_old_connections()
+                if last_purge is None or time.monotonic() - last_purge >= options['purge_interval']:
+                    outbox.purge()
+                    last_purge = time.monotonic()
+
+                sent, failed = outbox.deliver(batch_size, connection)
+                if sent or failed:
+                    self.stdout.write(f'Sent {sent} email(s), {failed} failed')
+                if sent + failed < batch_size:
+                    # Idle: let the mail server session go rather than hold it open
+                    connection.close()
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        finally:
+            connection.close()
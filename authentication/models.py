@@ -1,3 +1,32 @@
 from django.db import models
+from django.utils.timezone import now
 
 # Create your models here.
+class OutboxEmail(models.Model):
+    # An email written in the same transaction as the change it is about and
+    # sent later by `manage.py deliver_outbox`, see authentication.outbox
+    PENDING='pending'
+    SENT='sent'
+    FAILED='failed'
+    STATUS_CHOICES=[(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    subject=models.CharField(max_length=255)
+    body=models.TextField()
+    from_email=models.CharField(max_length=254)
+    to=models.JSONField(default=list)
+    headers=models.JSONField(default=dict, blank=True)
+    status=models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts=models.PositiveIntegerField(default=0)
+    # When a worker may pick the message up next; pushed forward while one is sending it
+    next_attempt_at=models.DateTimeField(default=now)
+    last_error=models.TextField(blank=True)
+    created_at=models.DateTimeField(auto_now_add=True)
+    sent_at=models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.subject} to {", ".join(self.to)} ({self.status})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_due_idx'),
+        ]
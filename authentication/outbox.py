@@ -0,0 +1,132 @@
+"""
+Transactional email outbox.
+
+Views call ``enqueue`` inside the transaction that creates whatever the
+email is about, so the request does one INSERT and the email exists exactly
+when the change commits. ``manage.py deliver_outbox`` claims due messages in
+batches and sends them over one reused connection of the configured email
+backend. A failed message is retried with exponential backoff until
+``EMAIL_OUTBOX_MAX_ATTEMPTS``.
+
+Claiming pushes ``next_attempt_at`` forward by ``EMAIL_OUTBOX_LEASE`` with a
+conditional UPDATE, so several workers can share the table and a message
+held by a worker that died is picked up again once the lease runs out.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from expenses import metrics
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+
+
+def _setting(name, default):
+    return getattr(settings, f'EMAIL_OUTBOX_{name}', default)
+
+
+def enqueue(subject, body, to, from_email=None, headers=None):
+    return OutboxEmail.objects.create(subject=subject, body=body, to=list(to), headers=headers or {},
+                                      from_email=from_email or settings.DEFAULT_FROM_EMAIL)
+
+
+def retry_delay(attempts):
+    delay = datetime.timedelta(seconds=_setting('RETRY_DELAY', 60)) * 2 ** max(attempts - 1, 0)
+    return min(delay, MAX_RETRY_DELAY)
+
+
+def claim(limit, now=None):
+    """Lease up to ``limit`` due messages to this worker and return their ids, oldest first."""
+    now = now or timezone.now()
+    lease = now + datetime.timedelta(seconds=_setting('LEASE', 5 * 60))
+    due = (OutboxEmail.objects.filter(status=OutboxEmail.PENDING, next_attempt_at__lte=now)
+           .order_by('next_attempt_at', 'id'))
+    claimed = []
+    for pk, next_attempt_at, attempts in due.values_list('pk', 'next_attempt_at', 'attempts')[:limit * 2]:
+        # Only one worker wins the UPDATE for a given message
+        if OutboxEmail.objects.filter(pk=pk, status=OutboxEmail.PENDING, next_attempt_at=next_attempt_at).update(
+                next_attempt_at=lease, attempts=attempts + 1):
+            claimed.append(pk)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+def deliver(limit=100, connection=None):
+    """
+    Send up to ``limit`` due messages and return ``(sent, failed)``.
+
+    ``connection`` is an email backend instance to reuse; it is opened if
+    needed and left open for the next batch. Without one, a connection is
+    opened for this batch only.
+    """
+    ids = claim(limit)
+    if not ids:
+        return 0, 0
+    messages = list(OutboxEmail.objects.filter(pk__in=ids).order_by('id'))
+    own_connection = connection is None
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for message in messages:
+            _failed(message, e)
+        return 0, len(messages)
+
+    sent = failed = 0
+    try:
+        for message in messages:
+            email = EmailMessage(message.subject, message.body, message.from_email, message.to,
+                                 headers=message.headers, connection=connection)
+            try:
+                connection.send_messages([email])
+            except Exception as e:
+                failed += 1
+                _failed(message, e)
+                _reopen(connection)
+            else:
+                sent += 1
+                metrics.email_outcome('sent')
+                OutboxEmail.objects.filter(pk=message.pk).update(
+                    status=OutboxEmail.SENT, sent_at=timezone.now(), last_error='')
+    finally:
+        if own_connection:
+            connection.close()
+    return sent, failed
+
+
+def _failed(message, error):
+    error = str(error) or error.__class__.__name__
+    if message.attempts >= _setting('MAX_ATTEMPTS', 8):
+        logger.error('Giving up on outbox email %s after %s attempts: %s', message.pk, message.attempts, error)
+        changes = {'status': OutboxEmail.FAILED}
+        metrics.email_outcome('failed')
+    else:
+        logger.warning('Outbox email %s failed, retrying: %s', message.pk, error)
+        changes = {'next_attempt_at': timezone.now() + retry_delay(message.attempts)}
+        metrics.email_outcome('retry')
+    OutboxEmail.objects.filter(pk=message.pk, status=OutboxEmail.PENDING).update(last_error=error, **changes)
+
+
+def _reopen(connection):
+    # The error may have come from a dropped connection; start the next message on a fresh one
+    try:
+        connection.close()
+        connection.open()
+    except Exception:
+        logger.warning('Could not reopen the email connection', exc_info=True)
+
+
+def purge(now=None):
+    """Delete sent messages older than ``EMAIL_OUTBOX_RETENTION`` seconds."""
+    now = now or timezone.now()
+    cutoff = now - datetime.timedelta(seconds=_setting('RETENTION', 7 * 24 * 60 * 60))
+    deleted, _ = OutboxEmail.objects.filter(status=OutboxEmail.SENT, sent_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import availability
+
+
+@receiver(post_save, sender=User)
+def mark_taken(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    username, email = instance.username, instance.email
+
+    def add():
+        availability.usernames.add(username)
+        availability.emails.add(email)
+    transaction.on_commit(add)
+
+
+@receiver(post_delete, sender=User)
+def mark_available(sender, instance, **kwargs):
+    username, email = instance.username, instance.email
+
+    def discard():
+        availability.usernames.discard(username)
+        availability.emails.discard(email)
+    transaction.on_commit(discard)
@@ -1,3 +1,206 @@
-from django.test import TestCase
+import datetime
+import io
+import sys
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from . import apps, availability, outbox
+from .models import OutboxEmail
+
+
+class FlakyBackend(EmailBackend):
+    # locmem backend that refuses the first `failures` messages
+    def __init__(self, failures=1, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def send_messages(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        return super().send_messages(messages)
+
+
+class OutboxTests(TestCase):
+    def test_registration_queues_the_email_instead_of_sending(self):
+        data = {'username': 'newuser', 'email': 'new@example.com', 'password': 'secret-password'}
+        with CaptureQueriesContext(connection) as captured:
+            self.client.post('/authentication/register/', data)
+        self.assertEqual(mail.outbox, [])
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.to, ['new@example.com'])
+        self.assertIn('/authentication/activate/', email.body)
+        user = User.objects.get(username='newuser')
+        self.assertFalse(user.is_active)
+        self.assertTrue(user.check_password('secret-password'))
+        writes = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(writes), 2, writes)
+
+    def test_deliver_sends_batches_over_one_connection(self):
+        for n in range(5):
+            outbox.enqueue(f'Hello {n}', 'body', [f'user{n}@example.com'])
+        backend = FlakyBackend(failures=0)
+        self.assertEqual(outbox.deliver(3, backend), (3, 0))
+        self.assertEqual(outbox.deliver(3, backend), (2, 0))
+        self.assertEqual(outbox.deliver(3, backend), (0, 0))
+        self.assertEqual([message.subject for message in mail.outbox], [f'Hello {n}' for n in range(5)])
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.SENT).exists())
+
+    def test_failures_back_off_and_give_up(self):
+        def outcomes():
+            return [REGISTRY.get_sample_value('expensesweb_outbox_emails_total', {'outcome': outcome}) or 0
+                    for outcome in ('retry', 'failed')]
+
+        before = outcomes()
+        email = outbox.enqueue('Hello', 'body', ['user@example.com'])
+        with self.assertLogs('authentication.outbox', 'WARNING'):
+            self.assertEqual(outbox.deliver(10, FlakyBackend(failures=1)), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error), (OutboxEmail.PENDING, 1, 'connection reset'))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        # Not due yet
+        self.assertEqual(outbox.deliver(10, FlakyBackend(failures=0)), (0, 0))
+
+        with self.settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2):
+            OutboxEmail.objects.update(next_attempt_at=timezone.now())
+            with self.assertLogs('authentication.outbox', 'ERROR'):
+                self.assertEqual(outbox.deliver(10, FlakyBackend(failures=1)), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, 2))
+        self.assertEqual([after - was for after, was in zip(outcomes(), before)], [1, 1])
+
+    def test_expired_lease_is_claimed_again(self):
+        outbox.enqueue('Hello', 'body', ['user@example.com'])
+        self.assertEqual(len(outbox.claim(10)), 1)
+        self.assertEqual(outbox.claim(10), [])
+        later = timezone.now() + datetime.timedelta(minutes=10)
+        self.assertEqual(len(outbox.claim(10, now=later)), 1)
+
+
+class DeliverOutboxCommandTests(TransactionTestCase):
+    # The worker closes stale database connections, which a TestCase transaction would not survive
+    def test_worker_drains_the_outbox(self):
+        for n in range(3):
+            outbox.enqueue(f'Hello {n}', 'body', ['user@example.com'])
+        call_command('deliver_outbox', '--once', '--batch-size', '2', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class AvailabilityTests(TestCase):
+    def setUp(self):
+        availability.usernames.reset()
+        availability.emails.reset()
+        cache.clear()
+        User.objects.create_user('taken', 'taken@example.com')
+
+    def validate(self, field, value):
+        return self.client.post(f'/authentication/validate-{field}/', {field: value}, content_type='application/json')
+
+    def test_lookups_do_not_query_after_warmup(self):
+        self.assertIn('taken', availability.usernames)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.validate('username', 'taken').status_code, 409)
+            self.assertEqual(self.validate('username', 'free').status_code, 200)
+
+    def test_new_users_are_seen_without_waiting_for_a_refresh(self):
+        self.assertNotIn('newcomer', availability.usernames)
+        self.assertNotIn('newcomer@example.com', availability.emails)
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.create_user('newcomer', 'newcomer@example.com')
+        with self.assertNumQueries(0):
+            self.assertIn('newcomer', availability.usernames)
+            self.assertIn('newcomer@example.com', availability.emails)
+
+    def test_users_created_elsewhere_are_picked_up_on_refresh(self):
+        self.assertNotIn('elsewhere', availability.usernames)
+        # No on_commit callbacks run here, as if another process had created the user
+        User.objects.create_user('elsewhere')
+        self.assertNotIn('elsewhere', availability.usernames)
+        with self.settings(AVAILABILITY_REFRESH_INTERVAL=0):
+            self.assertIn('elsewhere', availability.usernames)
+
+    def test_users_renamed_elsewhere_drop_out_on_rebuild(self):
+        self.assertIn('taken', availability.usernames)
+        # update() sends no signals, as if another process had renamed the user
+        User.objects.filter(username='taken').update(username='renamed')
+        with self.settings(AVAILABILITY_REFRESH_INTERVAL=0):
+            # A refresh only looks past the highest id seen
+            self.assertIn('taken', availability.usernames)
+            self.assertNotIn('renamed', availability.usernames)
+            with self.settings(AVAILABILITY_REBUILD_INTERVAL=0):
+                self.assertNotIn('taken', availability.usernames)
+                self.assertIn('renamed', availability.usernames)
+
+    def test_warm_loads_both_indexes(self):
+        # warm() closes its thread's connection, which here is the test's own
+        with mock.patch.object(availability, 'connection'):
+            availability.warm()
+        with self.assertNumQueries(0):
+            self.assertIn('taken', availability.usernames)
+            self.assertIn('taken@example.com', availability.emails)
+
+    def test_only_server_processes_warm_at_startup(self):
+        for argv, serving in [(['manage.py', 'migrate'], False), (['manage.py', 'test'], False),
+                              (['manage.py', 'runserver'], True), (['/usr/bin/uvicorn', 'expensewebsite.asgi:application'], True)]:
+            with mock.patch.object(sys, 'argv', argv):
+                self.assertEqual(apps._serving(), serving, argv)
+
+    @override_settings(EMAIL_CHECK_DELIVERABILITY=False)
+    def test_email_checks_are_cached(self):
+        self.assertEqual(self.validate('email', 'taken@example.com').status_code, 409)
+        self.assertEqual(self.validate('email', 'not-an-email').status_code, 400)
+        with mock.patch.object(availability, 'validate_email', wraps=availability.validate_email) as validate:
+            self.assertEqual(self.validate('email', 'free@example.com').status_code, 200)
+            self.assertEqual(self.validate('email', 'free@example.com').status_code, 200)
+        self.assertEqual(validate.call_count, 1)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flights = availability.SingleFlight()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', slow)))
+        leader.start()
+        started.wait()
+        # Hold the leader until every follower is waiting on its call, so
+        # none of them can come late and start a call of its own
+        done = flights._calls['key']['done']
+        waiting = threading.Semaphore(0)
+        wait = done.wait
+
+        def counted_wait(*args):
+            waiting.release()
+            return wait(*args)
+
+        done.wait = counted_wait
+        followers = [threading.Thread(target=lambda: results.append(flights.do('key', slow))) for _ in range(5)]
+        for thread in followers:
+            thread.start()
+        for _ in followers:
+            self.assertTrue(waiting.acquire(timeout=10))
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['result'] * 6)
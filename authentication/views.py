@@ -7,54 +7,54 @@ from email_validator import validate_email, EmailNotValidError
 from django.contrib import messages
 from django.urls import reverse 
 from django.utils.encoding import force_bytes, smart_str, DjangoUnicodeDecodeError
-from django.core.mail import EmailMessage, send_mail
+from django.db import transaction
+from django.utils.decorators import method_decorator
+from asgiref.sync import sync_to_async
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from .utils import token_generator
 from django.contrib import auth
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
-import threading
+from . import availability, outbox
 
 
 # Create your views here.
 
-class EmailThread(threading.Thread):
-    def __init__(self, email):
-        self.email = email
-        threading.Thread.__init__(self)
-
-    def run(self):
-        self.email.send(fail_silently=False)
 class EmailValidationView(View):
-    def post(self, request):
+    # Answered from memory, see authentication.availability; the
+    # authoritative check is in RegistrationView.post
+    async def post(self, request):
         data = json.loads(request.body)
         email = data['email']
-        try: 
-            validate_email(email) 
-        except EmailNotValidError as e: 
-            return JsonResponse({'email_error': str(e)}, status=400)
+        # email_validator may do DNS lookups; they don't need the request's database thread
+        error = await sync_to_async(availability.check_email, thread_sensitive=False)(email)
+        if error:
+            return JsonResponse({'email_error': error}, status=400)
 
         # if not validate_email(email):
         #     return JsonResponse({'email_error': 'Email is invalid.'}, status=400)
-        if User.objects.filter(email=email).exists():
+        if await availability.ais_taken(availability.emails, email):
             return JsonResponse({'email_error': 'Sorry, this email is already taken. Please try another one'}, status=409)
         return JsonResponse({'email_valid': True})
 
 
 class UsernameValidationView(View):
-    def post(self, request):
+    async def post(self, request):
         data = json.loads(request.body)
         username = data['username']
 
         if not str(username).isalnum():
             return JsonResponse({'username_error': 'Username should only contain alphanumeric characters'}, status=400)
-        if User.objects.filter(username=username).exists():
+        if await availability.ais_taken(availability.usernames, username):
             return JsonResponse({'username_error': 'Sorry, this username is already taken. Please try another one'}, status=409)
         return JsonResponse({'username_valid': True})
         
 class RegistrationView(View):
     def get(self, request):
         return render(request, 'authentication/register.html')
+    # The account and its activation email commit together; the email is
+    # sent later by `manage.py deliver_outbox`
+    @method_decorator(transaction.atomic)
     def post(self,request):
         # Get user data
         # Validate user data
@@ -74,10 +74,8 @@ class RegistrationView(View):
                     messages.error(request, 'Password cannot be less than 8 characters')
                     return render(request, 'authentication/register.html', context)
                 
-                user = User.objects.create_user(username=username, email=email)
-                user.set_password(password)
-                user.is_active = False
-                user.save()
+                user = User.objects.create_user(username=username, email=email, password=password,
+                                                is_active=False)
 
                 #activation_link = f"{request.scheme}://{get_current_site(request).domain}/activate/{uid}/{token}/"
 
@@ -95,16 +93,8 @@ class RegistrationView(View):
                 email_subject = 'Activate your account'
                 email_body = f'Dear + {user.username},\
                     \nPlease use this link below to activate your account: \n{activation_link}'
-                email = EmailMessage(
-                    email_subject,
-                    email_body,
-                    "noreply@semicolon.com",
-                    [email],
-                    headers={"Message-ID": "foo"},
-                )
-
-                EmailThread(email).start()
-                
+                outbox.enqueue(email_subject, email_body, [email], "noreply@semicolon.com")
+
                 messages.success(request, 'Account created successfully')
                 return render(request, 'authentication/register.html')
         return render(request, 'authentication/register.html', context)
@@ -195,14 +185,7 @@ class RequestPasswordResetEmail(View):
             email_subject = 'Password reset Instructions'
             email_body = f'Dear {email_contents['user'].username},\
             \nPlease click this link below to reset your password: \n{reset_url}'
-            email = EmailMessage(
-            email_subject,
-            email_body,
-            "noreply@semicolon.com",
-            [email],
-            headers={"Message-ID": "foo"},
-        )
-            EmailThread(email).start()
+            outbox.enqueue(email_subject, email_body, [email], "noreply@semicolon.com")
             
         
         messages.success(request, 'We have sent you an email to reset your password.')     
@@ -1,14 +1,34 @@
 from django.contrib import admin
-from .models import Expense, Category
+from .models import Budget, Category, ExchangeRate, Expense
 
 # Register your models here.
 
 class ExpenseAdmin(admin.ModelAdmin):
-    list_display = ('amount', 'description', 'owner', 'category', 'date')
-    search_fields = ('amount', 'description', 'category', 'date')
+    list_display = ('amount', 'currency', 'description', 'owner', 'category', 'date')
+    list_select_related = ('owner', 'category')
+    search_fields = ('description', 'category__name', 'date')
     list_per_page = 5
 admin.site.register(Expense, ExpenseAdmin)
-admin.site.register(Category)
+
+class CategoryAdmin(admin.ModelAdmin):
+    # No owner: offered to everyone
+    list_display = ('name', 'owner')
+    search_fields = ('name',)
+    raw_id_fields = ('owner',)
+admin.site.register(Category, CategoryAdmin)
+
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ('currency', 'date', 'rate')
+    list_filter = ('currency',)
+    date_hierarchy = 'date'
+admin.site.register(ExchangeRate, ExchangeRateAdmin)
+
+class BudgetAdmin(admin.ModelAdmin):
+    list_display = ('owner', 'month', 'category', 'amount', 'currency')
+    list_select_related = ('owner', 'category')
+    list_filter = ('month',)
+    raw_id_fields = ('owner',)
+admin.site.register(Budget, BudgetAdmin)
 
 
 
@@ -0,0 +1,47 @@
+"""
+Helpers for the async views, which run under ASGI (see
+``expensewebsite.asgi``) and, through Django's adapter, under WSGI too.
+
+Under ASGI Django cancels a view when its client disconnects, which is how
+a superseded typeahead search stops: the browser aborts the old request.
+Cancelling the view only stops Python code waiting on the database, so
+``run_cancellable`` also cancels the query itself.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def _cancel_query(wrapper):
+    raw = wrapper.connection
+    if raw is None:
+        return
+    if wrapper.vendor == 'postgresql':
+        raw.cancel()
+    elif wrapper.vendor == 'sqlite':
+        raw.interrupt()
+
+
+async def run_cancellable(fn):
+    """
+    Run ``fn`` (sync ORM code with no async equivalent, like the raw
+    full-text search) in the request's database thread and return its
+    result. If the calling task is cancelled, the statement ``fn`` is
+    running is cancelled on the database server instead of running on.
+    """
+    state = {}
+
+    def call():
+        state['connection'] = connections[DEFAULT_DB_ALIAS]
+        return fn()
+
+    task = asyncio.ensure_future(sync_to_async(call)())
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if 'connection' in state:
+            _cancel_query(state['connection'])
+        # The thread fails with the cancelled query's error; nobody is waiting for it
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        raise
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ExpensesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'expenses'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import reference, signals, timing  # noqa: F401
+        connection_created.connect(timing.install)
+        reference.currency_choices()
@@ -0,0 +1,243 @@
+"""
+Batches of creates, updates and deletes of one user's expenses or incomes,
+sent as JSON by the mobile app and the bank sync job.
+
+Every field is checked for the whole batch at once, as a NumPy column. Ids
+are checked against one query and categories (or sources) against the
+user's cached choices. One bad operation rejects the batch and nothing is
+written. A good batch is applied in one transaction: one ``bulk_create``,
+one ``bulk_update`` and one DELETE, all scoped to the owner. These skip the
+signals, so the rollups, counters and data version are updated here, once
+per batch.
+
+A batch sent with an ``Idempotency-Key`` header is stored with its results
+for ``BATCH_IDEMPOTENCY_TTL`` seconds. A retry with the same key and
+operations gets those results back and changes nothing. Reusing the key for
+other operations is an error.
+"""
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.utils import timezone
+
+from userincome.models import UserIncome
+
+from . import bulk, counters, imports, money, reference, rollups, versioning
+from .models import BatchRequest, Expense
+
+FIELDS = ('amount', 'date', 'description')
+BATCH_SIZE = 1000
+
+
+class InvalidBatch(Exception):
+    def __init__(self, results):
+        super().__init__('The batch has invalid operations')
+        self.results = results
+
+
+class KeyReused(Exception):
+    pass
+
+
+def _integer(value):
+    # Ids from the JSON body; anything else becomes -1, which matches nothing
+    return value if type(value) is int and 0 < value < 2 ** 63 else -1
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class BatchTarget:
+    def __init__(self, name, model, label, choices, rollups=False):
+        # ``name`` is also the RecordCount field
+        self.name = name
+        self.model = model
+        self.label = label
+        self.choices = choices
+        self.rollups = rollups
+
+    def apply(self, owner_id, operations, key=None):
+        """
+        Validate and apply ``operations`` for ``owner_id`` and return
+        ``(results, replayed)``, one result per operation. Raises
+        InvalidBatch, having written nothing, if any operation is invalid,
+        and KeyReused if ``key`` was sent before with other operations.
+        """
+        body_hash = hashlib.sha256(json.dumps(operations, sort_keys=True).encode()).hexdigest()
+        with transaction.atomic():
+            if key:
+                record, replayed = self._claim(owner_id, key, body_hash)
+                if replayed:
+                    return record.response, True
+            results = self._apply(owner_id, operations)
+            if key:
+                record.response = results
+                record.save(update_fields=['response'])
+        return results, False
+
+    def _claim(self, owner_id, key, body_hash):
+        expired = timezone.now() - datetime.timedelta(seconds=settings.BATCH_IDEMPOTENCY_TTL)
+        BatchRequest.objects.filter(owner_id=owner_id, created_at__lt=expired).delete()
+        try:
+            with transaction.atomic():
+                return BatchRequest.objects.create(owner_id=owner_id, target=self.name, key=key,
+                                                   body_hash=body_hash), False
+        except IntegrityError:
+            # Applied before, or a retry racing the first request, which the
+            # INSERT waited for
+            record = BatchRequest.objects.get(owner_id=owner_id, target=self.name, key=key)
+        if record.body_hash != body_hash:
+            raise KeyReused
+        return record, True
+
+    def _apply(self, owner_id, items):
+        n = len(items)
+        errors = np.full(n, None, dtype=object)
+
+        def reject(mask, message):
+            # Each operation reports its first problem only
+            errors[mask & np.equal(errors, None)] = message
+
+        reject(np.array([not isinstance(item, dict) for item in items]), 'Each operation must be an object')
+        items = [item if isinstance(item, dict) else {} for item in items]
+        op = np.array([str(item.get('op')) for item in items])
+        creating, updating, deleting = op == 'create', op == 'update', op == 'delete'
+        reject(~(creating | updating | deleting), 'op must be create, update or delete')
+
+        ids = np.array([_integer(item.get('id')) for item in items], dtype=np.int64)
+        targeted = updating | deleting
+        reject(creating & np.array(['id' in item for item in items]), 'create takes no id')
+        reject(targeted & (ids < 0), 'id must be an integer')
+        known, counts = np.unique(ids[targeted & (ids > 0)], return_counts=True)
+        reject(targeted & np.isin(ids, known[counts > 1]), 'id appears more than once in the batch')
+        # Locked, so the rollup deltas below start from what is stored
+        rows = self.model.objects.select_for_update().filter(owner_id=owner_id).in_bulk(known.tolist())
+        reject(targeted & ~np.isin(ids, list(rows)), f'None of your {self.name} has this id')
+
+        writing = creating | updating
+        present = {field: np.array([field in item for item in items]) & writing for field in FIELDS + (self.label,)}
+        for field, mask in present.items():
+            reject(creating & ~mask, f'{field} is required')
+
+        descriptions = np.array([item.get('description') for item in items], dtype=object)
+        reject(present['description'] & np.array([not (isinstance(value, str) and value.strip())
+                                                  for value in descriptions]), 'description is required')
+        labels = np.array([_integer(item.get(self.label)) for item in items], dtype=np.int64)
+        reject(present[self.label] & ~np.isin(labels, [choice.id for choice in self.choices(owner_id)]),
+               f'Unknown {self.label}')
+        dates = np.array([_date(item.get('date')) for item in items], dtype=object)
+        reject(present['date'] & np.equal(dates, None), 'date must be in YYYY-MM-DD format')
+
+        # Exact decimal parsing has no vector form; only rows still valid get here
+        currency = reference.user_currency_code(owner_id)
+        amounts = np.zeros(n, dtype=np.int64)
+        for i in np.flatnonzero(present['amount'] & np.equal(errors, None)):
+            try:
+                amounts[i] = money.to_minor(items[i]['amount'], rows[ids[i]].currency if updating[i] else currency)
+            except ValueError:
+                errors[i] = 'amount must be a number'
+
+        if not np.equal(errors, None).all():
+            raise InvalidBatch([{'status': 'rejected', 'error': error} if error else {'status': 'not_applied'}
+                                for error in errors])
+
+        deltas = defaultdict(lambda: (0, 0))
+        created = [self.model(owner_id=owner_id, currency=currency, amount_minor=int(amounts[i]), date=dates[i],
+                              description=descriptions[i], **{f'{self.label}_id': int(labels[i])})
+                   for i in np.flatnonzero(creating)]
+        for row in created:
+            row.content_hash = imports.content_hash(row.date, row.amount_minor, row.currency, row.description)
+        self.model.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        for row in created:
+            self._count(deltas, row, 1)
+
+        updated = []
+        for i in np.flatnonzero(updating):
+            row = rows[ids[i]]
+            self._count(deltas, row, -1)
+            if present['amount'][i]:
+                row.amount_minor = int(amounts[i])
+            if present['date'][i]:
+                row.date = dates[i]
+            if present['description'][i]:
+                row.description = descriptions[i]
+            if present[self.label][i]:
+                setattr(row, f'{self.label}_id', int(labels[i]))
+            row.content_hash = imports.content_hash(row.date, row.amount_minor, row.currency, row.description)
+            self._count(deltas, row, 1)
+            updated.append(row)
+        columns = {'amount': 'amount_minor', 'date': 'date', 'description': 'description', self.label: self.label}
+        fields = [column for field, column in columns.items() if present[field][updating].any()]
+        if set(fields) & {'amount_minor', 'date', 'description'}:
+            fields.append('content_hash')
+        if fields:
+            self.model.objects.bulk_update(updated, fields, batch_size=BATCH_SIZE)
+
+        deleted = [rows[pk] for pk in ids[deleting]]
+        for row in deleted:
+            self._count(deltas, row, -1)
+        if deleted:
+            bulk.delete(self.model.objects.filter(owner_id=owner_id, pk__in=[row.pk for row in deleted]))
+
+        if self.rollups:
+            rollups.apply_deltas(deltas)
+        if len(created) != len(deleted):
+            counters.add(owner_id, self.name, len(created) - len(deleted))
+        versioning.bump(owner_id)
+
+        results = [None] * n
+        for status, mask, done in (('created', creating, created), ('updated', updating, updated),
+                                   ('deleted', deleting, deleted)):
+            for i, row in zip(np.flatnonzero(mask), done):
+                results[i] = {'status': status, 'id': row.pk}
+        return results
+
+    def _count(self, deltas, row, sign):
+        if self.rollups:
+            key = rollups.rollup_key(row.owner_id, row.date, getattr(row, f'{self.label}_id'), row.currency)
+            total, count = deltas[key]
+            deltas[key] = (total + sign * row.amount_minor, count + sign)
+
+
+EXPENSES = BatchTarget('expenses', Expense, 'category', reference.categories, rollups=True)
+INCOMES = BatchTarget('incomes', UserIncome, 'source', reference.sources)
+
+
+def respond(request, target):
+    """Handle a POST of ``{"operations": [...]}`` to ``target``'s batch endpoint."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Log in first'}, status=401)
+    # A cross-site form can't send JSON, which is why the endpoints can be csrf_exempt
+    if request.content_type != 'application/json':
+        return JsonResponse({'error': 'Send the batch as application/json'}, status=415)
+    try:
+        operations = json.loads(request.body)['operations']
+    except (ValueError, KeyError, TypeError):
+        operations = None
+    if not isinstance(operations, list) or not operations:
+        return JsonResponse({'error': 'operations must be a non-empty list'}, status=400)
+    if len(operations) > settings.BATCH_MAX_OPERATIONS:
+        return JsonResponse({'error': f'At most {settings.BATCH_MAX_OPERATIONS} operations per batch'}, status=413)
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= BatchRequest._meta.get_field('key').max_length:
+        return JsonResponse({'error': 'Idempotency-Key must be 1 to 255 characters'}, status=400)
+    try:
+        results, replayed = target.apply(request.user.id, operations, key)
+    except InvalidBatch as e:
+        return JsonResponse({'results': e.results}, status=400)
+    except KeyReused:
+        return JsonResponse({'error': 'This Idempotency-Key was sent with other operations'}, status=422)
+    response = JsonResponse({'results': results})
+    if replayed:
+        response['Idempotent-Replayed'] = 'true'
+    return response
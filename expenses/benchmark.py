@@ -0,0 +1,375 @@
+"""
+Scenario benchmark of every route, run by ``manage.py benchmark``.
+
+A scenario walks through the site the way a user does (log in, page through
+the list, type a search, add an expense, sync a batch, import a statement,
+look at the stats, export) with the test client, against users made by
+``seed``. Every request is timed and its SQL queries counted, keyed by
+method and URL name, so ``GET search-expenses`` collects all the typeahead
+requests whatever their query string. GETs send back the ETag of the
+previous response for the same URL, as the browser does.
+
+``compare`` checks a run against a stored baseline: a route regresses when
+its median request runs more queries than it used to, or its latency (p50
+unless asked for a higher percentile, which is noisier) grows past the
+tolerance.
+"""
+import datetime
+import itertools
+import random
+import re
+import time
+import uuid
+from importlib import import_module
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import PasswordResetTokenGenerator
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, resolve
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from authentication.models import OutboxEmail
+from userincome.models import Source, UserIncome
+
+from . import counters, imports, jobs, rollups
+from .models import Category, Expense, ExportJob
+
+ROUTE_MODULES = ('expenses.urls', 'userincome.urls', 'authentication.urls', 'userpreferences.urls')
+USERNAME_PREFIX = 'bench'
+PASSWORD = 'bench-password'
+CATEGORIES = ['Food', 'Rent', 'Travel', 'Fun', 'Health', 'Books', 'Gifts', 'Bills']
+SOURCES = ['Salary', 'Business', 'Side hustles', 'Gifts']
+WORDS = ['groceries', 'coffee', 'taxi', 'cinema', 'pharmacy', 'paperback', 'dinner', 'electricity', 'present',
+         'train', 'lunch', 'internet']
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.queries = {}
+        self.requests = 0
+        self.started = time.perf_counter()
+        self.wall = None
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.started
+
+    def record(self, route, elapsed, queries):
+        self.timings.setdefault(route, []).append(elapsed)
+        self.queries.setdefault(route, []).append(queries)
+        self.requests += 1
+
+    def merge(self, other):
+        for route, timings in other.timings.items():
+            self.timings.setdefault(route, []).extend(timings)
+            self.queries.setdefault(route, []).extend(other.queries[route])
+        self.requests += other.requests
+
+    def results(self):
+        """Return ``{route: stats}`` with latencies in milliseconds."""
+        wall = self.wall or time.perf_counter() - self.started
+        results = {}
+        for route in sorted(self.timings):
+            timings = np.array(self.timings[route]) * 1000
+            queries = self.queries[route]
+            p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+            results[route] = {'requests': len(timings), 'throughput': round(len(timings) / wall, 2),
+                              'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2),
+                              'queries': int(np.median(queries)), 'max_queries': max(queries)}
+        return results
+
+
+class MeasuredClient(Client):
+    """A test client that records every request it makes."""
+
+    def __init__(self, recorder, **defaults):
+        super().__init__(**defaults)
+        self.recorder = recorder
+        self.etags = {}
+
+    def request(self, **request):
+        method = request['REQUEST_METHOD']
+        url = request['PATH_INFO'] + '?' + request.get('QUERY_STRING', '')
+        if method == 'GET' and url in self.etags:
+            request['HTTP_IF_NONE_MATCH'] = self.etags[url]
+        # The query log is capped (9000 entries); once full it stops growing
+        # and every request would count 0
+        reset_queries()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = super().request(**request)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - started
+        if response.status_code >= 500:
+            raise BenchmarkError(f'{method} {url} failed with {response.status_code}')
+        if method == 'GET' and response.has_header('ETag'):
+            self.etags[url] = response['ETag']
+        self.recorder.record(f'{method} {resolve(request["PATH_INFO"]).url_name}', elapsed, len(captured))
+        return response
+
+
+def expect(response, *statuses):
+    if response.status_code not in statuses:
+        raise BenchmarkError(f'{response.request["REQUEST_METHOD"]} {response.request["PATH_INFO"]} '
+                             f'returned {response.status_code}, expected {statuses}')
+    return response
+
+
+def routes():
+    """The URL names of every route the benchmark should cover."""
+    names = set()
+    for module in ROUTE_MODULES:
+        names.update(pattern.name for pattern in import_module(module).urlpatterns if isinstance(pattern, URLPattern))
+    return names
+
+
+def uncovered(recorder):
+    seen = {route.split(' ', 1)[1] for route in recorder.timings}
+    return sorted(routes() - seen)
+
+
+def shared_ids(model):
+    # Name to key of the shared categories or sources, which the forms post
+    return dict(model.objects.filter(owner=None).values_list('name', 'pk'))
+
+
+def seed(users, rows, seed=0):
+    """
+    Create ``users`` users with ``rows`` expenses and ``rows // 3`` incomes
+    each, the same data for the same ``seed``. Returns the users.
+    """
+    rng = random.Random(seed)
+    Category.objects.bulk_create([Category(name=name) for name in CATEGORIES], ignore_conflicts=True)
+    Source.objects.bulk_create([Source(name=name) for name in SOURCES], ignore_conflicts=True)
+    categories, sources = shared_ids(Category), shared_ids(Source)
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(User(username=f'{USERNAME_PREFIX}{n}', email=f'{USERNAME_PREFIX}{n}@example.com',
+                                  password=password) for n in range(users))
+    owners = seeded_users()
+    today = datetime.date.today()
+    for owner in owners:
+        expenses = []
+        incomes = []
+        for n in range(rows):
+            date = today - datetime.timedelta(days=rng.randrange(3 * 365))
+            expenses.append(Expense(owner=owner, amount_minor=rng.randrange(100, 50000), currency='USD', date=date,
+                                    description=' '.join(rng.sample(WORDS, 2)), category_id=categories[rng.choice(CATEGORIES)]))
+            if n % 3 == 0:
+                incomes.append(UserIncome(owner=owner, amount_minor=rng.randrange(10000, 500000), currency='USD',
+                                          date=date, description=rng.choice(WORDS), source_id=sources[rng.choice(SOURCES)]))
+        for row in expenses + incomes:
+            row.content_hash = imports.content_hash(row.date, row.amount_minor, row.currency, row.description)
+        Expense.objects.bulk_create(expenses, batch_size=1000)
+        UserIncome.objects.bulk_create(incomes, batch_size=1000)
+    owner_ids = [owner.pk for owner in owners]
+    rollups.rebuild(owner_ids)
+    counters.rebuild(owner_ids)
+    # Plan against real table statistics, as a long-running database would
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    return owners
+
+
+def seeded_users():
+    return list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('pk'))
+
+
+def log_in(client, user):
+    expect(client.get('/authentication/login/'), 200)
+    expect(client.post('/authentication/login/', {'username': user.username, 'password': PASSWORD}), 302)
+
+
+def log_out(client):
+    expect(client.post('/authentication/logout'), 302)
+
+
+def page_through(client, path, pages):
+    response = expect(client.get(path), 200)
+    for _ in range(pages):
+        page_obj = response.context['page_obj']
+        if not page_obj.has_next:
+            break
+        response = expect(client.get(path + page_obj.next_query), 200)
+
+
+def type_search(client, path, rng):
+    word = rng.choice(WORDS)
+    for n in range(1, min(len(word), 6) + 1):
+        data = expect(client.get(path, {'searchText': word[:n]}), 200).json()
+    if data['next']:
+        expect(client.get(path, {'searchText': word[:n], 'cursor': data['next']}), 200)
+    # Backspace and type the last letter again: the browser revalidates
+    expect(client.get(path, {'searchText': word[:n - 1]}), 200, 304)
+    expect(client.get(path, {'searchText': word[:n]}), 200, 304)
+
+
+def sync_batch(client, path, label, keys, rng, rows=200):
+    # What the bank sync does: push a batch, retry it as if the response was
+    # lost, then take the rows back out in a second batch
+    date = datetime.date.today().isoformat()
+    operations = [{'op': 'create', 'amount': f'{rng.randrange(1, 500)}.{rng.randrange(100):02d}', 'date': date,
+                   'description': ' '.join(rng.sample(WORDS, 2)), label: rng.choice(keys)} for _ in range(rows)]
+    # Fresh for every run: the warm-up and the measured runs share a seed
+    key = f'bench-{uuid.uuid4()}'
+    results = expect(client.post(path, {'operations': operations}, content_type='application/json',
+                                 headers={'Idempotency-Key': key}), 200).json()['results']
+    expect(client.post(path, {'operations': operations}, content_type='application/json',
+                       headers={'Idempotency-Key': key}), 200)
+    expect(client.post(path, {'operations': [{'op': 'delete', 'id': result['id']} for result in results]},
+                       content_type='application/json'), 200)
+
+
+def import_statement(client, user, rng, rows=200):
+    # A month's statement, uploaded twice: the second time it is all duplicates
+    lines = ['date,amount,description']
+    for n in range(rows):
+        amount = rng.randrange(-20000, 300000 if n % 20 == 0 else 0)
+        lines.append(f'{datetime.date.today() - datetime.timedelta(days=rng.randrange(30))},{amount / 100:.2f},'
+                     f'card {rng.getrandbits(32):x} {rng.choice(WORDS)}')
+    data = {'category': shared_ids(Category)['Bills'], 'source': shared_ids(Source)['Salary']}
+    for _ in range(2):
+        statement = SimpleUploadedFile('statement.csv', '\n'.join(lines).encode(), content_type='text/csv')
+        expect(client.post('/import-statement', dict(data, statement=statement)), 200)
+    # Taken back out outside the measured requests, through the signals
+    for model in (Expense, UserIncome):
+        for row in model.objects.filter(owner=user, description__startswith='card '):
+            row.delete()
+
+
+def expenses_scenario(client, user, rng):
+    log_in(client, user)
+    page_through(client, '/', 3)
+    type_search(client, '/search-expenses', rng)
+
+    expect(client.get('/add-expense'), 200)
+    values = {'amount': f'{rng.randrange(1, 200)}.{rng.randrange(100):02d}', 'description': ' '.join(rng.sample(WORDS, 2)),
+              'date': datetime.date.today().isoformat(), 'category': shared_ids(Category)[rng.choice(CATEGORIES)]}
+    expect(client.post('/add-expense', values), 302)
+    expense = Expense.objects.filter(owner=user).latest('pk')
+    expect(client.get(f'/edit-expense/{expense.pk}/'), 200)
+    expect(client.post(f'/edit-expense/{expense.pk}/', dict(values, amount='12.50')), 302)
+    sync_batch(client, '/batch-expenses', 'category', list(shared_ids(Category).values()), rng)
+    import_statement(client, user, rng)
+
+    expect(client.get('/stats'), 200)
+    expect(client.get('/expense_category_summary'), 200)
+    expect(client.get('/expense_category_summary'), 304)
+    expect(client.get('/budgets/status'), 200)
+    today = datetime.date.today()
+    window = {'start': (today - datetime.timedelta(days=365)).isoformat(), 'end': today.isoformat()}
+    expect(client.get('/export-csv', window), 200)
+    expect(client.get('/export-excel', window), 200)
+    expect(client.get('/export-pdf', window), 200)
+
+    job = expect(client.post('/export-jobs/csv'), 200, 201).json()
+    # What run_export_worker would do, outside the measured requests; claimed
+    # directly so concurrent runners don't take each other's jobs
+    if ExportJob.objects.filter(pk=job['id'], status=ExportJob.PENDING).update(
+            status=ExportJob.RUNNING, started_at=timezone.now()):
+        jobs.run(job['id'])
+    expect(client.get(f'/export-jobs/{job["id"]}/status'), 200)
+    expect(client.get(f'/export-jobs/{job["id"]}/download'), 200)
+
+    expect(client.get(f'/delete-expense/{expense.pk}'), 302)
+    expect(client.get('/preferences/'), 200)
+    expect(client.post('/preferences/', {'currency': 'USD - United States Dollar'}), 200)
+    log_out(client)
+    # What the Prometheus scraper does every few seconds
+    expect(client.get('/metrics'), 200)
+
+
+def income_scenario(client, user, rng):
+    log_in(client, user)
+    page_through(client, '/income/income', 3)
+    type_search(client, '/income/search-income', rng)
+
+    expect(client.get('/income/add-income/'), 200)
+    values = {'amount': str(rng.randrange(100, 5000)), 'description': rng.choice(WORDS),
+              'income_date': datetime.date.today().isoformat(), 'source': shared_ids(Source)[rng.choice(SOURCES)]}
+    expect(client.post('/income/add-income/', values), 302)
+    income = UserIncome.objects.filter(owner=user).latest('pk')
+    expect(client.get(f'/income/edit-income/{income.pk}/'), 200)
+    expect(client.post(f'/income/edit-income/{income.pk}/', dict(values, amount='99')), 302)
+    sync_batch(client, '/income/batch-income', 'source', list(shared_ids(Source).values()), rng)
+    expect(client.get('/income/export-csv'), 200)
+    expect(client.get(f'/income/delete-income/{income.pk}/'), 302)
+    log_out(client)
+
+
+_newcomers = itertools.count()
+
+
+def newcomer_scenario(client, user, rng):
+    # The scenario signs up a new account; ``user`` only goes into its name
+    username = f'new{user.pk}x{next(_newcomers)}'
+    email = f'{username}@example.com'
+    expect(client.get('/authentication/register/'), 200)
+    for n in range(3, len(username) + 1, 3):
+        expect(client.post('/authentication/validate-username/', {'username': username[:n]},
+                           content_type='application/json'), 200, 409)
+    expect(client.post('/authentication/validate-email/', {'email': email}, content_type='application/json'), 200)
+    expect(client.post('/authentication/register/', {'username': username, 'email': email, 'password': PASSWORD}),
+           200)
+    body = OutboxEmail.objects.filter(to=[email]).latest('pk').body
+    expect(client.get(re.search(r'/authentication/activate/\S+/', body).group(0)), 302)
+    log_in(client, User.objects.get(username=username))
+    log_out(client)
+
+    expect(client.get('/authentication/request-reset-link'), 200)
+    expect(client.post('/authentication/request-reset-link', {'email': email}), 200)
+    new = User.objects.get(username=username)
+    path = (f'/authentication/set-newpassword/{urlsafe_base64_encode(force_bytes(new.pk))}/'
+            f'{PasswordResetTokenGenerator().make_token(new)}/')
+    expect(client.get(path), 200)
+    expect(client.post(path, {'password': PASSWORD, 'password2': PASSWORD}), 302)
+
+
+SCENARIOS = {
+    'expenses': expenses_scenario,
+    'income': income_scenario,
+    'newcomer': newcomer_scenario,
+}
+
+
+def run(scenarios, users, iterations, recorder=None, seed=0):
+    """Run each of ``scenarios`` ``iterations`` times, cycling through ``users``."""
+    recorder = recorder or Recorder()
+    rng = random.Random(seed)
+    for iteration in range(iterations):
+        for name in scenarios:
+            user = users[(iteration * len(scenarios) + scenarios.index(name)) % len(users)]
+            SCENARIOS[name](MeasuredClient(recorder), user, rng)
+    return recorder
+
+
+def compare(results, baseline, metric='p50', tolerance=0.25, slack=2.0):
+    """
+    Return a description of each regression of ``results`` against
+    ``baseline``: more queries in the median request, or a ``metric``
+    latency more than ``tolerance`` (a fraction) plus ``slack``
+    milliseconds slower. A route the baseline doesn't have fails too, so
+    that new routes are gated from the start.
+    """
+    regressions = [f'{route}: not in the baseline, record it with --save-baseline'
+                   for route in sorted(results) if route not in baseline]
+    for route, before in sorted(baseline.items()):
+        after = results.get(route)
+        if after is None:
+            continue
+        if after['queries'] > before['queries']:
+            regressions.append(f'{route}: {after["queries"]} queries per request, was {before["queries"]}')
+        if after[metric] > before[metric] * (1 + tolerance) + slack:
+            regressions.append(f'{route}: {metric} {after[metric]:.1f}ms, was {before[metric]:.1f}ms')
+    return regressions
@@ -0,0 +1,109 @@
+"""
+Monthly category budgets and their nightly evaluation.
+
+``evaluate`` (run by ``manage.py evaluate_budgets``) takes one month for all
+users at once. It streams the month's budgets and the matching monthly
+totals from ``ExpenseRollup`` (never ``Expense``) in one query each, matches
+them up, converts and projects the spending with NumPy, and rewrites the
+month's ``BudgetStatus`` rows with ``expenses.bulk``. ``status`` only reads
+those rows.
+
+A budget is over once its spending passes the amount, and at risk when
+spending on at the month's pace so far would pass it by the month's end.
+Spending in a currency with no known rate is left out, as in the summary.
+"""
+import datetime
+from itertools import batched
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import bulk, money, rates, rollups
+from .models import Budget, BudgetStatus, ExpenseRollup
+
+CHUNK_SIZE = 10000
+
+
+def _columns(rows, dtypes):
+    """Read an iterator of tuples into one array per column, a chunk at a time."""
+    columns = [[] for _ in dtypes]
+    for chunk in batched(rows, CHUNK_SIZE):
+        for column, values, dtype in zip(columns, zip(*chunk), dtypes):
+            column.append(np.array(values, dtype=dtype))
+    return [np.concatenate(column) if column else np.array([], dtype=dtype) for column, dtype in zip(columns, dtypes)]
+
+
+def _spent(budget_keys, budget_currencies, keys, currencies, totals, as_of):
+    """Sum the rollup rows into the budgets they belong to, in each budget's currency."""
+    order = np.argsort(budget_keys)
+    found = order[np.minimum(np.searchsorted(budget_keys, keys, sorter=order), len(order) - 1)]
+    # A budget deleted since it was read leaves rows with nowhere to go
+    matched = budget_keys[found] == keys
+    found, currencies, totals = found[matched], currencies[matched], totals[matched]
+    targets = budget_currencies[found]
+    converted = np.zeros(len(found), dtype=np.int64)
+    for target in np.unique(targets):
+        rows = targets == target
+        converted[rows], _ = rates.convert(totals[rows], currencies[rows], np.full(rows.sum(), as_of), target)
+    return np.bincount(found, weights=converted, minlength=len(budget_keys)).astype(np.int64)
+
+
+def evaluate(month, today=None):
+    """Evaluate every budget of ``month`` as of ``today`` and return how many there were."""
+    month = rollups.month_start(month)
+    end = rollups.next_month(month) - datetime.timedelta(days=1)
+    as_of = min(max(today or datetime.date.today(), month), end)
+    budgets = Budget.objects.filter(month=month).order_by()
+    ids, owners, categories, budget_currencies, amounts = _columns(
+        budgets.values_list('id', 'owner_id', 'category_id', 'currency', 'amount_minor').iterator(CHUNK_SIZE),
+        [np.int64, np.int64, np.int64, object, np.int64])
+
+    rows = (ExpenseRollup.objects.filter(month=month).order_by()
+            .filter(Exists(budgets.filter(owner_id=OuterRef('owner_id'), category_id=OuterRef('category_id'))))
+            .values_list('owner_id', 'category_id', 'currency', 'total_minor'))
+    row_owners, row_categories, row_currencies, totals = _columns(
+        rows.iterator(CHUNK_SIZE), [np.int64, np.int64, object, np.int64])
+
+    # (owner, category) pairs as single integers, to match rows to budgets by sorting
+    width = int(max(categories.max(initial=0), row_categories.max(initial=0))) + 1
+    budget_keys = owners * width + categories
+    keys = row_owners * width + row_categories
+    spent = (_spent(budget_keys, budget_currencies, keys, row_currencies, totals, as_of)
+             if len(ids) else np.zeros(0, dtype=np.int64))
+    elapsed = (as_of - month).days + 1
+    days = (end - month).days + 1
+    projected = np.rint(spent * (days / elapsed)).astype(np.int64)
+    states = np.where(spent > amounts, BudgetStatus.OVER,
+                      np.where(projected > amounts, BudgetStatus.AT_RISK, BudgetStatus.OK))
+
+    # Naive UTC, which is what the connection's time zone reads it as
+    now = timezone.now().replace(tzinfo=None)
+    with transaction.atomic():
+        BudgetStatus.objects.filter(budget__month=month).delete()
+        bulk.load(BudgetStatus, {
+            'budget_id': ids, 'spent_minor': spent, 'projected_minor': projected,
+            'state': states.astype(object), 'as_of': np.full(len(ids), np.datetime64(as_of)),
+            'evaluated_at': np.full(len(ids), np.datetime64(now)),
+        })
+    return len(ids)
+
+
+def status(owner_id, month):
+    """The budgets of ``owner_id`` for ``month`` with their last evaluation, for the status endpoint."""
+    budgets = (Budget.objects.filter(owner_id=owner_id, month=rollups.month_start(month))
+               .select_related('category', 'status').order_by('category__name'))
+    result = []
+    for budget in budgets:
+        entry = {'category': budget.category.name, 'currency': budget.currency,
+                 'amount': str(money.from_minor(budget.amount_minor, budget.currency))}
+        evaluation = getattr(budget, 'status', None)
+        if evaluation is None:
+            entry['state'] = None
+        else:
+            entry.update(state=evaluation.state, as_of=evaluation.as_of.isoformat(),
+                         spent=str(money.from_minor(evaluation.spent_minor, budget.currency)),
+                         projected=str(money.from_minor(evaluation.projected_minor, budget.currency)))
+        result.append(entry)
+    return result
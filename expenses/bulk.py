@@ -0,0 +1,102 @@
+"""
+Bulk writes that skip the ORM: inserts and updates of rows held as NumPy
+column arrays, and deletes.
+
+PostgreSQL gets inserted rows through ``COPY ... FROM STDIN`` as they are
+formatted, SQLite through ``executemany`` in one transaction. Updates are
+one ``UPDATE ... FROM (VALUES ...)`` per call. ``save`` and the signals are
+skipped throughout.
+"""
+import numpy as np
+from django.db import connection, transaction
+
+
+def _columns(model, data):
+    fields = [model._meta.get_field(name) for name in data]
+    return model._meta.db_table, [field.column for field in fields]
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_chunks(columns, rows=10000):
+    # COPY text format; only text can hold its delimiters
+    columns = [[_escape(value) for value in column.astype(str).tolist()] if column.dtype.kind in 'OU'
+               else column.astype(str).tolist() for column in columns]
+    for start in range(0, len(columns[0]), rows):
+        lines = zip(*[column[start:start + rows] for column in columns])
+        yield ''.join('\t'.join(line) + '\n' for line in lines).encode()
+
+
+class _ChunkStream:
+    """A read()-able file over an iterator of byte strings, for psycopg2's copy_expert."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def load(model, data):
+    """Insert the rows in ``data`` (column arrays by field name) into ``model``'s table."""
+    table, columns = _columns(model, data)
+    values = list(data.values())
+    if not len(values[0]):
+        return 0
+    if connection.vendor == 'postgresql':
+        sql = f'COPY {table} ({", ".join(columns)}) FROM STDIN'
+        with connection.cursor() as cursor:
+            raw = cursor.cursor
+            if hasattr(raw, 'copy_expert'):
+                raw.copy_expert(sql, _ChunkStream(_copy_chunks(values)), size=1 << 20)
+            else:
+                # psycopg 3
+                with raw.copy(sql) as copy:
+                    for chunk in _copy_chunks(values):
+                        copy.write(chunk)
+    else:
+        placeholders = ', '.join(['%s'] * len(columns))
+        rows = zip(*[column.astype(str) if column.dtype.kind == 'M' else column.tolist() for column in values])
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders})', rows)
+    return len(values[0])
+
+
+def update(model, pks, data):
+    """Set the fields in ``data`` (arrays by field name) on the rows of ``model`` with primary keys ``pks``."""
+    table, columns = _columns(model, data)
+    values = [np.asarray(pks).tolist()] + [np.asarray(column).tolist() for column in data.values()]
+    if not values[0]:
+        return 0
+    names = [f'c{n}' for n in range(len(values))]
+    rows = ', '.join([f'({", ".join(["%s"] * len(values))})'] * len(values[0]))
+    assignments = ', '.join(f'{column} = v.{name}' for column, name in zip(columns, names[1:]))
+    with connection.cursor() as cursor:
+        cursor.execute(f'WITH v ({", ".join(names)}) AS (VALUES {rows}) '
+                       f'UPDATE {table} SET {assignments} FROM v WHERE {table}.{model._meta.pk.column} = v.c0',
+                       [value for row in zip(*values) for value in row])
+        return cursor.rowcount
+
+
+def delete(queryset):
+    """
+    Delete ``queryset``'s rows in one statement and return how many went.
+    Unlike ``QuerySet.delete`` the rows are not fetched first and no
+    signals are sent, so nothing may point at them.
+    """
+    model = queryset.model
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE {model._meta.pk.column} IN ({sql})', params)
+        return cursor.rowcount
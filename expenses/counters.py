@@ -0,0 +1,48 @@
+"""
+Per-user expense and income counts.
+
+``RecordCount`` is updated by the signal handlers in ``expenses.signals``;
+loaders that bypass signals (bulk_create, raw SQL) must call ``add``
+themselves or ``rebuild`` afterwards.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from userincome.models import UserIncome
+
+from .models import Expense, RecordCount
+
+FIELDS = ('expenses', 'incomes')
+
+
+def add(owner_id, field, delta):
+    rows = RecordCount.objects.filter(owner_id=owner_id)
+    if rows.update(**{field: F(field) + delta}):
+        return
+    try:
+        with transaction.atomic():
+            RecordCount.objects.create(owner_id=owner_id, **{field: delta})
+    except IntegrityError:
+        rows.update(**{field: F(field) + delta})
+
+
+def get(owner_id, field):
+    return max(0, RecordCount.objects.filter(owner_id=owner_id).values_list(field, flat=True).first() or 0)
+
+
+def rebuild(owner_ids=None):
+    """Recount every user's rows from scratch, optionally for some users only."""
+    counts = {}
+    for field, model in (('expenses', Expense), ('incomes', UserIncome)):
+        rows = model.objects.order_by()
+        if owner_ids is not None:
+            rows = rows.filter(owner_id__in=owner_ids)
+        for owner_id, count in rows.values_list('owner_id').annotate(count=Count('id')):
+            counts.setdefault(owner_id, dict.fromkeys(FIELDS, 0))[field] = count
+    with transaction.atomic():
+        existing = RecordCount.objects.all()
+        if owner_ids is not None:
+            existing = existing.filter(owner_id__in=owner_ids)
+        existing.delete()
+        RecordCount.objects.bulk_create(RecordCount(owner_id=owner_id, **values) for owner_id, values in counts.items())
+    return len(counts)
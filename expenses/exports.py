@@ -0,0 +1,209 @@
+"""
+Export writers shared by the expense and income export views.
+
+Rows are always read as a ``values_list`` projection through
+``QuerySet.iterator(chunk_size=...)``, which uses a server-side cursor on
+PostgreSQL, so memory stays flat however many rows a user has.
+"""
+import csv
+import time
+from collections import Counter
+from itertools import islice
+
+import xlsxwriter
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from . import metrics, money, rates
+
+CSV_FLUSH_BYTES = 64 * 1024
+XLSX_MAX_ROWS = 1048576
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# (header, field, kind) per exported column; kind sets the XLSX cell type.
+# 'money' columns hold minor units and are converted using the row's currency.
+# converted() adds the amount in the user's currency, see expenses.rates.
+# Names are joined in by key.
+EXPENSE_COLUMNS = [('Amount', 'amount_minor', 'money'), ('Currency', 'currency', 'text'),
+                   ('Description', 'description', 'text'), ('Category', 'category__name', 'text'),
+                   ('Date', 'date', 'date')]
+INCOME_COLUMNS = [('Amount', 'amount_minor', 'money'), ('Currency', 'currency', 'text'),
+                  ('Description', 'description', 'text'), ('Source', 'source__name', 'text'),
+                  ('Date', 'date', 'date')]
+
+
+class Echo:
+    # File-like object for csv.writer that hands each line back instead of storing it
+    def write(self, value):
+        return value
+
+
+def chunk_size():
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+def iter_rows(queryset, fields):
+    return queryset.order_by('-date', '-id').values_list(*fields).iterator(chunk_size=chunk_size())
+
+
+def converted(columns, currency):
+    """Return ``columns`` plus the amount converted to ``currency``, if one is given."""
+    if not currency:
+        return columns
+    return columns + [(f'Amount ({currency})', 'amount_minor', 'converted')]
+
+
+def export_rows(queryset, columns, currency=None):
+    """
+    Yield the ``columns`` of each row, with money columns as Decimals.
+    'converted' columns hold the amount in ``currency``, or None where no
+    exchange rate is known; they are converted a chunk of rows at a time.
+    """
+    fields = [field for _, field, _ in columns]
+    kinds = [kind for _, _, kind in columns]
+    if 'money' not in kinds and 'converted' not in kinds:
+        yield from iter_rows(queryset, fields)
+        return
+    fields = list(dict.fromkeys(fields + ['amount_minor', 'currency', 'date']))
+    position = {field: index for index, field in enumerate(fields)}
+    rows = iter_rows(queryset, fields)
+    while chunk := list(islice(rows, chunk_size())):
+        if 'converted' in kinds:
+            amounts, missing = rates.convert([row[position['amount_minor']] for row in chunk],
+                                             [row[position['currency']] for row in chunk],
+                                             [row[position['date']] for row in chunk], currency)
+        for index, row in enumerate(chunk):
+            values = []
+            for _, field, kind in columns:
+                value = row[position[field]]
+                if kind == 'money':
+                    value = money.from_minor(value, row[position['currency']])
+                elif kind == 'converted':
+                    value = None if missing[index] else money.from_minor(int(amounts[index]), currency)
+                values.append(value)
+            yield values
+
+
+def with_progress(rows, progress):
+    """Pass ``rows`` through, calling ``progress(n)`` after every ``n`` rows read."""
+    if progress is None:
+        yield from rows
+        return
+    every = chunk_size()
+    done = 0
+    for row in rows:
+        yield row
+        done += 1
+        if done == every:
+            progress(done)
+            done = 0
+    if done:
+        progress(done)
+
+
+def csv_chunks(header, rows):
+    # The header is yielded before the first row is fetched, so the client
+    # starts receiving data while the query is still running.
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    buffer = []
+    size = 0
+    for row in rows:
+        line = writer.writerow(row)
+        buffer.append(line)
+        size += len(line)
+        if size >= CSV_FLUSH_BYTES:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def csv_export_chunks(columns, queryset, progress=None, currency=None):
+    rows = with_progress(export_rows(queryset, columns, currency), progress)
+    return csv_chunks([header for header, _, _ in columns], rows)
+
+
+def _measured_csv(chunks):
+    started = time.perf_counter()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk.encode())
+        yield chunk
+    metrics.export_finished('csv', time.perf_counter() - started, size)
+
+
+def stream_csv(filename, columns, queryset, currency=None):
+    response = StreamingHttpResponse(_measured_csv(csv_export_chunks(columns, queryset, currency=currency)),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def write_csv(path, columns, queryset, progress=None, currency=None):
+    with open(path, 'w', newline='', encoding='utf-8') as output:
+        for chunk in csv_export_chunks(columns, queryset, progress, currency):
+            output.write(chunk)
+
+
+def write_xlsx(target, sheets, progress=None, currency=None):
+    """
+    Write an XLSX workbook to ``target`` (a path or binary file object).
+
+    ``sheets`` is a list of ``(title, columns, queryset)`` where ``columns``
+    holds ``(header, field, kind)`` triples and ``kind`` is ``'money'``,
+    ``'converted'`` (to ``currency``), ``'number'``, ``'date'`` or
+    ``'text'``, so cells keep their type in Excel. Each
+    queryset gets one sheet, or one sheet per year once it has more than
+    ``EXPORT_XLSX_SPLIT_ROWS`` rows. The workbook is written in xlsxwriter's
+    constant-memory mode: rows go to disk as soon as they are written.
+    ``progress(n)`` is called as rows are written.
+    """
+    split_rows = getattr(settings, 'EXPORT_XLSX_SPLIT_ROWS', 50000)
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+    formats = {
+        'header': workbook.add_format({'bold': True}),
+        'number': workbook.add_format({'num_format': '#,##0.00'}),
+        'date': workbook.add_format({'num_format': 'yyyy-mm-dd'}),
+    }
+    titles = Counter()
+    try:
+        for title, columns, queryset in sheets:
+            by_year = queryset.count() > split_rows
+            fields = [field for _, field, _ in columns]
+            kinds = [kind for _, _, kind in columns]
+            date_column = fields.index('date')
+            sheet = sheet_key = None
+            row_num = 0
+            for row in with_progress(export_rows(queryset, columns, currency), progress):
+                key = row[date_column].year if by_year else None
+                if sheet is None or key != sheet_key or row_num >= XLSX_MAX_ROWS:
+                    sheet = _add_sheet(workbook, titles, f'{title} {key}' if by_year else title, columns, formats)
+                    sheet_key = key
+                    row_num = 1
+                for col_num, (value, kind) in enumerate(zip(row, kinds)):
+                    if value is None:
+                        continue
+                    if kind in ('money', 'converted', 'number'):
+                        sheet.write_number(row_num, col_num, float(value), formats['number'])
+                    elif kind == 'date':
+                        sheet.write_datetime(row_num, col_num, value, formats['date'])
+                    else:
+                        sheet.write_string(row_num, col_num, str(value))
+                row_num += 1
+            if sheet is None:
+                _add_sheet(workbook, titles, title, columns, formats)
+    finally:
+        workbook.close()
+
+
+def _add_sheet(workbook, titles, title, columns, formats):
+    titles[title] += 1
+    if titles[title] > 1:
+        title = f'{title} ({titles[title]})'
+    sheet = workbook.add_worksheet(title[:31])
+    for col_num, (header, _, kind) in enumerate(columns):
+        sheet.set_column(col_num, col_num, 40 if kind == 'text' else 14)
+        sheet.write_string(0, col_num, header, formats['header'])
+    return sheet
@@ -0,0 +1,70 @@
+"""
+Querysets behind the search box and the exports, shared by the views and
+the background export worker.
+"""
+from userincome.models import UserIncome
+
+from . import query, rates, reference, search
+from .models import Expense
+from .utils import filter_date_range, parse_date_range
+
+
+def filter_expenses(owner, parsed):
+    # Owner plus the structured part of a parsed search query
+    owner_id = getattr(owner, 'pk', owner)
+    return Expense.objects.filter(
+        query.compile_query(parsed, query.EXPENSE_FIELDS, {'category': lambda: reference.categories(owner_id)}),
+        owner=owner)
+
+
+def searched_expenses(owner, text):
+    # Everything a search for `text` matches, unranked and unpaginated, for exports
+    parsed = query.parse(text)
+    expenses = filter_expenses(owner, parsed)
+    tokens = search.tokenize(parsed.text)
+    if tokens:
+        expenses = search.EXPENSE_SEARCH.filter(expenses, tokens, reference.categories(getattr(owner, 'pk', owner)))
+    return expenses
+
+
+def filter_incomes(owner, parsed):
+    owner_id = getattr(owner, 'pk', owner)
+    return UserIncome.objects.filter(
+        query.compile_query(parsed, query.INCOME_FIELDS, {'source': lambda: reference.sources(owner_id)}),
+        owner=owner)
+
+
+def searched_incomes(owner, text):
+    parsed = query.parse(text)
+    incomes = filter_incomes(owner, parsed)
+    tokens = search.tokenize(parsed.text)
+    if tokens:
+        incomes = search.INCOME_SEARCH.filter(incomes, tokens, reference.sources(getattr(owner, 'pk', owner)))
+    return incomes
+
+
+def export_params(request):
+    """
+    Read the ?q=&start=&end= export filters, raising ValueError on bad dates.
+    The user's currency and the versions of the rate table, categories and
+    sources go along so that cached and coalesced exports are redone when
+    any changes.
+    """
+    start, end = parse_date_range(request)
+    return {
+        'q': request.GET.get('q', ''),
+        'start': start.isoformat() if start else None,
+        'end': end.isoformat() if end else None,
+        'currency': reference.user_currency_code(request.user.id),
+        'rates': rates.version(),
+        'categories': reference.version('categories'),
+        'sources': reference.version('sources'),
+    }
+
+
+def export_querysets(owner, params):
+    """Return the (expenses, incomes) querysets an export with ``params`` covers."""
+    expenses = searched_expenses(owner, params.get('q') or '')
+    incomes = searched_incomes(owner, params.get('q') or '')
+    return (filter_date_range(expenses, params.get('start'), params.get('end')),
+            filter_date_range(incomes, params.get('start'), params.get('end')))
@@ -0,0 +1,36 @@
+"""
+Cached fragments of the expense and income list pages.
+
+The table and pagination block of a list page depend on the user's rows,
+their currency preference, the exchange rates and the page asked for.
+``key`` covers all of them, the first two through the user's data version,
+so an add, edit or delete or a preference change moves the user to new keys
+and a stale fragment is never read again; it just ages out. The views hand
+the page to the template lazily, so a hit runs none of the list queries.
+
+Fragments live in the ``FRAGMENT_CACHE_ALIAS`` cache: local memory per
+process by default, a file or database cache when several nodes serve the
+site. Hits and misses are counted in ``expenses.metrics``.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics, rates, versioning
+
+
+def cache():
+    return caches[getattr(settings, 'FRAGMENT_CACHE_ALIAS', 'fragments')]
+
+
+def key(name, owner_id, *parts):
+    """The cache key of fragment ``name`` for ``owner_id``'s current data and ``parts`` (cursor, page size...)."""
+    return f'fragment:{name}:{owner_id}:{versioning.stamp(owner_id, rates.version(), *parts)}'
+
+
+def get_or_render(key, render):
+    html = cache().get(key)
+    metrics.cache_lookup('fragment', html is not None)
+    if html is None:
+        html = render()
+        cache().set(key, html)
+    return html
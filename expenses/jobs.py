@@ -0,0 +1,166 @@
+"""
+Export jobs, rendered off the request path.
+
+``submit`` queues a job, or hands back the live one already covering the
+same user, format, data version and filters. ``manage.py run_export_worker``
+claims pending jobs with a conditional UPDATE (so several workers can share
+the table), renders them with bounded concurrency and records progress as
+it goes. Finished files are kept for ``EXPORT_JOB_TTL`` seconds.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.urls import reverse
+from django.utils import timezone
+
+from . import exports, filters, metrics, reports, versioning
+from .models import ExportJob
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'csv': 'text/csv', 'xlsx': exports.XLSX_CONTENT_TYPE, 'pdf': 'application/pdf'}
+LIVE = (ExportJob.PENDING, ExportJob.RUNNING, ExportJob.DONE)
+# Failed and expired rows are kept this long for the status endpoint, then deleted
+RETENTION = datetime.timedelta(days=1)
+
+
+def job_dir():
+    path = getattr(settings, 'EXPORT_JOB_DIR', os.path.join(settings.BASE_DIR, 'cache', 'export-jobs'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def submit(owner_id, format, params):
+    """Return ``(job, created)`` for an export of ``owner_id``'s current data."""
+    key = dict(owner_id=owner_id, format=format, version=versioning.current(owner_id),
+               params_hash=params_hash(params))
+    live = ExportJob.objects.filter(status__in=LIVE, **key)
+    job = live.first()
+    if job is not None and job.status == ExportJob.DONE and job.expires_at <= timezone.now():
+        expire(job)
+        job = None
+    if job is not None:
+        return job, False
+    try:
+        with transaction.atomic():
+            return ExportJob.objects.create(params=params, **key), True
+    except IntegrityError:
+        # A duplicate request queued the same job first
+        return live.get(), False
+
+
+def claim(limit):
+    """Mark up to ``limit`` pending jobs as running and return their ids, oldest first."""
+    claimed = []
+    pending = ExportJob.objects.filter(status=ExportJob.PENDING).order_by('created_at', 'id')
+    for pk in pending.values_list('pk', flat=True)[:limit * 2]:
+        # Only one worker wins the UPDATE for a given job
+        if ExportJob.objects.filter(pk=pk, status=ExportJob.PENDING).update(
+                status=ExportJob.RUNNING, started_at=timezone.now(), progress=0):
+            claimed.append(pk)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+def run(pk):
+    """Render claimed job ``pk`` to a file under ``job_dir()``."""
+    job = ExportJob.objects.get(pk=pk)
+    # Every write is conditional so a job purged as timed out stays failed
+    jobs = ExportJob.objects.filter(pk=pk, status=ExportJob.RUNNING)
+    path = os.path.join(job_dir(), f'{job.pk}.{job.format}')
+    expenses, incomes = filters.export_querysets(job.owner_id, job.params)
+    total = expenses.count() + (incomes.count() if job.format == 'xlsx' else 0)
+    state = {'rows': 0, 'percent': 0}
+
+    def progress(rows):
+        state['rows'] += rows
+        percent = min(99, state['rows'] * 100 // max(total, 1))
+        if percent != state['percent']:
+            state['percent'] = percent
+            jobs.update(progress=percent)
+
+    started = time.perf_counter()
+    try:
+        currency = job.params.get('currency')
+        if job.format == 'csv':
+            exports.write_csv(path, exports.converted(exports.EXPENSE_COLUMNS, currency), expenses, progress, currency)
+        elif job.format == 'xlsx':
+            exports.write_xlsx(path, [('Expenses', exports.converted(exports.EXPENSE_COLUMNS, currency), expenses),
+                                      ('Incomes', exports.converted(exports.INCOME_COLUMNS, currency), incomes)],
+                               progress, currency)
+        else:
+            reports.render_expense_report(path, expenses, job.params, progress)
+    except Exception as e:
+        logger.exception('Export job %s failed', pk)
+        _remove(path)
+        jobs.update(status=ExportJob.FAILED, error=str(e) or e.__class__.__name__, finished_at=timezone.now())
+        return
+    metrics.export_finished(job.format, time.perf_counter() - started, os.path.getsize(path))
+    now = timezone.now()
+    ttl = getattr(settings, 'EXPORT_JOB_TTL', 3600)
+    if not jobs.update(status=ExportJob.DONE, progress=100, file_path=path, finished_at=now,
+                       expires_at=now + datetime.timedelta(seconds=ttl)):
+        _remove(path)
+
+
+def run_in_thread(pk):
+    # Worker threads get their own connection; don't leave it open between jobs
+    try:
+        run(pk)
+    finally:
+        connection.close()
+
+
+def expire(job):
+    _remove(job.file_path)
+    ExportJob.objects.filter(pk=job.pk, status=ExportJob.DONE).update(status=ExportJob.EXPIRED, file_path='')
+
+
+def purge(now=None):
+    """Expire finished jobs past their TTL, fail stuck ones and drop old rows."""
+    now = now or timezone.now()
+    for job in ExportJob.objects.filter(status=ExportJob.DONE, expires_at__lte=now).only('pk', 'file_path'):
+        expire(job)
+    # A worker that died mid-job leaves it running forever
+    timeout = getattr(settings, 'EXPORT_JOB_TIMEOUT', 3600)
+    ExportJob.objects.filter(
+        status=ExportJob.RUNNING, started_at__lt=now - datetime.timedelta(seconds=timeout),
+    ).update(status=ExportJob.FAILED, error='Timed out', finished_at=now)
+    ExportJob.objects.filter(
+        status__in=[ExportJob.FAILED, ExportJob.EXPIRED], finished_at__lt=now - RETENTION,
+    ).delete()
+
+
+def describe(job):
+    data = {
+        'id': job.pk,
+        'format': job.format,
+        'status': job.status,
+        'progress': job.progress,
+        'status_url': reverse('export-job-status', args=[job.pk]),
+        'download_url': None,
+        'expires_at': job.expires_at,
+        'error': job.error or None,
+    }
+    if job.status == ExportJob.DONE:
+        data['download_url'] = reverse('export-job-download', args=[job.pk])
+    return data
+
+
+def _remove(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,135 @@
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+# python -m arguments for each server
+SERVERS = {
+    'waitress': ['waitress', '--threads={threads}', '--listen=127.0.0.1:{port}',
+                 'expensewebsite.wsgi:application'],
+    'uvicorn': ['uvicorn', '--host=127.0.0.1', '--port={port}', '--workers={workers}',
+                '--log-level=warning', 'expensewebsite.asgi:application'],
+}
+
+# (name, method, path, JSON body)
+REQUESTS = [
+    ('search', 'GET', '/search-expenses?searchText={term}', None),
+    ('income search', 'GET', '/income/search-income?searchText={term}', None),
+    ('summary', 'GET', '/expense_category_summary', None),
+    ('validate username', 'POST', '/authentication/validate-username/', {'username': 'someone{n}'}),
+    ('validate email', 'POST', '/authentication/validate-email/', {'email': 'someone{n}@example.com'}),
+]
+
+TERMS = ['f', 'fo', 'foo', 'food', 'r', 're', 'ren', 'rent', '1', '12']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, pct):
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1] if len(samples) > 1 else samples[0]
+
+
+class Command(BaseCommand):
+    help = ('Compare request latency of the site under waitress (WSGI, threads) and uvicorn (ASGI) '
+            'against the configured database, by hitting the search, summary and validation '
+            'endpoints concurrently as an existing user.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='Username to make the requests as')
+        parser.add_argument('--server', choices=sorted(SERVERS), action='append', dest='servers',
+                            help='Only benchmark this server (repeatable)')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per server')
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument('--threads', type=int, default=4, help='waitress worker threads')
+        parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f'No user named {options["user"]!r}')
+        client = Client()
+        client.force_login(user)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        for name in options['servers'] or sorted(SERVERS):
+            port = free_port()
+            command = [part.format(port=port, **options) for part in SERVERS[name]]
+            # Request logging from the servers would only drown the report
+            output = None if options['verbosity'] > 1 else subprocess.DEVNULL
+            process = subprocess.Popen([sys.executable, '-m'] + command, env=env, stdout=output, stderr=output)
+            try:
+                self.wait_for(port, process)
+                timings, errors = self.run(port, cookie, options['requests'], options['concurrency'])
+            finally:
+                process.terminate()
+                process.wait()
+            self.report(name, timings, errors)
+
+    def wait_for(self, port, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'The server exited with status {process.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'The server did not start listening on port {port}')
+
+    def run(self, port, cookie, count, concurrency):
+        def request(n):
+            name, method, path, body = REQUESTS[n % len(REQUESTS)]
+            term = TERMS[n // len(REQUESTS) % len(TERMS)]
+            headers = {'Cookie': cookie}
+            if body is not None:
+                body = json.dumps({key: value.format(n=n) for key, value in body.items()})
+                headers['Content-Type'] = 'application/json'
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            started = time.perf_counter()
+            try:
+                connection.request(method, path.format(term=term), body, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status < 500
+            except OSError:
+                ok = False
+            finally:
+                connection.close()
+            return name, time.perf_counter() - started, ok
+
+        timings = {}
+        errors = 0
+        with ThreadPoolExecutor(concurrency) as pool:
+            for name, elapsed, ok in pool.map(request, range(count)):
+                if ok:
+                    timings.setdefault(name, []).append(elapsed * 1000)
+                else:
+                    errors += 1
+        return timings, errors
+
+    def report(self, server, timings, errors):
+        self.stdout.write(self.style.MIGRATE_HEADING(server))
+        everything = [elapsed for samples in timings.values() for elapsed in samples]
+        for name, samples in list(timings.items()) + [('all', everything)]:
+            if samples:
+                self.stdout.write(f'  {name:<20} n={len(samples):<6} p50={percentile(samples, 50):8.1f}ms '
+                                  f'p95={percentile(samples, 95):8.1f}ms p99={percentile(samples, 99):8.1f}ms')
+        if errors:
+            self.stdout.write(self.style.WARNING(f'  {errors} requests failed'))
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from expenses import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Seed a fresh test database, run the user scenarios in expenses.benchmark against every '
+            'route and report throughput, p50/p95/p99 latency and SQL queries per route. The run '
+            'fails if a route regressed against the baseline file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=sorted(benchmark.SCENARIOS), action='append', dest='scenarios',
+                            help='Only run this scenario (repeatable)')
+        parser.add_argument('--iterations', type=int, default=20, help='Times each scenario is run')
+        parser.add_argument('--warmup', type=int, default=1, help='Unmeasured iterations run first')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Scenario runners in parallel threads (use PostgreSQL for more than one)')
+        parser.add_argument('--users', type=int, default=20, help='Users to seed')
+        parser.add_argument('--rows', type=int, default=2000, help='Expenses per seeded user')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keepdb', action='store_true', help='Keep the seeded test database for the next run')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true', help='Write this run to the baseline file')
+        parser.add_argument('--percentile', choices=['p50', 'p95', 'p99'], default='p50',
+                            help='Latency compared against the baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed slowdown against the baseline, as a fraction')
+        parser.add_argument('--slack', type=float, default=2.0,
+                            help='Milliseconds of slowdown always allowed, for very fast routes')
+        parser.add_argument('--output', help='Also write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'] or sorted(benchmark.SCENARIOS)
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb'])
+        try:
+            # Deliverability checks would time DNS rather than the app, and a timed
+            # refresh of the availability index would make its query count flap
+            with override_settings(EMAIL_CHECK_DELIVERABILITY=False, AVAILABILITY_REFRESH_INTERVAL=3600):
+                recorder = self.run_scenarios(scenarios, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        results = recorder.results()
+        self.report(results, recorder)
+        missing = benchmark.uncovered(recorder)
+        if missing and not options['scenarios']:
+            self.stdout.write(self.style.WARNING(f'Routes no scenario visited: {", ".join(missing)}'))
+        run = {'database': connection.vendor, 'scenarios': scenarios, 'routes': results}
+        if options['output']:
+            self.write(options['output'], run)
+        if options['save_baseline']:
+            self.write(options['baseline'], run)
+            self.stdout.write(self.style.SUCCESS(f'Saved the baseline to {options["baseline"]}'))
+        else:
+            self.check_baseline(options, results)
+
+    def run_scenarios(self, scenarios, options):
+        users = benchmark.seeded_users()
+        if len(users) != options['users']:
+            if users:
+                raise CommandError(f'The kept database has {len(users)} seeded users; run without --keepdb')
+            self.stdout.write(f'Seeding {options["users"]} users with {options["rows"]} expenses each...')
+            users = benchmark.seed(options['users'], options['rows'], options['seed'])
+        benchmark.run(scenarios, users, options['warmup'], seed=options['seed'])
+
+        recorder = benchmark.Recorder()
+        concurrency = options['concurrency']
+        errors = []
+        lock = threading.Lock()
+
+        def runner(n):
+            try:
+                partial = benchmark.run(scenarios, users[n::concurrency], options['iterations'], seed=options['seed'] + n)
+                with lock:
+                    recorder.merge(partial)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if n:
+                    connection.close()
+
+        threads = [threading.Thread(target=runner, args=(n,)) for n in range(1, concurrency)]
+        for thread in threads:
+            thread.start()
+        runner(0)
+        for thread in threads:
+            thread.join()
+        recorder.stop()
+        if errors:
+            raise CommandError(errors[0])
+        return recorder
+
+    def report(self, results, recorder):
+        self.stdout.write(f'{"route":<36} {"n":>6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}')
+        for route, stats in results.items():
+            self.stdout.write(f'{route:<36} {stats["requests"]:>6} {stats["throughput"]:>8.1f} {stats["p50"]:>8.1f} '
+                              f'{stats["p95"]:>8.1f} {stats["p99"]:>8.1f} {stats["queries"]:>8}')
+        self.stdout.write(f'{recorder.requests} requests in {recorder.wall:.1f}s, '
+                          f'{recorder.requests / recorder.wall:.1f} req/s')
+
+    def check_baseline(self, options, results):
+        try:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            self.stdout.write(self.style.WARNING(f'No baseline at {options["baseline"]}; use --save-baseline'))
+            return
+        if baseline['database'] != connection.vendor:
+            raise CommandError(f'The baseline was recorded on {baseline["database"]}, not {connection.vendor}')
+        regressions = benchmark.compare(results, baseline['routes'], options['percentile'],
+                                        options['tolerance'], options['slack'])
+        if regressions:
+            raise CommandError('Regressed against the baseline:\n  ' + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def write(self, path, run):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as output:
+            json.dump(run, output, indent=2, sort_keys=True)
+            output.write('\n')
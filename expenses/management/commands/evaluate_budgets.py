@@ -0,0 +1,35 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import budgets, rollups
+
+
+def month(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise CommandError(f'{value!r} is not a month like 2024-03')
+
+
+class Command(BaseCommand):
+    help = ('Evaluate every budget of a month against the monthly expense totals and store where '
+            'each stands, for the budget status endpoint. Meant to run nightly; by default it '
+            'evaluates this month and last month, so late entries still count towards it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', type=month, action='append', dest='months',
+                            help='Evaluate this month, as YYYY-MM (repeatable)')
+        parser.add_argument('--date', type=datetime.date.fromisoformat,
+                            help='Evaluate as of this day (YYYY-MM-DD) instead of today')
+
+    def handle(self, *args, **options):
+        today = options['date'] or datetime.date.today()
+        this_month = rollups.month_start(today)
+        months = options['months'] or [rollups.month_start(this_month - datetime.timedelta(days=1)), this_month]
+        for first in months:
+            started = time.perf_counter()
+            count = budgets.evaluate(first, today)
+            self.stdout.write(self.style.SUCCESS(
+                f'Evaluated {count} budgets for {first:%Y-%m} in {time.perf_counter() - started:.1f}s'))
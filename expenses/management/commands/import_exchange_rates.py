@@ -0,0 +1,87 @@
+import csv
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from expenses import rates, reference
+from expenses.models import ExchangeRate
+
+
+class Command(BaseCommand):
+    help = ('Load daily exchange rates from a CSV file, either "date,currency,rate" rows or one '
+            'row per date with a column per currency. Rates are units of the currency per one '
+            'EXCHANGE_RATE_BASE; existing rates for the same currency and date are replaced.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to import')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as csv_file:
+                loaded = self.load(csv.reader(csv_file), options['batch_size'])
+        except OSError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f'Imported {loaded} exchange rates'))
+
+    def load(self, reader, batch_size):
+        header = [column.strip() for column in next(reader, [])]
+        if not header:
+            raise CommandError('The file is empty')
+        known = reference.currencies()
+        base = rates.base_currency()
+        long_format = [column.lower() for column in header] == ['date', 'currency', 'rate']
+        if not long_format:
+            unknown = [column for column in header[1:] if column.upper() not in known]
+            if unknown:
+                raise CommandError(f'Unknown currency columns: {", ".join(unknown)}')
+
+        loaded = 0
+        batch = {}
+        with transaction.atomic():
+            for line, row in enumerate(reader, start=2):
+                if not any(cell.strip() for cell in row):
+                    continue
+                if long_format:
+                    values = [(row[0], row[1], row[2])] if len(row) >= 3 else None
+                else:
+                    values = [(row[0], currency, value) for currency, value in zip(header[1:], row[1:])]
+                if values is None:
+                    raise CommandError(f'Line {line}: expected date,currency,rate')
+                for date, currency, value in values:
+                    currency = currency.strip().upper()
+                    # Wide files leave gaps (N/A, blank) for days a currency was not quoted
+                    if currency == base or (not long_format and value.strip().upper() in ('', 'N/A', 'NA')):
+                        continue
+                    rate = self.parse(line, date, currency, value, known)
+                    batch[currency, rate.date] = rate
+                if len(batch) >= batch_size:
+                    loaded += self.save(batch)
+            loaded += self.save(batch)
+            # bulk_create sends no signals
+            rates.invalidate()
+        return loaded
+
+    def parse(self, line, date, currency, value, known):
+        if currency not in known:
+            raise CommandError(f'Line {line}: unknown currency {currency!r}')
+        try:
+            date = datetime.date.fromisoformat(date.strip())
+        except ValueError:
+            raise CommandError(f'Line {line}: {date!r} is not a YYYY-MM-DD date')
+        try:
+            rate = Decimal(value.strip())
+        except InvalidOperation:
+            rate = None
+        if rate is None or not rate.is_finite() or rate <= 0:
+            raise CommandError(f'Line {line}: {value!r} is not a rate for {currency}')
+        return ExchangeRate(currency=currency, date=date, rate=rate)
+
+    def save(self, batch):
+        ExchangeRate.objects.bulk_create(batch.values(), update_conflicts=True,
+                                         unique_fields=['currency', 'date'], update_fields=['rate'])
+        saved = len(batch)
+        batch.clear()
+        return saved
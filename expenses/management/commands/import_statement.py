@@ -0,0 +1,66 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import imports, reference
+
+
+def choice(choices, name, label):
+    if name is None:
+        return None
+    for option in choices:
+        if option.name.casefold() == name.casefold():
+            return option.id
+    raise CommandError(f'No {label} named {name!r}')
+
+
+class Command(BaseCommand):
+    help = ('Import a bank statement (CSV or OFX) into a user\'s expenses and incomes: money out '
+            'becomes expenses, money in incomes. Rows the user has already, by date, amount and '
+            'description, are skipped. The file is read a chunk at a time in one transaction.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', required=True, help='Username to import for')
+        parser.add_argument('--format', choices=imports.FORMATS, help='Default: from the file extension')
+        parser.add_argument('--category', help='Category of expenses with none in the file')
+        parser.add_argument('--source', help='Source of incomes with none in the file')
+        parser.add_argument('--encoding', default='utf-8-sig')
+        parser.add_argument('--date-format', help='strptime format of CSV dates; default YYYY-MM-DD')
+        for field, default in imports.CSV_COLUMNS.items():
+            name = 'category or source' if field == 'label' else field
+            parser.add_argument(f'--{field}-column', default=default, help=f'CSV header of the {name}')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f'No user {options["user"]!r}')
+        category_id = choice(reference.categories(user.pk), options['category'], 'category')
+        source_id = choice(reference.sources(user.pk), options['source'], 'source')
+        columns = {field: options[f'{field}_column'] for field in imports.CSV_COLUMNS}
+        started = time.perf_counter()
+
+        def progress(summary):
+            if options['verbosity'] > 0:
+                self.stdout.write(f'{summary["rows"]:,} rows: {summary["expenses"]:,} expenses, '
+                                  f'{summary["incomes"]:,} incomes, {summary["duplicates"]:,} duplicates, '
+                                  f'{summary["rejected"]:,} rejected')
+
+        try:
+            with open(options['path'], encoding=options['encoding'], newline='') as stream:
+                rows = imports.read(stream, options['format'] or imports.guess_format(options['path']), columns,
+                                    options['date_format'])
+                summary = imports.run(user.pk, rows, category_id, source_id, progress)
+        except (OSError, LookupError, imports.InvalidStatement) as e:
+            raise CommandError(e)
+        for error in summary['errors']:
+            self.stderr.write(f'line {error["line"]}: {error["error"]}')
+        if summary['rejected'] > len(summary['errors']):
+            self.stderr.write(f'and {summary["rejected"] - len(summary["errors"]):,} more rejected rows')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {summary["expenses"]:,} expenses and {summary["incomes"]:,} incomes from '
+            f'{summary["rows"]:,} rows in {elapsed:.1f}s ({summary["rows"] / elapsed:,.0f} rows/s), '
+            f'skipped {summary["duplicates"]:,} duplicates'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from expenses import rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the monthly expense rollup table from raw expenses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only rebuild rollups for this user id (repeatable)')
+
+    def handle(self, *args, **options):
+        created = rollups.rebuild(owner_ids=options['users'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {created} rollup rows'))
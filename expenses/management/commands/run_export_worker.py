@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from expenses import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued export jobs off the request path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int,
+                            default=getattr(settings, 'EXPORT_WORKER_CONCURRENCY', 2),
+                            help='Number of exports rendered at the same time')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait between checks for new jobs')
+        parser.add_argument('--purge-interval', type=float, default=60.0,
+                            help='Seconds between sweeps for expired and stuck jobs')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        self.stdout.write(f'Export worker started with {concurrency} slot(s)')
+        running = set()
+        last_purge = None
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while True:
+                close_old_connections()
+                if last_purge is None or time.monotonic() - last_purge >= options['purge_interval']:
+                    jobs.purge()
+                    last_purge = time.monotonic()
+
+                running = {future for future in running if not future.done()}
+                claimed = jobs.claim(concurrency - len(running)) if len(running) < concurrency else []
+                for pk in claimed:
+                    running.add(pool.submit(jobs.run_in_thread, pk))
+                    self.stdout.write(f'Started export job {pk}')
+
+                if options['once'] and not running and not claimed:
+                    break
+                time.sleep(options['poll_interval'])
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import re
+import time
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from expenses import bulk, reference, seeding
+from expenses.models import Category, Expense
+from userincome.models import Source, UserIncome
+
+
+def _setup():
+    # Forked workers inherit the parent's setup; spawned ones start from scratch
+    django.setup()
+
+
+def _seed_block(args):
+    load_here, *generate_args = args
+    expenses, incomes = seeding.generate(*generate_args)
+    if not load_here:
+        return expenses, incomes
+    return bulk.load(Expense, expenses), bulk.load(UserIncome, incomes)
+
+
+class Command(BaseCommand):
+    help = ('Create users with large synthetic expense and income ledgers for scaling tests. The data '
+            'is generated with NumPy across worker processes and is the same for the same --seed; '
+            'PostgreSQL loads it with COPY, SQLite with executemany.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rows', type=int, default=1000, help='Average expenses per user')
+        parser.add_argument('--years', type=int, default=3, help='Years of history, up to today')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Generating processes')
+        parser.add_argument('--block-size', type=int, default=50,
+                            help='Users generated together; the data depends on this and --seed')
+        parser.add_argument('--prefix', default='seed', help='Usernames are this plus a number')
+        parser.add_argument('--password', default='seed-password', help='Password of every seeded user')
+
+    def handle(self, *args, **options):
+        users = options['users']
+        prefix = options['prefix']
+        start, end = seeding.default_range(options['years'])
+        usernames = [f'{prefix}{n}' for n in range(users)]
+        if User.objects.filter(username__regex=rf'^{re.escape(prefix)}[0-9]+$').exists():
+            raise CommandError(f'Users named {prefix}N exist already; pick another --prefix')
+
+        started = time.perf_counter()
+        keys = self.ensure_reference_rows()
+        currencies = seeding.ledger_currencies(options['seed'], users)
+        password = make_password(options['password'])
+        User.objects.bulk_create((User(username=username, email=f'{username}@example.com', password=password)
+                                  for username in usernames), batch_size=5000)
+        owner_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+        owner_ids = [owner_ids[username] for username in usernames]
+
+        block_size = options['block_size']
+        load_here = connection.vendor == 'postgresql'
+        blocks = [(load_here, options['seed'], block, owner_ids[first:first + block_size],
+                   currencies[first:first + block_size], keys, start, end, options['rows'])
+                  for block, first in enumerate(range(0, users, block_size))]
+        expenses = incomes = 0
+        loading = time.perf_counter()
+        # Workers open their own connections; don't hand them a copy of ours
+        connections.close_all()
+        with multiprocessing.Pool(max(1, options['workers']), initializer=_setup) as pool:
+            # PostgreSQL takes a COPY from every worker at once; SQLite has one writer, this process
+            for n, result in enumerate(pool.imap(_seed_block, blocks), start=1):
+                if load_here:
+                    block_expenses, block_incomes = result
+                else:
+                    block_expenses = bulk.load(Expense, result[0])
+                    block_incomes = bulk.load(UserIncome, result[1])
+                expenses += block_expenses
+                incomes += block_incomes
+                if options['verbosity'] > 1:
+                    elapsed = time.perf_counter() - loading
+                    self.stdout.write(f'{n}/{len(blocks)} blocks, {(expenses + incomes) / elapsed:,.0f} rows/s')
+        loaded = time.perf_counter() - loading
+
+        finishing = time.perf_counter()
+        seeding.finish(owner_ids, currencies)
+        finished = time.perf_counter()
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {users} users with {expenses:,} expenses and {incomes:,} incomes from '
+            f'{start:%Y-%m-%d} to {end:%Y-%m-%d}: {(expenses + incomes) / loaded:,.0f} rows/s '
+            f'({loaded:.1f}s generating and loading, {finished - finishing:.1f}s rebuilding rollups '
+            f'and counters, {finished - started:.1f}s in all)'))
+
+    def ensure_reference_rows(self):
+        # The shared categories and sources the ledgers use, as {name: id}
+        keys = []
+        for model, names, reference_name in ((Category, seeding.CATEGORIES, 'categories'),
+                                             (Source, ['Salary', *seeding.SOURCES], 'sources')):
+            missing = set(names) - set(model.objects.filter(owner=None).values_list('name', flat=True))
+            if missing:
+                model.objects.bulk_create(model(name=name) for name in sorted(missing))
+                reference.invalidate(reference_name)
+            keys.append(dict(model.objects.filter(owner=None, name__in=names).values_list('name', 'pk')))
+        return keys
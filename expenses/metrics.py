@@ -0,0 +1,129 @@
+"""
+Prometheus metrics, served at ``/metrics`` in the text exposition format.
+
+Request, SQL and in-flight metrics are recorded by
+``expenses.timing.RequestTimingMiddleware`` from the numbers it keeps
+anyway; exports, outbox deliveries and caches record their own. Hit ratios
+are left to the query, e.g.
+``sum by (cache) (rate(expensesweb_cache_requests_total{result="hit"}[5m]))
+/ sum by (cache) (rate(expensesweb_cache_requests_total[5m]))``.
+
+Values are shared by the threads of a process. Processes (uvicorn workers,
+``run_export_worker``, ``deliver_outbox``) share them through
+``PROMETHEUS_MULTIPROC_DIR``: set it to the same directory for all of them,
+as the Procfile does. Each process then keeps its values in memory-mapped
+files there, and ``/metrics`` adds them up. A process that starts while
+none of the others is running empties the directory first, so a restarted
+site counts from zero whichever process comes up first, while a worker
+restarted on its own leaves the totals alone.
+
+Labelled series are looked up once and kept in a dict, so recording takes
+only the short per-value lock of the client library.
+"""
+import atexit
+import os
+import re
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _join(directory):
+    """Register this process in ``directory``, emptying it first if no process using it is running."""
+    # Unix only, like the Procfile; plain runs never get here
+    import fcntl
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        names = [name for name in os.listdir(directory) if name != 'lock']
+        # Value files are <kind>_<pid>.db; a process with none yet has its .pid marker
+        pids = {int(match[1]) for match in map(re.compile(r'.*_(\d+)\.(?:db|pid)').fullmatch, names) if match}
+        if not any(_running(pid) for pid in pids):
+            for name in names:
+                os.remove(os.path.join(directory, name))
+        open(os.path.join(directory, f'process_{os.getpid()}.pid'), 'w').close()
+
+
+if MULTIPROCESS:
+    # Before the first metric below creates its files
+    _join(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+REQUESTS = Counter('expensesweb_requests', 'Requests by URL name, method and status', ['route', 'method', 'status'])
+REQUEST_DURATION = Histogram(
+    'expensesweb_request_duration_seconds', 'Request latency by URL name', ['route', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+IN_FLIGHT = Gauge('expensesweb_requests_in_flight', 'Requests being handled', multiprocess_mode='livesum')
+DB_QUERIES = Histogram(
+    'expensesweb_db_queries_per_request', 'SQL queries per request by URL name', ['route'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 250))
+DB_DURATION = Histogram(
+    'expensesweb_db_duration_seconds', 'SQL time per request by URL name', ['route'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+EXPORT_SIZE = Histogram(
+    'expensesweb_export_size_bytes', 'Size of rendered exports by format', ['format'],
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9))
+EXPORT_DURATION = Histogram(
+    'expensesweb_export_duration_seconds', 'Time to render an export by format', ['format'],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+EMAILS = Counter('expensesweb_outbox_emails', 'Outbox delivery attempts by outcome (sent, retry, failed)',
+                 ['outcome'])
+CACHE_REQUESTS = Counter('expensesweb_cache_requests', 'Cache lookups by cache and result (hit, miss)',
+                         ['cache', 'result'])
+
+_children = {}
+
+
+def _child(metric, *labels):
+    # labels() takes the metric's lock every time; a dict read doesn't
+    child = _children.get((metric, labels))
+    if child is None:
+        child = _children[(metric, labels)] = metric.labels(*labels)
+    return child
+
+
+def request_finished(route, method, status, seconds, queries, db_seconds):
+    _child(REQUESTS, route, method, str(status)).inc()
+    _child(REQUEST_DURATION, route, method).observe(seconds)
+    _child(DB_QUERIES, route).observe(queries)
+    _child(DB_DURATION, route).observe(db_seconds)
+
+
+def export_finished(format, seconds, size):
+    _child(EXPORT_DURATION, format).observe(seconds)
+    _child(EXPORT_SIZE, format).observe(size)
+
+
+def email_outcome(outcome):
+    _child(EMAILS, outcome).inc()
+
+
+def cache_lookup(cache, hit):
+    _child(CACHE_REQUESTS, cache, 'hit' if hit else 'miss').inc()
+
+
+def exposition():
+    """Return the metrics of every process as ``(body, content_type)``."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+if MULTIPROCESS:
+    # Drops this process's in-flight gauge file, or a dead worker's requests would count forever
+    atexit.register(multiprocess.mark_process_dead, os.getpid())
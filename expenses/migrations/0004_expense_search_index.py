@@ -0,0 +1,17 @@
+from django.db import migrations
+
+from expenses.search import SearchIndex
+
+# Description and the category name column, as it was here
+EXPENSE_SEARCH = SearchIndex('expenses_expense', ('description', 'category'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0003_expenserollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(EXPENSE_SEARCH.install, EXPENSE_SEARCH.uninstall),
+    ]
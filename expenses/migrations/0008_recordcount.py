@@ -0,0 +1,38 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_records(apps, schema_editor):
+    RecordCount = apps.get_model('expenses', 'RecordCount')
+    counts = {}
+    for field, model in (('expenses', apps.get_model('expenses', 'Expense')),
+                         ('incomes', apps.get_model('userincome', 'UserIncome'))):
+        for owner_id, count in model.objects.order_by().values_list('owner_id').annotate(count=Count('id')):
+            counts.setdefault(owner_id, {})[field] = count
+    RecordCount.objects.bulk_create(
+        [RecordCount(owner_id=owner_id, **values) for owner_id, values in counts.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('expenses', '0007_exportjob'),
+        ('userincome', '0003_owner_date_amount_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordCount',
+            fields=[
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('expenses', models.BigIntegerField(default=0)),
+                ('incomes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_records, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from expenses.search import SearchIndex
+
+EXPENSE_SEARCH = SearchIndex('expenses_expense', ('description', 'category'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0008_recordcount'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', '-date', '-id'], name='expense_owner_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'category', '-date', '-id'], name='expense_owner_cat_date_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='expense',
+            name='expense_owner_date_idx',
+        ),
+        # SQLite remakes the table for the AlterField, which drops the search
+        # triggers, so reinstall them after it in either direction.
+        migrations.RunPython(migrations.RunPython.noop, EXPENSE_SEARCH.install),
+        migrations.AlterField(
+            model_name='expense',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(EXPENSE_SEARCH.install, migrations.RunPython.noop),
+    ]
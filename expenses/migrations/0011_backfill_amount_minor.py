@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from expenses.money import backfill_minor_units
+
+
+def backfill(apps, schema_editor):
+    backfill_minor_units(apps.get_model('expenses', 'Expense'), apps.get_model('userpreferences', 'UserPreference'))
+
+
+class Migration(migrations.Migration):
+    # Commit batch by batch so a large table is converted without one huge
+    # transaction, and a failed run resumes with the rows still missing.
+    atomic = False
+
+    dependencies = [
+        ('expenses', '0010_amount_minor'),
+        ('userpreferences', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
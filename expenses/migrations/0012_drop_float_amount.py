@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from expenses.money import restore_float_amounts
+from expenses.search import SearchIndex
+
+EXPENSE_SEARCH = SearchIndex('expenses_expense', ('description', 'category'))
+
+
+def restore_amounts(apps, schema_editor):
+    restore_float_amounts(apps.get_model('expenses', 'Expense'))
+
+
+def rebuild_rollups(apps, schema_editor):
+    Expense = apps.get_model('expenses', 'Expense')
+    ExpenseRollup = apps.get_model('expenses', 'ExpenseRollup')
+    ExpenseRollup.objects.all().delete()
+    grouped = (Expense.objects.order_by()
+               .annotate(month=TruncMonth('date'))
+               .values_list('owner_id', 'month', 'category', 'currency')
+               .annotate(total=Sum('amount_minor'), count=Count('id')))
+    ExpenseRollup.objects.bulk_create(
+        (ExpenseRollup(owner_id=owner_id, month=month, category=category, currency=currency,
+                       total_minor=total, count=count)
+         for owner_id, month, category, currency, total, count in grouped.iterator()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0011_backfill_amount_minor'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # SQLite remakes the table below, dropping the search triggers;
+        # these two RunPythons reinstall them going forwards and backwards.
+        migrations.RunPython(migrations.RunPython.noop, EXPENSE_SEARCH.install),
+        migrations.AlterField(
+            model_name='expense',
+            name='amount',
+            field=models.FloatField(null=True),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore_amounts),
+        migrations.RemoveIndex(
+            model_name='expense',
+            name='expense_owner_amount_idx',
+        ),
+        migrations.RemoveField(
+            model_name='expense',
+            name='amount',
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='amount_minor',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='currency',
+            field=models.CharField(max_length=3),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'amount_minor'], name='expense_owner_amount_minor_idx'),
+        ),
+        migrations.RunPython(EXPENSE_SEARCH.install, migrations.RunPython.noop),
+        # Rollups are kept per currency, in minor units, and recomputed here
+        migrations.RemoveConstraint(
+            model_name='expenserollup',
+            name='expense_rollup_owner_month_category',
+        ),
+        migrations.RemoveField(
+            model_name='expenserollup',
+            name='total',
+        ),
+        migrations.AddField(
+            model_name='expenserollup',
+            name='currency',
+            field=models.CharField(default='', max_length=3),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='expenserollup',
+            name='total_minor',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='expenserollup',
+            constraint=models.UniqueConstraint(fields=('owner', 'month', 'category', 'currency'),
+                                               name='expense_rollup_owner_month_category'),
+        ),
+        migrations.RunPython(rebuild_rollups, migrations.RunPython.noop),
+    ]
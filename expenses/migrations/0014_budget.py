@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0013_exchangerate'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Budget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=266)),
+                ('month', models.DateField()),
+                ('amount_minor', models.BigIntegerField()),
+                ('currency', models.CharField(max_length=3)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='expenserollup',
+            index=models.Index(fields=['month'], name='expense_rollup_month_idx'),
+        ),
+        migrations.CreateModel(
+            name='BudgetStatus',
+            fields=[
+                ('budget', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='status', serialize=False, to='expenses.budget')),
+                ('spent_minor', models.BigIntegerField()),
+                ('projected_minor', models.BigIntegerField()),
+                ('state', models.CharField(choices=[('ok', 'On track'), ('at_risk', 'On track to go over'), ('over', 'Over budget')], max_length=10)),
+                ('as_of', models.DateField()),
+                ('evaluated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='budget',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='budget',
+            index=models.Index(fields=['month', 'owner', 'category'], name='budget_month_owner_cat_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='budget',
+            constraint=models.UniqueConstraint(fields=('owner', 'month', 'category'), name='budget_owner_month_category'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def drop_duplicate_names(apps, schema_editor):
+    # Nothing points at categories by key yet; keep the first of each shared name
+    Category = apps.get_model('expenses', 'Category')
+    first = Category.objects.values('name').annotate(first=Min('pk')).values_list('first', flat=True)
+    Category.objects.exclude(pk__in=list(first)).delete()
+
+
+def rename_in_state(model_name, indexes=(), constraints=()):
+    # The text column keeps its name, so only the migration state changes
+    operations = [
+        migrations.AlterField(
+            model_name=model_name,
+            name='category',
+            field=models.CharField(db_column='category', max_length=266),
+        ),
+    ]
+    operations += [migrations.RemoveIndex(model_name=model_name, name=index.name) for index in indexes]
+    operations += [migrations.RemoveConstraint(model_name=model_name, name=constraint.name) for constraint in constraints]
+    operations.append(migrations.RenameField(model_name=model_name, old_name='category', new_name='category_name'))
+    operations += [migrations.AddIndex(model_name=model_name, index=index) for index in indexes]
+    operations += [migrations.AddConstraint(model_name=model_name, constraint=constraint) for constraint in constraints]
+    return migrations.SeparateDatabaseAndState(state_operations=operations)
+
+
+def category_key():
+    return models.ForeignKey(null=True, db_index=False, on_delete=django.db.models.deletion.PROTECT,
+                             related_name='+', to='expenses.category')
+
+
+class Migration(migrations.Migration):
+    # Step one of three: the key columns, empty. 0016 fills them in batches
+    # and 0017 drops the names.
+
+    dependencies = [
+        ('expenses', '0014_budget'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='category',
+            name='id',
+            field=models.AutoField(primary_key=True, serialize=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.UniqueConstraint(fields=('owner', 'name'), name='category_owner_name'),
+        ),
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.UniqueConstraint(condition=models.Q(('owner', None)), fields=('name',),
+                                               name='category_shared_name'),
+        ),
+        rename_in_state('expense', indexes=[
+            models.Index(fields=['owner', 'category_name', '-date', '-id'], name='expense_owner_cat_date_idx'),
+        ]),
+        rename_in_state('expenserollup', constraints=[
+            models.UniqueConstraint(fields=('owner', 'month', 'category_name', 'currency'),
+                                    name='expense_rollup_owner_month_category'),
+        ]),
+        rename_in_state('budget', indexes=[
+            models.Index(fields=['month', 'owner', 'category_name'], name='budget_month_owner_cat_idx'),
+        ], constraints=[
+            models.UniqueConstraint(fields=('owner', 'month', 'category_name'), name='budget_owner_month_category'),
+        ]),
+        migrations.AddField(model_name='expense', name='category', field=category_key()),
+        migrations.AddField(model_name='expenserollup', name='category', field=category_key()),
+        migrations.AddField(model_name='budget', name='category', field=category_key()),
+    ]
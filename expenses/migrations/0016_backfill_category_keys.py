@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+from expenses.operations import AddIndexConcurrently
+from expenses.reference import backfill_keys
+
+
+def backfill(apps, schema_editor):
+    Category = apps.get_model('expenses', 'Category')
+    for model_name in ('Expense', 'ExpenseRollup', 'Budget'):
+        backfill_keys(apps.get_model('expenses', model_name), Category, 'category')
+
+
+class Migration(migrations.Migration):
+    # Batches commit separately, see expenses.reference.backfill_keys, and the
+    # index is built without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('expenses', '0015_category_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'category', '-date', '-id'], name='expense_owner_cat_id_date_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+from expenses.reference import backfill_keys, restore_names
+from expenses.search import SearchIndex
+
+MODEL_NAMES = ('Expense', 'ExpenseRollup', 'Budget')
+
+# The search index before and after this migration, frozen here
+NAMED_SEARCH = SearchIndex('expenses_expense', ('description', 'category'))
+EXPENSE_SEARCH = SearchIndex('expenses_expense', ('description',))
+
+
+def backfill(apps, schema_editor):
+    # Rows written by the old code since 0016 ran
+    Category = apps.get_model('expenses', 'Category')
+    for model_name in MODEL_NAMES:
+        backfill_keys(apps.get_model('expenses', model_name), Category, 'category')
+
+
+def restore(model_name):
+    def restore(apps, schema_editor):
+        restore_names(apps.get_model('expenses', model_name), apps.get_model('expenses', 'Category'), 'category')
+    return restore
+
+
+def drop_names(model_name):
+    # Nullable first, so that unapplying can add the column back and refill it
+    return [
+        migrations.AlterField(
+            model_name=model_name,
+            name='category_name',
+            field=models.CharField(db_column='category', max_length=266, null=True),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore(model_name)),
+        migrations.RemoveField(model_name=model_name, name='category_name'),
+        migrations.AlterField(
+            model_name=model_name,
+            name='category',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                                    to='expenses.category'),
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0016_backfill_category_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        # The search column is built from the category name too; it goes
+        # first and comes back over descriptions only
+        migrations.RunPython(NAMED_SEARCH.uninstall, NAMED_SEARCH.install),
+        migrations.RemoveIndex(model_name='expense', name='expense_owner_cat_date_idx'),
+        migrations.RemoveConstraint(model_name='expenserollup', name='expense_rollup_owner_month_category'),
+        migrations.RemoveConstraint(model_name='budget', name='budget_owner_month_category'),
+        migrations.RemoveIndex(model_name='budget', name='budget_month_owner_cat_idx'),
+        *drop_names('expense'),
+        *drop_names('expenserollup'),
+        *drop_names('budget'),
+        migrations.AddConstraint(
+            model_name='expenserollup',
+            constraint=models.UniqueConstraint(fields=('owner', 'month', 'category', 'currency'),
+                                               name='expense_rollup_owner_month_category'),
+        ),
+        migrations.AddConstraint(
+            model_name='budget',
+            constraint=models.UniqueConstraint(fields=('owner', 'month', 'category'), name='budget_owner_month_category'),
+        ),
+        migrations.AddIndex(
+            model_name='budget',
+            index=models.Index(fields=['month', 'owner', 'category'], name='budget_month_owner_cat_idx'),
+        ),
+        migrations.RunPython(EXPENSE_SEARCH.install, EXPENSE_SEARCH.uninstall),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+from expenses.imports import backfill_hashes
+from expenses.operations import AddIndexConcurrently
+
+
+def backfill(apps, schema_editor):
+    backfill_hashes(apps.get_model('expenses', 'Expense'))
+
+
+class Migration(migrations.Migration):
+    # Batches commit separately and the index is built without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('expenses', '0018_batchrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='content_hash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'content_hash'], name='expense_owner_hash_idx'),
+        ),
+    ]
@@ -2,23 +2,230 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 
+from . import money
+
 # Create your models here.
 class Expense(models.Model):
-    amount = models.FloatField()
+    # Minor units of `currency`, see expenses.money
+    amount_minor = models.BigIntegerField()
+    currency = models.CharField(max_length=3)
     date=models.DateField(default=now)
     description=models.TextField()
-    owner=models.ForeignKey(User, on_delete=models.CASCADE)
-    category=models.CharField(max_length=266)
+    # Indexed through the composite (owner, ...) indexes in Meta
+    owner=models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    category=models.ForeignKey('Category', on_delete=models.PROTECT, db_index=False, related_name='+')
+    # Date, amount and description hashed, for spotting re-imported rows, see expenses.imports
+    content_hash=models.BigIntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
-        return self.category
+        return self.category.name
+
+    @property
+    def amount(self):
+        return money.from_minor(self.amount_minor, self.currency)
+
     class Meta:
         ordering= ['-date']
+        indexes = [
+            # Lists, keyset pages and exports: owner, newest first
+            models.Index(fields=['owner', '-date', '-id'], name='expense_owner_date_id_idx'),
+            # category: filters and the per-category summary
+            models.Index(fields=['owner', 'category', '-date', '-id'], name='expense_owner_cat_id_date_idx'),
+            models.Index(fields=['owner', 'amount_minor'], name='expense_owner_amount_minor_idx'),
+            models.Index(fields=['owner', 'content_hash'], name='expense_owner_hash_idx'),
+        ]
 
 class Category(models.Model):
+        # 4-byte keys: every expense row carries one
+        id=models.AutoField(primary_key=True)
         name=models.CharField(max_length=255)
+        # Shared by everyone when empty, else one user's own, see expenses.reference.categories
+        owner=models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
         class Meta:
              verbose_name_plural = 'Categories'
+             constraints = [
+                 models.UniqueConstraint(fields=['owner', 'name'], name='category_owner_name'),
+                 models.UniqueConstraint(fields=['name'], condition=models.Q(owner=None), name='category_shared_name'),
+             ]
 
         def __str__(self):
-             return self.name
\ No newline at end of file
+             return self.name
+
+class ExchangeRate(models.Model):
+    # Units of `currency` per one EXCHANGE_RATE_BASE on `date`, loaded with
+    # `manage.py import_exchange_rates`, see expenses.rates
+    currency=models.CharField(max_length=3)
+    date=models.DateField()
+    rate=models.DecimalField(max_digits=24, decimal_places=10)
+
+    def __str__(self):
+        return f'{self.currency} {self.date} {self.rate}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['currency', 'date'], name='exchangerate_currency_date'),
+        ]
+
+class ExpenseRollup(models.Model):
+    # Monthly totals per user and category, kept in sync by expenses.signals
+    # and rebuildable with `manage.py rebuild_expense_rollups`.
+    owner=models.ForeignKey(User, on_delete=models.CASCADE)
+    month=models.DateField()
+    category=models.ForeignKey(Category, on_delete=models.PROTECT, db_index=False, related_name='+')
+    currency=models.CharField(max_length=3)
+    total_minor=models.BigIntegerField(default=0)
+    count=models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.owner_id} {self.month:%Y-%m} {self.category_id} {self.currency}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'month', 'category', 'currency'],
+                                    name='expense_rollup_owner_month_category'),
+        ]
+        indexes = [
+            # One month across all users, for the nightly budget evaluation
+            models.Index(fields=['month'], name='expense_rollup_month_idx'),
+        ]
+
+
+class DataVersion(models.Model):
+    # Per-user counter bumped on every change to the user's expenses, see
+    # expenses.versioning. Also bumped for incomes and preferences; caches
+    # of rendered data and response ETags key on it.
+    owner=models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    version=models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.owner_id} v{self.version}'
+
+
+class ReferenceVersion(models.Model):
+    # Version of shared reference data (categories, sources, exchange rates)
+    # bumped in the transaction that changes it. Cache keys carry it, so a
+    # change reaches every process whatever the cache backend, see
+    # expenses.reference
+    name=models.CharField(max_length=50, primary_key=True)
+    version=models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name} v{self.version}'
+
+
+class RecordCount(models.Model):
+    # Per-user row counts kept up to date by expenses.signals, so list pages
+    # can show a total without a COUNT(*), see expenses.counters
+    owner=models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    expenses=models.BigIntegerField(default=0)
+    incomes=models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.owner_id}: {self.expenses} expenses, {self.incomes} incomes'
+
+
+class ExportJob(models.Model):
+    # An export rendered off the request path by `manage.py run_export_worker`,
+    # see expenses.jobs
+    PENDING='pending'
+    RUNNING='running'
+    DONE='done'
+    FAILED='failed'
+    EXPIRED='expired'
+    STATUS_CHOICES=[(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'), (EXPIRED, 'Expired')]
+    FORMAT_CHOICES=[('csv', 'CSV'), ('xlsx', 'Excel'), ('pdf', 'PDF')]
+
+    owner=models.ForeignKey(User, on_delete=models.CASCADE)
+    format=models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    params=models.JSONField(default=dict)
+    params_hash=models.CharField(max_length=64)
+    version=models.BigIntegerField()
+    status=models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    progress=models.PositiveSmallIntegerField(default=0)
+    file_path=models.CharField(max_length=500, blank=True)
+    error=models.TextField(blank=True)
+    created_at=models.DateTimeField(auto_now_add=True)
+    started_at=models.DateTimeField(null=True, blank=True)
+    finished_at=models.DateTimeField(null=True, blank=True)
+    expires_at=models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.format} export #{self.pk} ({self.status})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='exportjob_status_created_idx'),
+        ]
+        constraints = [
+            # One live job per user, format, data version and filters
+            models.UniqueConstraint(
+                fields=['owner', 'format', 'version', 'params_hash'],
+                condition=models.Q(status__in=['pending', 'running', 'done']),
+                name='exportjob_live_unique'),
+        ]
+
+
+class Budget(models.Model):
+    # Spending limit for one category in one month, in minor units of
+    # `currency`; evaluated nightly into BudgetStatus, see expenses.budgets
+    owner=models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    category=models.ForeignKey(Category, on_delete=models.PROTECT, db_index=False, related_name='+')
+    month=models.DateField()
+    amount_minor=models.BigIntegerField()
+    currency=models.CharField(max_length=3)
+
+    def __str__(self):
+        return f'{self.owner_id} {self.month:%Y-%m} {self.category_id}'
+
+    @property
+    def amount(self):
+        return money.from_minor(self.amount_minor, self.currency)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'month', 'category'], name='budget_owner_month_category'),
+        ]
+        indexes = [
+            models.Index(fields=['month', 'owner', 'category'], name='budget_month_owner_cat_idx'),
+        ]
+
+
+class BudgetStatus(models.Model):
+    # Where a budget stood at its last evaluation, rewritten in bulk by
+    # `manage.py evaluate_budgets`
+    OK='ok'
+    AT_RISK='at_risk'
+    OVER='over'
+    STATE_CHOICES=[(OK, 'On track'), (AT_RISK, 'On track to go over'), (OVER, 'Over budget')]
+
+    budget=models.OneToOneField(Budget, on_delete=models.CASCADE, primary_key=True, related_name='status')
+    spent_minor=models.BigIntegerField()
+    projected_minor=models.BigIntegerField()
+    state=models.CharField(max_length=10, choices=STATE_CHOICES)
+    as_of=models.DateField()
+    evaluated_at=models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.budget} {self.state}'
+
+
+class BatchRequest(models.Model):
+    # A batch applied under an Idempotency-Key and its response, replayed to
+    # retries of the same batch, see expenses.batch
+    owner=models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    target=models.CharField(max_length=10)
+    key=models.CharField(max_length=255)
+    body_hash=models.CharField(max_length=64)
+    response=models.JSONField(null=True)
+    created_at=models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.owner_id} {self.target} {self.key}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'target', 'key'], name='batchrequest_owner_target_key'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'created_at'], name='batchrequest_owner_created_idx'),
+        ]
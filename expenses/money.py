@@ -0,0 +1,101 @@
+"""
+Money amounts as integers of minor units (cents, pence, yen, fils...).
+
+Amounts are stored in ``amount_minor`` with an ISO 4217 ``currency`` code
+next to them, so sums and comparisons happen in the database with exact
+integer math. ``to_minor`` is used wherever an amount comes in (forms,
+search terms, imports) and ``from_minor`` wherever one is shown.
+"""
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+
+# ISO 4217 currencies whose minor unit is not 1/100
+MINOR_UNITS = {
+    'BHD': 3, 'BIF': 0, 'CLF': 4, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'IQD': 3, 'ISK': 0,
+    'JOD': 3, 'JPY': 0, 'KMF': 0, 'KRW': 0, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'PYG': 0,
+    'RWF': 0, 'TND': 3, 'UGX': 0, 'UYI': 0, 'UYW': 4, 'VND': 0, 'VUV': 0, 'XAF': 0,
+    'XOF': 0, 'XPF': 0,
+}
+# Keeps amount_minor well inside a signed 64-bit integer for any exponent
+MAX_AMOUNT = Decimal(10) ** 14
+
+
+def exponent(currency):
+    return MINOR_UNITS.get((currency or '').upper(), 2)
+
+
+def to_minor(value, currency):
+    """Convert a user-entered amount to minor units, raising ValueError if it is not one."""
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'{value!r} is not an amount')
+    if not amount.is_finite() or abs(amount) >= MAX_AMOUNT:
+        raise ValueError(f'{value!r} is not an amount')
+    return int(amount.scaleb(exponent(currency)).to_integral_value(ROUND_HALF_UP))
+
+
+def from_minor(minor, currency):
+    """Return ``minor`` units of ``currency`` as a Decimal with the currency's precision."""
+    return Decimal(minor or 0).scaleb(-exponent(currency))
+
+
+def format_money(minor, currency=None):
+    text = f'{from_minor(minor, currency):,f}'
+    return f'{text} {currency}' if currency else text
+
+
+def currency_code(preference):
+    """Extract the code from a stored preference like ``'USD - United States Dollar'``."""
+    code = (preference or '').split(' - ', 1)[0].strip().upper()
+    return code if len(code) == 3 and code.isalpha() else settings.DEFAULT_CURRENCY
+
+
+def with_amounts(rows):
+    """Replace ``amount_minor`` in ``values()`` rows with a decimal ``amount`` string, for JSON."""
+    for row in rows:
+        row['amount'] = str(from_minor(row.pop('amount_minor'), row.get('currency')))
+    return rows
+
+
+def backfill_minor_units(model, preference_model, batch_size=2000):
+    """
+    Fill ``amount_minor`` and ``currency`` from the old float ``amount``
+    column, for the money migrations. Each batch commits on its own and
+    converted rows are skipped, so an interrupted run picks up where it
+    stopped. Rows get the owner's preferred currency.
+    """
+    currencies = {user_id: currency_code(preference)
+                  for user_id, preference in preference_model.objects.values_list('user_id', 'currency')}
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            rows = list(model.objects.filter(amount_minor__isnull=True, pk__gt=last_pk)
+                        .order_by('pk').only('pk', 'owner_id', 'amount')[:batch_size])
+            if not rows:
+                return
+            for row in rows:
+                row.currency = currencies.get(row.owner_id, settings.DEFAULT_CURRENCY)
+                try:
+                    # repr() is the shortest string that round-trips, so 0.1 becomes 10 cents
+                    row.amount_minor = to_minor(repr(row.amount), row.currency)
+                except ValueError as e:
+                    raise ValueError(f'{model.__name__} {row.pk}: {e}')
+            model.objects.bulk_update(rows, ['amount_minor', 'currency'])
+            last_pk = rows[-1].pk
+
+
+def restore_float_amounts(model, batch_size=2000):
+    # Reverse of backfill_minor_units, for unapplying the money migrations
+    last_pk = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                    .only('pk', 'amount_minor', 'currency')[:batch_size])
+        if not rows:
+            return
+        for row in rows:
+            row.amount = float(from_minor(row.amount_minor, row.currency))
+        model.objects.bulk_update(rows, ['amount'])
+        last_pk = rows[-1].pk
@@ -0,0 +1,116 @@
+"""
+Keyset pagination for the expense and income lists.
+
+Pages are read with ``WHERE (date, id) < (last date, last id)`` instead of
+an OFFSET, so every page costs one index range scan however deep it is. The
+cursor in the page links carries that position plus the page number, and
+the page count comes from ``expenses.counters`` rather than a COUNT(*).
+"""
+import datetime
+import math
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = 'expenses.pagination.cursor'
+MAX_PAGE_SIZE = 100
+
+
+class KeysetPage:
+    def __init__(self, object_list, number, count, per_page, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.count = count
+        self.per_page = per_page
+        self.num_pages = max(1, math.ceil(count / per_page))
+        self.has_previous = has_previous
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _query(self, direction, row=None, number=None):
+        params = {}
+        if direction:
+            position = [direction, number]
+            if row is not None:
+                position += [row.date.isoformat(), row.pk]
+            params['cursor'] = signing.dumps(position, salt=CURSOR_SALT)
+        if self.per_page != page_size():
+            params['per_page'] = self.per_page
+        return '?' + urlencode(params)
+
+    @property
+    def first_query(self):
+        return self._query(None)
+
+    @property
+    def previous_query(self):
+        if self.number <= 2:
+            return self.first_query
+        return self._query('prev', self.object_list[0], self.number - 1)
+
+    @property
+    def next_query(self):
+        return self._query('next', self.object_list[-1], self.number + 1)
+
+    @property
+    def last_query(self):
+        return self._query('last', number=self.num_pages)
+
+
+def page_size(value=None):
+    default = getattr(settings, 'LIST_PAGE_SIZE', 3)
+    try:
+        size = int(value) if value else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def _load_cursor(cursor):
+    try:
+        direction, number, *key = signing.loads(cursor, salt=CURSOR_SALT)
+        if key:
+            key = (datetime.date.fromisoformat(key[0]), int(key[1]))
+        return direction, int(number), key or None
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+def paginate(queryset, count, cursor=None, per_page=None):
+    """
+    Return the ``KeysetPage`` of ``queryset`` (newest first) that ``cursor``
+    points at, or the first page. ``count`` is the total number of rows.
+    """
+    per_page = page_size(per_page)
+    num_pages = max(1, math.ceil(count / per_page))
+    position = _load_cursor(cursor) if cursor else None
+    direction, number, key = position or (None, 1, None)
+
+    if direction == 'last':
+        # The last page holds whatever is left over after the full pages
+        size = count - (num_pages - 1) * per_page if count else per_page
+        rows = list(queryset.order_by('date', 'id')[:size])[::-1]
+        return KeysetPage(rows, num_pages, count, per_page, num_pages > 1, False)
+
+    if direction == 'prev' and key:
+        date, pk = key
+        rows = list(queryset.filter(Q(date__gt=date) | Q(date=date, id__gt=pk))
+                    .order_by('date', 'id')[:per_page + 1])
+        has_previous = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        return KeysetPage(rows, number if has_previous else 1, count, per_page, has_previous, True)
+
+    if direction == 'next' and key:
+        date, pk = key
+        queryset = queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+    else:
+        number = 1
+    rows = list(queryset.order_by('-date', '-id')[:per_page + 1])
+    return KeysetPage(rows[:per_page], number, count, per_page, number > 1, len(rows) > per_page)
@@ -0,0 +1,224 @@
+"""
+Query language for the expense and income search boxes.
+
+    amount:50..200 date:2024-01..2024-03 category:food coffee
+
+``field:value`` terms are compiled into equality and range filters on the
+indexed columns; everything else is free text for ``expenses.search``.
+Supported terms::
+
+    amount:12.50   amount:>100   amount >= 100   amount:50..200   amount:..20
+    date:2024   date:2024-03   date:2024-03-15   date:2024-01..2024-03   date:>2024-06
+    March 2024   mar 2024
+    category:food   category:"eating out"   source:salary
+
+Parsing is pure and cached, so the search views and the exports share the
+same parsed query for the same search text.
+"""
+import calendar
+import datetime
+import re
+from dataclasses import dataclass
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal, InvalidOperation
+from functools import lru_cache
+
+from django.db.models import Q
+
+from . import money
+
+COMPARISONS = {'>': 'gt', '>=': 'gte', '<': 'lt', '<=': 'lte', '=': 'exact'}
+MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+MONTHS['sept'] = 9
+
+TERM_RE = re.compile(r'''
+    \b(?P<month>%(months)s)\s+(?P<year>\d{4})\b
+  | \b(?P<field>amount|date|category|source)
+        \s*(?::\s*(?P<op>>=|<=|>|<|=)?|(?P<bare_op>>=|<=|>|<|=))
+        \s*(?P<value>"[^"]*"?|[^\s"]*)
+  | (?P<word>"[^"]*"?|\S+)
+''' % {'months': '|'.join(sorted(MONTHS, key=len, reverse=True))}, re.IGNORECASE | re.VERBOSE)
+
+
+class QueryError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Condition:
+    field: str
+    lookup: str
+    value: object
+
+
+@dataclass(frozen=True)
+class ParsedQuery:
+    conditions: tuple = ()
+    text: str = ''
+    errors: tuple = ()
+
+    @property
+    def has_filters(self):
+        return bool(self.conditions)
+
+
+@lru_cache(maxsize=1024)
+def parse(text):
+    """Parse search box ``text`` into a ``ParsedQuery``. Bad terms are reported, not raised."""
+    conditions = []
+    words = []
+    errors = []
+    for match in TERM_RE.finditer(text or ''):
+        if match.group('month'):
+            try:
+                start = datetime.date(int(match.group('year')), MONTHS[match.group('month').lower()], 1)
+                conditions += _period_conditions('date', '', (start, _add_months(start, 1)))
+            except ValueError:
+                errors.append(f'"{match.group(0)}" is not a valid month')
+        elif match.group('field'):
+            field = match.group('field').lower()
+            op = match.group('op') or match.group('bare_op') or ''
+            value = match.group('value').strip('"')
+            if not value:
+                # Still being typed, e.g. "amount:".
+                continue
+            try:
+                conditions += _field_conditions(field, op, value)
+            except QueryError as e:
+                errors.append(str(e))
+        else:
+            words.append(match.group('word').strip('"'))
+    return ParsedQuery(conditions=tuple(conditions), text=' '.join(w for w in words if w), errors=tuple(errors))
+
+
+def compile_query(parsed, fields, choices=None):
+    """
+    Turn ``parsed`` conditions into a ``Q`` over a model.
+
+    ``fields`` maps query field names to model field names; conditions on
+    other fields are ignored. ``choices`` maps the key fields (``category``,
+    ``source``) to a callable returning their ``(id, name)`` choices:
+    ``category:food`` matches the keys named ``Food`` in any case, and
+    nothing if there is none. Amounts are compared in each row's own
+    currency: ``amount:100`` is 10000 minor units of a USD row and 100 of a
+    JPY one.
+    """
+    q = Q()
+    for condition in parsed.conditions:
+        model_field = fields.get(condition.field)
+        if model_field is None:
+            continue
+        value = condition.value
+        if choices and condition.field in choices:
+            ids = [choice_id for choice_id, name in choices[condition.field]() if name.lower() == value.lower()]
+            q &= Q(**{f'{model_field}__in': ids})
+            continue
+        if condition.field == 'amount':
+            q &= _amount_q(model_field, condition.lookup, value)
+            continue
+        q &= Q(**{f'{model_field}__{condition.lookup}': value})
+    return q
+
+
+# Currency codes by the number of decimals of their minor unit; None for
+# all the others, with the usual two
+_CODES_BY_EXPONENT = {places: sorted(code for code, exponent in money.MINOR_UNITS.items() if exponent == places)
+                      for places in set(money.MINOR_UNITS.values())}
+_CODES_BY_EXPONENT[2] = None
+# A fraction of a minor unit lies between two of them: round towards the end that keeps the comparison
+_ROUNDING = {'gt': ROUND_FLOOR, 'lte': ROUND_FLOOR, 'gte': ROUND_CEILING, 'lt': ROUND_CEILING}
+
+
+def _amount_q(model_field, lookup, amount):
+    # One condition per minor unit size, each on the rows of its currencies
+    q = Q()
+    for exponent, codes in sorted(_CODES_BY_EXPONENT.items()):
+        minor = amount.scaleb(exponent)
+        if minor != minor.to_integral_value():
+            if lookup not in _ROUNDING:
+                # No row of these currencies holds that exact amount
+                continue
+            minor = minor.to_integral_value(_ROUNDING[lookup])
+        rows = Q(currency__in=codes) if codes else ~Q(currency__in=list(money.MINOR_UNITS))
+        q |= rows & Q(**{f'{model_field}__{lookup}': int(minor)})
+    return q or Q(pk__in=[])
+
+
+def _field_conditions(field, op, value):
+    if field == 'amount':
+        return _range_conditions(field, op, value, _parse_amount)
+    if field == 'date':
+        if '..' in value and not op:
+            low, high = value.split('..', 1)
+            conditions = []
+            if low:
+                conditions.append(Condition(field, 'gte', _parse_period(low)[0]))
+            if high:
+                conditions.append(Condition(field, 'lt', _parse_period(high)[1]))
+            return conditions
+        return _period_conditions(field, op, _parse_period(value))
+    if op not in ('', '='):
+        raise QueryError(f'{field} only supports exact matches')
+    return [Condition(field, 'exact', value)]
+
+
+def _range_conditions(field, op, value, convert):
+    if '..' in value and not op:
+        low, high = value.split('..', 1)
+        conditions = []
+        if low:
+            conditions.append(Condition(field, 'gte', convert(low)))
+        if high:
+            conditions.append(Condition(field, 'lte', convert(high)))
+        return conditions
+    return [Condition(field, COMPARISONS.get(op, 'exact'), convert(value))]
+
+
+def _period_conditions(field, op, period):
+    start, end = period
+    if op == '>':
+        return [Condition(field, 'gte', end)]
+    if op == '>=':
+        return [Condition(field, 'gte', start)]
+    if op == '<':
+        return [Condition(field, 'lt', start)]
+    if op == '<=':
+        return [Condition(field, 'lt', end)]
+    return [Condition(field, 'gte', start), Condition(field, 'lt', end)]
+
+
+def _parse_amount(value):
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise QueryError(f'"{value}" is not an amount')
+    if not amount.is_finite() or abs(amount) >= money.MAX_AMOUNT:
+        raise QueryError(f'"{value}" is not an amount')
+    return amount
+
+
+def _parse_period(value):
+    """Return ``(start, end)`` with ``end`` exclusive for YYYY, YYYY-MM or YYYY-MM-DD."""
+    try:
+        parts = [int(part) for part in value.split('-')]
+        if len(parts) == 1:
+            start = datetime.date(parts[0], 1, 1)
+            return start, datetime.date(parts[0] + 1, 1, 1)
+        if len(parts) == 2:
+            start = datetime.date(parts[0], parts[1], 1)
+            return start, _add_months(start, 1)
+        if len(parts) == 3:
+            start = datetime.date(*parts)
+            return start, start + datetime.timedelta(days=1)
+    except (ValueError, OverflowError):
+        pass
+    raise QueryError(f'"{value}" is not a date (use YYYY, YYYY-MM or YYYY-MM-DD)')
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+
+EXPENSE_FIELDS = {'amount': 'amount_minor', 'date': 'date', 'category': 'category'}
+INCOME_FIELDS = {'amount': 'amount_minor', 'date': 'date', 'source': 'source'}
@@ -0,0 +1,104 @@
+"""
+Currency conversion against the local ``ExchangeRate`` table.
+
+Rates are units of a currency per one ``EXCHANGE_RATE_BASE`` and an amount
+is converted at the latest rate on or before its date. ``convert`` works on
+whole arrays: rows are grouped by currency and each distinct (currency,
+date) pair is looked up once with a binary search over that currency's
+rates, so a 100k-row export costs one lookup per day it spans, not per row.
+
+Each currency's rates are read into NumPy arrays once per process and kept
+until the rate table's version, stored in the database, moves: the import
+command bumps it, and so does any save or delete (the admin, see
+``expenses.signals``), in the same transaction.
+"""
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+from . import money, reference
+from .models import ExchangeRate
+
+REFERENCE_NAME = 'exchange-rates'
+
+
+def base_currency():
+    return getattr(settings, 'EXCHANGE_RATE_BASE', 'USD')
+
+
+def version():
+    return reference.version(REFERENCE_NAME)
+
+
+def invalidate():
+    reference.invalidate(REFERENCE_NAME)
+
+
+@lru_cache(maxsize=512)
+def _series(currency, version):
+    rows = list(ExchangeRate.objects.filter(currency=currency).order_by('date').values_list('date', 'rate'))
+    return (np.array([date for date, _ in rows], dtype='datetime64[D]'),
+            np.array([float(rate) for _, rate in rows], dtype=np.float64))
+
+
+def rates_on(currency, dates, table_version=None):
+    """
+    Return the rate of ``currency`` in effect on each of ``dates``, NaN
+    where none is known, reading the version of the rate table unless given.
+    """
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    if currency == base_currency():
+        return np.ones(len(dates))
+    known_dates, known_rates = _series(currency, version() if table_version is None else table_version)
+    if not len(known_dates):
+        return np.full(len(dates), np.nan)
+    found = np.searchsorted(known_dates, dates, side='right') - 1
+    return np.where(found >= 0, known_rates[np.maximum(found, 0)], np.nan)
+
+
+def convert(amounts, currencies, dates, target):
+    """
+    Convert ``amounts`` (minor units of ``currencies``, on ``dates``) to
+    minor units of ``target``.
+
+    Returns ``(converted, missing)``: an int64 array and a boolean array
+    flagging rows with no rate for their currency or for ``target``, which
+    are 0 in ``converted``. Amounts already in ``target`` are copied exactly.
+    """
+    amounts = np.asarray(amounts, dtype=np.int64)
+    currencies = np.asarray(currencies, dtype=object)
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    converted = amounts.copy()
+    missing = np.zeros(len(amounts), dtype=bool)
+    if not len(amounts):
+        return converted, missing
+
+    codes, code_index = np.unique(currencies, return_inverse=True)
+    table_version = version()
+    for n, code in enumerate(codes):
+        if code == target:
+            continue
+        rows = code_index == n
+        days, day_index = np.unique(dates[rows], return_inverse=True)
+        factors = (rates_on(target, days, table_version) / rates_on(code, days, table_version)
+                   * 10.0 ** (money.exponent(target) - money.exponent(code)))
+        values = amounts[rows] * factors[day_index]
+        unknown = np.isnan(values)
+        converted[rows] = np.rint(np.where(unknown, 0, values)).astype(np.int64)
+        missing[rows] = unknown
+    return converted, missing
+
+
+def annotate(objects, target):
+    """
+    Set ``converted_amount`` on each of ``objects`` (anything with
+    ``amount_minor``, ``currency`` and ``date``) to its amount in ``target``
+    as a Decimal, or None where no rate is known.
+    """
+    objects = list(objects)
+    converted, missing = convert([obj.amount_minor for obj in objects], [obj.currency for obj in objects],
+                                 [obj.date for obj in objects], target)
+    for obj, value, unknown in zip(objects, converted, missing):
+        obj.converted_amount = None if unknown else money.from_minor(int(value), target)
+    return objects
@@ -0,0 +1,177 @@
+"""
+Reference data that changes rarely: currencies, categories, sources and
+each user's preferences.
+
+Currencies are read from ``currencies.json`` once per process. The rest is
+kept in Django's cache under versioned keys. The versions live in the
+database: categories and sources have a ``ReferenceVersion`` row each,
+bumped by ``expenses.signals`` in the transaction of any save or delete,
+and preferences use the user's data version, which preference saves bump.
+Every process reads the same versions, so a change reaches all of them
+even though each has its own local memory cache, and old entries simply
+expire.
+
+Expenses and incomes point at their category and source by key. A user
+picks from the shared ones (no owner) and their own; both kinds share one
+version, so a user's cached choices go stale with any change.
+"""
+import json
+import os
+from collections import namedtuple
+from functools import cache
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Q, Subquery
+
+from userincome.models import Source
+from userpreferences.models import UserPreference
+
+from . import metrics, money, versioning
+from .models import Category, ReferenceVersion
+
+Currency = namedtuple('Currency', ['key', 'value'])
+Choice = namedtuple('Choice', ['id', 'name'])
+
+KEY_PREFIX = 'reference'
+
+
+@cache
+def currencies():
+    """Return the read-only ``{code: name}`` mapping from ``currencies.json``."""
+    with open(os.path.join(settings.BASE_DIR, 'currencies.json')) as json_file:
+        return MappingProxyType(json.load(json_file))
+
+
+@cache
+def currency_choices():
+    return tuple(Currency(key, value) for key, value in currencies().items())
+
+
+def _timeout():
+    return getattr(settings, 'REFERENCE_CACHE_TIMEOUT', 60 * 60)
+
+
+def version(name):
+    """The stored version of ``name``, 0 until it is first invalidated."""
+    # The table holds a row per name, all read at once
+    versions = versioning.remembered('reference', lambda: dict(ReferenceVersion.objects.values_list('name', 'version')))
+    return versions.get(name, 0)
+
+
+def cached(name, version, loader, *parts):
+    """Return ``loader()``, cached under ``name`` at ``version`` and ``parts``."""
+    key = ':'.join([KEY_PREFIX, name, str(version), *map(str, parts)])
+    value = django_cache.get(key)
+    metrics.cache_lookup('reference', value is not None)
+    if value is None:
+        value = loader()
+        django_cache.set(key, value, _timeout())
+    return value
+
+
+def invalidate(name):
+    """Bump ``name``'s version, in the caller's transaction."""
+    versioning.forget('reference')
+    rows = ReferenceVersion.objects.filter(name=name)
+    if rows.update(version=F('version') + 1):
+        return
+    try:
+        with transaction.atomic():
+            ReferenceVersion.objects.create(name=name, version=1)
+    except IntegrityError:
+        rows.update(version=F('version') + 1)
+
+
+def _choices(model, owner_id):
+    rows = model.objects.filter(Q(owner=None) | Q(owner_id=owner_id)).order_by('pk').values_list('pk', 'name')
+    return tuple(Choice(*row) for row in rows)
+
+
+def categories(owner_id):
+    """The categories ``owner_id`` can pick, shared and their own, as ``Choice(id, name)``."""
+    return cached('categories', version('categories'), lambda: _choices(Category, owner_id), owner_id)
+
+
+def sources(owner_id):
+    return cached('sources', version('sources'), lambda: _choices(Source, owner_id), owner_id)
+
+
+def choice_id(choices, value):
+    """The id of the posted ``value`` if it is one of ``choices``, else ``None``."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if any(choice.id == value for choice in choices) else None
+
+
+def with_names(rows, field, choices):
+    # Search results carry the key; show the name
+    names = dict(choices)
+    for row in rows:
+        row[field] = names.get(row[field])
+    return rows
+
+
+def preference_key(user_id):
+    return f'preferences:{user_id}'
+
+
+def user_currency(user_id):
+    """Return the user's preferred currency, or ``None`` if they have not picked one."""
+    def load():
+        # Cached as a tuple so a user without preferences is cached too
+        return (UserPreference.objects.filter(user_id=user_id).values_list('currency', flat=True).first(),)
+    return cached(preference_key(user_id), versioning.current(user_id), load)[0]
+
+
+def user_currency_code(user_id):
+    """Return the ISO code of the user's currency, ``DEFAULT_CURRENCY`` if unset."""
+    return money.currency_code(user_currency(user_id))
+
+
+def backfill_keys(model, label_model, field, batch_size=5000):
+    """
+    Point ``field`` of each ``model`` row at the ``label_model`` row named in
+    its old ``<field>_name`` column, for the category and source migrations.
+    Names without a shared row get one of the owner's own first. Each batch
+    is one UPDATE committed on its own and filled rows are skipped, so the
+    table is never locked for long and an interrupted run picks up where it
+    stopped.
+    """
+    name_field = f'{field}_name'
+    pending = model.objects.filter(**{f'{field}__isnull': True})
+    shared = label_model.objects.filter(owner=None).values_list('name', flat=True)
+    owned = set(label_model.objects.exclude(owner=None).values_list('owner_id', 'name'))
+    missing = set(pending.exclude(**{f'{name_field}__in': shared}).order_by()
+                  .values_list('owner_id', name_field).distinct()) - owned
+    label_model.objects.bulk_create([label_model(owner_id=owner_id, name=name) for owner_id, name in sorted(missing)],
+                                    batch_size=1000)
+
+    # The owner's own before a shared one of the same name
+    label = (label_model.objects.filter(Q(owner=None) | Q(owner_id=OuterRef('owner_id')), name=OuterRef(name_field))
+             .order_by(F('owner').asc(nulls_last=True)).values('pk')[:1])
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            ids = list(pending.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return
+            model.objects.filter(pk__in=ids).update(**{field: Subquery(label)})
+            last_pk = ids[-1]
+
+
+def restore_names(model, label_model, field, batch_size=5000):
+    # Reverse of backfill_keys, for unapplying the migrations
+    name = label_model.objects.filter(pk=OuterRef(f'{field}_id')).values('name')
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            ids = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return
+            model.objects.filter(pk__in=ids).update(**{f'{field}_name': Subquery(name)})
+            last_pk = ids[-1]
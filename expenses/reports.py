@@ -0,0 +1,258 @@
+"""
+PDF expense reports.
+
+A report has a summary table (per-category totals from one grouped query,
+with each converted to the user's currency) followed by a detail table per
+category with its subtotal. Categories come in key order, the order they
+are offered in and the one the expense index reads them in. Tables repeat
+their header on every page and descriptions wrap instead of being cut off.
+
+Detail rows are read and turned into flowables as reportlab lays the
+pages out, a few tables ahead of it (see ``_Story``), so memory does not
+grow with the row count; what does is reportlab's record of the finished
+pages, about 1 MB per 1,000 rows, held until the file is written. Rendering
+takes about half a second per 1,000 rows, so the export view queues
+reports of more than ``EXPORT_PDF_INLINE_ROWS`` rows as jobs
+(``expenses.jobs``) rather than render them in the request.
+
+Rendered files are cached on disk under ``EXPORT_CACHE_DIR``, keyed by the
+user, their data version (``expenses.versioning``) and the report filters,
+so a repeat download is served from disk without rendering again.
+"""
+import glob
+import hashlib
+from collections import defaultdict
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.db.models import Count, Sum
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import LongTable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from . import exports, metrics, money, rates, versioning
+from .models import Category
+
+# Detail rows are laid out in tables of this many rows; one huge table
+# makes reportlab's page splitting quadratic.
+TABLE_CHUNK_ROWS = 500
+
+TABLE_STYLE = TableStyle([
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+    ('LINEBELOW', (0, 0), (-1, 0), 0.5, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+])
+TOTAL_STYLE = TableStyle([
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ('LINEABOVE', (0, 0), (-1, 0), 0.5, colors.grey),
+    ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+])
+
+
+def cache_dir():
+    path = getattr(settings, 'EXPORT_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'exports'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_path(owner_id, version, kind, params):
+    digest = hashlib.sha256(repr(sorted(params.items())).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir(), f'{kind}-{owner_id}-{version}-{digest}.pdf')
+
+
+def cached_expense_report(owner_id, expenses, params, max_rows=None):
+    """
+    Return the path of the PDF report for ``expenses``, rendering it only if
+    no file exists yet for this user, data version and ``params``. Returns
+    None instead of rendering a report of more than ``max_rows`` rows.
+    """
+    version = versioning.current(owner_id)
+    path = cache_path(owner_id, version, 'expenses', params)
+    exists = os.path.exists(path)
+    metrics.cache_lookup('pdf_report', exists)
+    if not exists and max_rows is not None and expenses[:max_rows + 1].count() > max_rows:
+        return None
+    if not exists:
+        _discard_stale(owner_id, 'expenses', version)
+        # Render next to the final name and move it into place, so a
+        # concurrent download never sees a half-written file.
+        fd, partial = tempfile.mkstemp(suffix='.partial', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            started = time.perf_counter()
+            render_expense_report(partial, expenses, params)
+            metrics.export_finished('pdf', time.perf_counter() - started, os.path.getsize(partial))
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return path
+
+
+def _discard_stale(owner_id, kind, version):
+    for path in glob.glob(os.path.join(cache_dir(), f'{kind}-{owner_id}-*.pdf')):
+        try:
+            if int(os.path.basename(path).split('-')[2]) < version:
+                os.remove(path)
+        except (ValueError, IndexError, OSError):
+            pass
+
+
+def render_expense_report(path, expenses, params, progress=None):
+    """
+    Render the report for the ``expenses`` queryset straight to the file at
+    ``path``, calling ``progress(n)`` as detail rows are read.
+    """
+    styles = getSampleStyleSheet()
+
+    # Totals are exact integer sums of minor units, one per currency
+    summary = list(expenses.order_by('category_id', 'currency').values_list('category_id', 'currency')
+                   .annotate(total=Sum('amount_minor'), count=Count('id')))
+    names = dict(Category.objects.filter(pk__in={row[0] for row in summary}).values_list('pk', 'name'))
+    subtotals = defaultdict(dict)
+    grand_totals = defaultdict(int)
+    for category, currency, total, _ in summary:
+        subtotals[category][currency] = total
+        grand_totals[currency] += total
+
+    story = [Paragraph('Expenses Report', styles['Title'])]
+    period = ' to '.join(str(params[key]) for key in ('start', 'end') if params.get(key))
+    if period:
+        story.append(Paragraph(f'Period: {period}', styles['Normal']))
+    if params.get('q'):
+        story.append(Paragraph(f'Search: {_escape(params["q"])}', styles['Normal']))
+    story.append(Spacer(1, 0.2 * inch))
+
+    story.append(Paragraph('Summary', styles['Heading2']))
+    target = params.get('currency')
+    widths = [3.5 * inch, 1.25 * inch, 1.75 * inch]
+    summary_rows = [['Category', 'Expenses', 'Total']]
+    summary_rows += [[_escape(names[category]), count, _money(total, currency)]
+                     for category, currency, total, count in summary]
+    total_rows = [['Total', '', _money(total, currency)] for currency, total in sorted(grand_totals.items())]
+    total_rows = total_rows or [['Total', '', _money(0, None)]]
+    if target:
+        widths = [2.75 * inch, 1 * inch, 1.5 * inch, 1.5 * inch]
+        converted = _converted_totals(expenses, target)
+        summary_rows[0].append(f'In {target}')
+        for row, (category, currency, _, _) in zip(summary_rows[1:], summary):
+            row.append(_money(converted[category, currency], target) if converted[category, currency] is not None
+                       else 'no rate')
+        known = [total for total in converted.values() if total is not None]
+        for row in total_rows:
+            row.append('')
+        total_rows.append([f'Total in {target}', '', '' if len(known) == len(converted) else 'excl. no rate',
+                           _money(sum(known), target)])
+    story.append(Table(summary_rows, colWidths=widths, repeatRows=1, style=TABLE_STYLE))
+    story.append(Table(total_rows, colWidths=widths, style=TOTAL_STYLE))
+
+    rows = (expenses.order_by('category_id', '-date', '-id')
+            .values_list('category_id', 'date', 'description', 'amount_minor', 'currency'))
+    details = _details(exports.with_progress(rows.iterator(chunk_size=exports.chunk_size()), progress),
+                       names, subtotals, styles)
+
+    doc = SimpleDocTemplate(path, pagesize=letter, title='Expenses Report',
+                            topMargin=0.9 * inch, bottomMargin=0.75 * inch)
+    doc.build(_Story(story, details), onFirstPage=_decorate_page, onLaterPages=_decorate_page)
+
+
+class _Story(list):
+    """
+    The flowables reportlab has yet to lay out, topped up from ``more`` as
+    it takes them off the front. ``build`` asks for the length before each
+    flowable, and only ever indexes the first few.
+    """
+
+    def __init__(self, flowables, more, ahead=4):
+        super().__init__(flowables)
+        self.more = more
+        self.ahead = ahead
+
+    def __len__(self):
+        while self.more is not None and super().__len__() < self.ahead:
+            flowable = next(self.more, None)
+            if flowable is None:
+                self.more = None
+            else:
+                self.append(flowable)
+        return super().__len__()
+
+
+def _details(rows, names, subtotals, styles):
+    # Per category: a heading, tables of TABLE_CHUNK_ROWS detail rows, the subtotal
+    cell = styles['BodyText'].clone('cell', fontSize=9, leading=11)
+    widths = [1 * inch, 4.25 * inch, 1.25 * inch]
+    header = ['Date', 'Description', 'Amount']
+    current = None
+    chunk = []
+    for category, date, description, amount, currency in rows:
+        if category != current:
+            if chunk:
+                yield _detail_table(header, chunk, widths)
+            if current is not None:
+                yield from _subtotal(names[current], subtotals[current], widths)
+            yield Paragraph(_escape(names[category]), styles['Heading3'])
+            current = category
+            chunk = []
+        chunk.append([date, Paragraph(_escape(description), cell), _money(amount, currency)])
+        if len(chunk) >= TABLE_CHUNK_ROWS:
+            yield _detail_table(header, chunk, widths)
+            chunk = []
+    if chunk:
+        yield _detail_table(header, chunk, widths)
+    if current is not None:
+        yield from _subtotal(names[current], subtotals[current], widths)
+
+
+def _converted_totals(expenses, currency):
+    """
+    Return ``{(category_id, currency): total}`` in minor units of ``currency``,
+    None where some day has no rate. Totals are converted per day.
+    """
+    daily = list(expenses.order_by().values_list('category_id', 'currency', 'date').annotate(total=Sum('amount_minor')))
+    amounts, missing = rates.convert([row[3] for row in daily], [row[1] for row in daily],
+                                     [row[2] for row in daily], currency)
+    totals = {}
+    for (category, code, _, _), amount, unknown in zip(daily, amounts, missing):
+        key = (category, code)
+        if unknown or (key in totals and totals[key] is None):
+            totals[key] = None
+        else:
+            totals[key] = totals.get(key, 0) + int(amount)
+    return totals
+
+
+def _detail_table(header, chunk, widths):
+    return LongTable([header] + chunk, colWidths=widths, repeatRows=1, style=TABLE_STYLE)
+
+
+def _subtotal(name, subtotals, widths):
+    rows = [['', f'Subtotal {name}', _money(total, currency)]
+            for currency, total in sorted(subtotals.items())]
+    if rows:
+        yield Table(rows, colWidths=widths, style=TOTAL_STYLE)
+
+
+def _decorate_page(canvas, doc):
+    canvas.saveState()
+    canvas.setFont('Helvetica-Bold', 12)
+    canvas.drawCentredString(letter[0] / 2, letter[1] - 0.5 * inch, 'TRULY EXPENSE MANAGEMENT')
+    canvas.setFont('Helvetica', 8)
+    canvas.drawRightString(letter[0] - 0.75 * inch, 0.5 * inch, f'Page {doc.page}')
+    canvas.restoreState()
+
+
+def _money(minor, currency):
+    return money.format_money(minor, currency)
+
+
+def _escape(text):
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
@@ -0,0 +1,135 @@
+"""
+Per-user monthly category totals for expenses.
+
+``ExpenseRollup`` holds one row per (owner, month, category, currency)
+with the total in minor units; categories are keys, not names. Writes go
+through ``apply_deltas`` so that the signal handlers and any bulk loaders
+share the same upsert logic, and reads go through ``category_totals`` which
+stitches whole months from the rollup table together with the (at most two)
+partial months at the edges of the requested window.
+"""
+import datetime
+from collections import defaultdict
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncMonth
+
+from .models import Expense, ExpenseRollup
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    if day.month == 12:
+        return datetime.date(day.year + 1, 1, 1)
+    return datetime.date(day.year, day.month + 1, 1)
+
+
+def rollup_key(owner_id, date, category_id, currency):
+    return (owner_id, month_start(date), category_id, currency)
+
+
+def apply_deltas(deltas):
+    """
+    Add ``deltas`` to the rollup table.
+
+    ``deltas`` maps ``(owner_id, month, category_id, currency)`` to
+    ``(total_minor, count)``. Each key is an UPDATE ... SET total_minor =
+    total_minor + x, falling back to an
+    INSERT for the first expense of a month/category. Rows that drop to zero
+    expenses are removed so the table only holds months with data.
+    """
+    for (owner_id, month, category_id, currency), (total, count) in deltas.items():
+        if not total and not count:
+            continue
+        rows = ExpenseRollup.objects.filter(owner_id=owner_id, month=month, category_id=category_id, currency=currency)
+        updated = rows.update(total_minor=F('total_minor') + total, count=F('count') + count)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    ExpenseRollup.objects.create(owner_id=owner_id, month=month, category_id=category_id,
+                                                 currency=currency, total_minor=total, count=count)
+            except IntegrityError:
+                # Another request created the row between our UPDATE and INSERT.
+                rows.update(total_minor=F('total_minor') + total, count=F('count') + count)
+        if count < 0:
+            rows.filter(count__lte=0).delete()
+
+
+def rebuild(owner_ids=None):
+    """Recompute the rollup table from raw expenses, optionally for some users only."""
+    expenses = Expense.objects.all()
+    rollups = ExpenseRollup.objects.all()
+    if owner_ids is not None:
+        expenses = expenses.filter(owner_id__in=owner_ids)
+        rollups = rollups.filter(owner_id__in=owner_ids)
+
+    # Grouped and inserted by the database in one INSERT ... SELECT; the
+    # SELECT lists the values() fields first, then the annotations in order
+    grouped = (expenses.order_by()
+               .values('owner_id', 'category_id', 'currency')
+               .annotate(month=TruncMonth('date'), total=Sum('amount_minor'), count=Count('id')))
+    select_sql, params = grouped.query.sql_with_params()
+    columns = ', '.join(ExpenseRollup._meta.get_field(name).column
+                        for name in ('owner_id', 'category_id', 'currency', 'month', 'total_minor', 'count'))
+    with transaction.atomic(), connection.cursor() as cursor:
+        rollups.delete()
+        cursor.execute(f'INSERT INTO {ExpenseRollup._meta.db_table} ({columns}) {select_sql}', params)
+        return cursor.rowcount
+
+
+def _totals_queries(owner_id, start, end):
+    # Querysets of (category_id, currency, month, total) rows that add up to the window
+    if start > end:
+        return []
+    first_full = start if start.day == 1 else next_month(start)
+    after_last_full = month_start(end + datetime.timedelta(days=1))
+
+    queries = []
+    if first_full < after_last_full:
+        queries.append(ExpenseRollup.objects
+                       .filter(owner_id=owner_id, month__gte=first_full, month__lt=after_last_full)
+                       .values_list('category_id', 'currency', 'month', 'total_minor'))
+        edges = Q()
+        if start < first_full:
+            edges |= Q(date__gte=start, date__lt=first_full)
+        if after_last_full <= end:
+            edges |= Q(date__gte=after_last_full, date__lte=end)
+    else:
+        edges = Q(date__gte=start, date__lte=end)
+
+    if edges:
+        queries.append(Expense.objects.filter(edges, owner_id=owner_id)
+                       .order_by()
+                       .annotate(month=TruncMonth('date'))
+                       .values_list('category_id', 'currency', 'month')
+                       .annotate(total=Sum('amount_minor')))
+    return queries
+
+
+def category_totals(owner_id, start, end, by_month=False):
+    """
+    Return ``{(category_id, currency): total_minor}`` for expenses dated
+    ``start`` to ``end`` inclusive, or ``{(category_id, currency, month): ...}``
+    with ``by_month``.
+
+    Months lying entirely inside the window are read from the rollup table;
+    the partial months at either edge are summed from raw expenses.
+    """
+    totals = defaultdict(int)
+    for rows in _totals_queries(owner_id, start, end):
+        for category, currency, month, total in rows:
+            totals[(category, currency, month) if by_month else (category, currency)] += total
+    return totals
+
+
+async def acategory_totals(owner_id, start, end, by_month=False):
+    """``category_totals`` for async views, on the async ORM."""
+    totals = defaultdict(int)
+    for rows in _totals_queries(owner_id, start, end):
+        async for category, currency, month, total in rows:
+            totals[(category, currency, month) if by_month else (category, currency)] += total
+    return totals
@@ -0,0 +1,298 @@
+"""
+Ranked full-text search for expenses and incomes.
+
+On PostgreSQL the searched table carries a generated ``tsvector`` column with
+a GIN index; on SQLite an external-content FTS5 table is kept in sync by
+triggers. Any other database falls back to ``icontains``. A search runs in
+two steps: the index yields the scores and ids of one page, then only the
+columns the table renders are fetched for those ids. Pages are continued with
+an opaque signed cursor holding the last (score, id) pair.
+
+Category and source names are not in the index, which holds descriptions
+only: a search word that begins a word of one of the owner's category (or
+source) names, from the cached choices, also matches the rows filed under
+it. Those rows rank after rows matching on their description.
+"""
+import datetime
+import json
+import re
+from functools import reduce
+from operator import and_, or_
+
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+TOKEN_RE = re.compile(r'[^\W_]+')
+MAX_TOKENS = 16
+MAX_LIMIT = 100
+CURSOR_SALT = 'expenses.search.cursor'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def request_params(request):
+    # searchText, limit and cursor from the query string (GET, cacheable) or a JSON body (POST)
+    if request.method == 'GET':
+        return request.GET
+    return json.loads(request.body)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower())[:MAX_TOKENS]
+
+
+class SearchIndex:
+    vector_column = 'search_vector'
+
+    def __init__(self, table, columns, label=None):
+        self.table = table
+        self.columns = tuple(columns)
+        # The category or source key, whose names are matched from the cache
+        self.label = label
+
+    @property
+    def fts_table(self):
+        return f'{self.table}_fts'
+
+    # Schema management, called from migrations through RunPython.
+
+    def install(self, apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            self._install_postgresql(schema_editor)
+        elif vendor == 'sqlite':
+            self._install_sqlite(schema_editor)
+
+    def uninstall(self, apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            schema_editor.execute(f'ALTER TABLE {self.table} DROP COLUMN IF EXISTS {self.vector_column}')
+        elif vendor == 'sqlite':
+            for suffix in ('ai', 'ad', 'au'):
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {self.fts_table}_{suffix}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {self.fts_table}')
+
+    def _install_postgresql(self, schema_editor):
+        document = " || ' ' || ".join(f"coalesce({column}, '')" for column in self.columns)
+        schema_editor.execute(
+            f'ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS {self.vector_column} tsvector '
+            f"GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, {document})) STORED")
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {self.table}_search_idx ON {self.table} USING gin ({self.vector_column})')
+
+    def _install_sqlite(self, schema_editor):
+        # Triggers are dropped whenever Django remakes the table, so this is
+        # written to be re-run by any later migration that alters it.
+        self.uninstall(None, schema_editor)
+        columns = ', '.join(self.columns)
+        new_values = ', '.join(f'new.{column}' for column in self.columns)
+        old_values = ', '.join(f'old.{column}' for column in self.columns)
+        fts = self.fts_table
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({columns}, content='{self.table}', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        schema_editor.execute(
+            f'CREATE TRIGGER {fts}_ai AFTER INSERT ON {self.table} BEGIN '
+            f'INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new_values}); END')
+        schema_editor.execute(
+            f'CREATE TRIGGER {fts}_ad AFTER DELETE ON {self.table} BEGIN '
+            f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END")
+        schema_editor.execute(
+            f'CREATE TRIGGER {fts}_au AFTER UPDATE ON {self.table} BEGIN '
+            f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            f'INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new_values}); END')
+        schema_editor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    # Querying.
+
+    def label_matches(self, tokens, choices):
+        """
+        Map each of ``tokens`` that begins a word of the name of one of
+        ``choices`` (the owner's categories or sources) to their ids.
+        """
+        if not self.label:
+            return {}
+        matches = {}
+        for token in tokens:
+            ids = [pk for pk, name in choices if any(word.startswith(token) for word in tokenize(name))]
+            if ids:
+                matches[token] = ids
+        return matches
+
+    def filter(self, queryset, tokens, choices=()):
+        """
+        Restrict ``queryset`` to rows matching every token, without ranking.
+        A token naming one of ``choices`` also matches the rows filed under it.
+        """
+        connection = connections[queryset.db]
+        return queryset.filter(self._condition(self._backend(connection), tokens, self.label_matches(tokens, choices)))
+
+    def ranked_ids(self, queryset, tokens, limit, after=None, choices=()):
+        """
+        Return up to ``limit`` ``(score, id)`` pairs of ``queryset`` rows
+        matching every token, best first and strictly after ``after``.
+        Rows matched only through the name of one of ``choices`` come last.
+        """
+        connection = connections[queryset.db]
+        backend = self._backend(connection)
+        labels = self.label_matches(tokens, choices)
+        matched = queryset.filter(self._condition(backend, tokens, labels))
+        if backend == 'postgresql':
+            return self._ranked_ids_postgresql(matched, tokens, limit, after)
+        if backend == 'sqlite':
+            return self._ranked_ids_sqlite(connection, queryset, matched if labels else None, tokens, limit, after)
+        return self._ranked_ids_fallback(matched, limit, after)
+
+    tsquery_sql = "to_tsquery('simple'::regconfig, %s)"
+
+    def _tsquery(self, tokens):
+        return ' & '.join(f'{token}:*' for token in tokens)
+
+    def _fts_match(self, tokens):
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def _backend(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'postgresql'
+        if connection.vendor == 'sqlite' and self._has_fts_table(connection):
+            return 'sqlite'
+        return None
+
+    def _condition(self, backend, tokens, labels):
+        # Tokens naming a category or source match either way; the rest go
+        # to the index together
+        plain = [token for token in tokens if token not in labels]
+        condition = self._match(backend, plain) if plain else Q()
+        for token, ids in labels.items():
+            condition &= self._match(backend, [token]) | Q(**{f'{self.label}__in': ids})
+        return condition
+
+    def _match(self, backend, tokens):
+        if backend == 'postgresql':
+            return Q(RawSQL(f'{self.table}.{self.vector_column} @@ {self.tsquery_sql}', [self._tsquery(tokens)],
+                            output_field=BooleanField()))
+        if backend == 'sqlite':
+            return Q(pk__in=RawSQL(f'SELECT rowid FROM {self.fts_table} WHERE {self.fts_table} MATCH %s',
+                                   [self._fts_match(tokens)]))
+        return reduce(and_, (reduce(or_, (Q(**{f'{column}__icontains': token}) for column in self.columns))
+                             for token in tokens))
+
+    def _ranked_ids_postgresql(self, matched, tokens, limit, after):
+        vector = f'{self.table}.{self.vector_column}'
+        ranked = matched.annotate(score=RawSQL(
+            f'ts_rank({vector}, {self.tsquery_sql})::float8', [self._tsquery(tokens)], output_field=FloatField()))
+        if after is not None:
+            score, pk = after
+            ranked = ranked.filter(Q(score__lt=score) | Q(score=score, pk__lt=pk))
+        return list(ranked.order_by('-score', '-pk').values_list('score', 'pk')[:limit])
+
+    def _has_fts_table(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.fts_table])
+            return cursor.fetchone() is not None
+
+    def _ranked_ids_sqlite(self, connection, queryset, named, tokens, limit, after):
+        # bm25 only scores rows of a MATCH over every token, so the rows
+        # ``named`` adds through a category or source score 0
+        fts = self.fts_table
+        match = self._fts_match(tokens)
+        scope_sql, scope_params = queryset.order_by().values('pk').query.sql_with_params()
+        sql = (f'SELECT score, id FROM ('
+               f'SELECT -bm25({fts}) AS score, {fts}.rowid AS id FROM {fts} '
+               f'WHERE {fts} MATCH %s AND {fts}.rowid IN ({scope_sql})')
+        params = [match, *scope_params]
+        if named is not None:
+            named_sql, named_params = named.order_by().values('pk').query.sql_with_params()
+            sql += (f' UNION ALL SELECT 0.0, id FROM ({named_sql}) '
+                    f'WHERE id NOT IN (SELECT rowid FROM {fts} WHERE {fts} MATCH %s)')
+            params += [*named_params, match]
+        sql += ') '
+        if after is not None:
+            sql += 'WHERE score < %s OR (score = %s AND id < %s) '
+            params += [after[0], after[0], after[1]]
+        sql += 'ORDER BY score DESC, id DESC LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def _ranked_ids_fallback(self, matched, limit, after):
+        if after is not None:
+            matched = matched.filter(pk__lt=after[1])
+        matched = matched.annotate(score=Value(0.0, output_field=FloatField()))
+        return list(matched.order_by('-pk').values_list('score', 'pk')[:limit])
+
+
+def search(queryset, index, text, fields, limit=None, cursor=None, match_all=False, choices=()):
+    """
+    Search ``queryset`` and return ``{'results': [...], 'next': cursor}``.
+    ``choices`` are the owner's categories or sources, whose names the
+    search words match too.
+
+    ``results`` holds dicts of ``fields`` in rank order, at most ``limit`` of
+    them; ``next`` continues the listing or is ``None`` on the last page.
+    Without any search words nothing matches, unless ``match_all`` is set
+    (the queryset is already filtered), in which case rows are listed newest
+    first.
+    """
+    limit = clamp_limit(limit)
+    after = load_cursor(cursor)
+    tokens = tokenize(text)
+    if tokens:
+        ranked = index.ranked_ids(queryset, tokens, limit + 1, after, choices)
+    elif match_all:
+        ranked = recent_ids(queryset, limit + 1, after)
+    else:
+        return {'results': [], 'next': None}
+
+    page = ranked[:limit]
+    rows = queryset.model._default_manager.filter(pk__in=[pk for _, pk in page]).order_by().values('id', *fields)
+    rows = {row['id']: row for row in rows}
+    return {
+        'results': [rows[pk] for _, pk in page if pk in rows],
+        'next': dump_cursor(page[-1]) if len(ranked) > limit else None,
+    }
+
+
+def recent_ids(queryset, limit, after=None):
+    """Like ``SearchIndex.ranked_ids`` but ordered by date, scoring each row by its date ordinal."""
+    if after is not None:
+        try:
+            day, pk = datetime.date.fromordinal(int(after[0])), after[1]
+        except ValueError as e:
+            raise InvalidCursor(str(e))
+        queryset = queryset.filter(Q(date__lt=day) | Q(date=day, pk__lt=pk))
+    rows = queryset.order_by('-date', '-pk').values_list('date', 'pk')[:limit]
+    return [(float(day.toordinal()), pk) for day, pk in rows]
+
+
+def clamp_limit(limit):
+    default = getattr(settings, 'SEARCH_RESULT_LIMIT', 25)
+    try:
+        limit = int(limit) if limit is not None else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def dump_cursor(position):
+    return signing.dumps(list(position), salt=CURSOR_SALT, compress=True)
+
+
+def load_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        score, pk = signing.loads(cursor, salt=CURSOR_SALT)
+        return float(score), int(pk)
+    except (signing.BadSignature, TypeError, ValueError) as e:
+        raise InvalidCursor(str(e))
+
+
+EXPENSE_SEARCH = SearchIndex('expenses_expense', ('description',), 'category')
+INCOME_SEARCH = SearchIndex('userincome_userincome', ('description',), 'source')
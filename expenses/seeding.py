@@ -0,0 +1,155 @@
+"""
+Synthetic ledgers for scaling tests, generated and loaded by
+``manage.py seed_ledger``.
+
+Users are processed in fixed blocks, each generated with NumPy from a
+random generator seeded by ``(seed, block)``, so the data depends only on
+the seed and the block size, not on how many processes share the work.
+Activity is skewed: row counts per user are log-normal, categories follow
+a Zipf-like popularity with log-normal amounts around a typical price, and
+dates lean towards December and weekends. Incomes are a monthly salary
+plus occasional side income.
+
+Rows bypass the ORM through ``expenses.bulk.load``: PostgreSQL gets them
+through ``COPY ... FROM STDIN`` as they are formatted, SQLite through
+``executemany`` in one transaction per block. Signals don't fire, so
+``finish`` rebuilds the rollups and counters of the new users afterwards.
+"""
+import datetime
+
+import numpy as np
+from django.db import connection
+
+from userincome.models import UserIncome
+from userpreferences.models import UserPreference
+
+from . import counters, imports, money, reference, rollups
+from .models import DataVersion, Expense
+
+# name: (popularity weight, typical amount in major units, descriptions)
+CATEGORIES = {
+    'Food': (30, 18, ['groceries', 'lunch', 'coffee', 'dinner out', 'bakery', 'takeaway']),
+    'Bills': (12, 60, ['electricity', 'internet', 'phone', 'water', 'gas bill']),
+    'Travel': (10, 25, ['train ticket', 'taxi', 'fuel', 'bus pass', 'parking', 'flight']),
+    'Fun': (9, 30, ['cinema', 'concert', 'streaming', 'games', 'museum']),
+    'Health': (6, 35, ['pharmacy', 'dentist', 'gym', 'optician']),
+    'Gifts': (4, 45, ['birthday present', 'flowers', 'wedding gift']),
+    'Books': (3, 20, ['paperback', 'ebook', 'magazine', 'textbook']),
+    'Rent': (2, 1200, ['rent', 'rent and service charge']),
+}
+SOURCES = {
+    'Side hustles': ['freelance job', 'market stall', 'tutoring', 'resale'],
+    'Business': ['invoice paid', 'consulting', 'dividend'],
+    'Gifts': ['birthday money', 'cash gift'],
+}
+# Currency of each user's ledger, with the share of users using it
+CURRENCIES = {'USD': 0.6, 'EUR': 0.25, 'GBP': 0.15}
+SEASON = 0.25
+WEEKEND = 1.3
+
+
+def currency_label(code):
+    return f'{code} - {reference.currencies()[code]}'
+
+
+def ledger_currencies(seed, users):
+    # A stream of its own, apart from the (seed, block) ones
+    rng = np.random.default_rng([seed, 0, 0])
+    return rng.choice(list(CURRENCIES), size=users, p=list(CURRENCIES.values())).tolist()
+
+
+def _lookup(names):
+    return np.array(names, dtype=object)
+
+
+def _calendar(start, end):
+    """Every day from ``start`` to ``end`` and how likely a purchase is on it."""
+    days = np.arange(np.datetime64(start), np.datetime64(end) + 1)
+    months = days.astype('datetime64[M]').astype(int) % 12 + 1
+    weekdays = (days.astype(int) + 3) % 7  # 1970-01-01 was a Thursday
+    weights = (1 + SEASON * np.cos(2 * np.pi * (months - 12) / 12)) * np.where(weekdays >= 5, WEEKEND, 1)
+    return days, weights / weights.sum()
+
+
+def generate(seed, block, owners, currencies, keys, start, end, rows_per_user):
+    """
+    Return ``(expenses, incomes)`` for ``owners`` (ids, with their ledger
+    ``currencies``): dicts of equal-length column arrays keyed by model
+    field name. ``keys`` holds the ``{name: id}`` of the shared categories
+    and sources.
+    """
+    category_ids, source_ids = keys
+    rng = np.random.default_rng([seed, block])
+    owners = np.asarray(owners)
+    currencies = np.asarray(currencies, dtype=object)
+    scale = np.array([10 ** money.exponent(code) for code in currencies])
+    days, weights = _calendar(start, end)
+
+    # log-normal with mean rows_per_user: a few heavy users, many light ones
+    sigma = 0.8
+    counts = np.maximum(1, rng.lognormal(np.log(rows_per_user) - sigma ** 2 / 2, sigma, len(owners)).astype(int))
+    who = np.repeat(np.arange(len(owners)), counts)
+    names = list(CATEGORIES)
+    popularity = np.array([CATEGORIES[name][0] for name in names], dtype=float)
+    typical = np.array([CATEGORIES[name][1] for name in names], dtype=float)
+    category = rng.choice(len(names), size=len(who), p=popularity / popularity.sum())
+    amount = np.exp(rng.normal(np.log(typical[category]), 0.6)) * scale[who]
+    descriptions = [CATEGORIES[name][2] for name in names]
+    offsets = np.cumsum([0] + [len(choices) for choices in descriptions])
+    description = offsets[category] + (rng.random(len(who)) * np.diff(offsets)[category]).astype(int)
+    expenses = {
+        'owner_id': owners[who],
+        'amount_minor': np.maximum(1, np.rint(amount)).astype(np.int64),
+        'currency': currencies[who],
+        'date': rng.choice(days, size=len(who), p=weights),
+        'description': _lookup([text for choices in descriptions for text in choices])[description],
+        'category_id': np.array([category_ids[name] for name in names])[category],
+    }
+
+    # A salary on the 25th of every month, plus side income about once a month
+    months = np.arange(np.datetime64(start, 'M'), np.datetime64(end, 'M') + 1)
+    paydays = months.astype('datetime64[D]') + 24
+    paydays = paydays[(paydays >= np.datetime64(start)) & (paydays <= np.datetime64(end))]
+    salary = np.exp(rng.normal(np.log(3500), 0.5, len(owners)))
+    salary_who = np.repeat(np.arange(len(owners)), len(paydays))
+    side_who = np.repeat(np.arange(len(owners)), rng.poisson(len(paydays), len(owners)))
+    source_names = list(SOURCES)
+    source = rng.integers(len(source_names), size=len(side_who))
+    side_texts = [SOURCES[name] for name in source_names]
+    side_offsets = np.cumsum([0] + [len(choices) for choices in side_texts])
+    side_text = side_offsets[source] + (rng.random(len(side_who)) * np.diff(side_offsets)[source]).astype(int)
+    who = np.concatenate([salary_who, side_who])
+    amount = np.concatenate([salary[salary_who] * rng.normal(1, 0.02, len(salary_who)),
+                             np.exp(rng.normal(np.log(150), 0.9, len(side_who)))]) * scale[who]
+    incomes = {
+        'owner_id': owners[who],
+        'amount_minor': np.maximum(1, np.rint(amount)).astype(np.int64),
+        'currency': currencies[who],
+        'date': np.concatenate([np.tile(paydays, len(owners)), rng.choice(days, size=len(side_who), p=weights)]),
+        'description': np.concatenate([np.full(len(salary_who), 'salary', dtype=object),
+                                       _lookup([text for choices in side_texts for text in choices])[side_text]]),
+        'source_id': np.concatenate([np.full(len(salary_who), source_ids['Salary']),
+                                     np.array([source_ids[name] for name in source_names])[source]]),
+    }
+    expenses['content_hash'] = imports.content_hashes(expenses)
+    incomes['content_hash'] = imports.content_hashes(incomes)
+    return expenses, incomes
+
+
+def finish(owner_ids, currencies):
+    """Give the loaded users what signals would have: preferences, rollups, counters, versions."""
+    UserPreference.objects.bulk_create(
+        [UserPreference(user_id=owner_id, currency=currency_label(code)) for owner_id, code in zip(owner_ids, currencies)],
+        batch_size=1000)
+    rollups.rebuild(owner_ids)
+    counters.rebuild(owner_ids)
+    DataVersion.objects.bulk_create([DataVersion(owner_id=owner_id, version=1) for owner_id in owner_ids],
+                                    batch_size=1000)
+    with connection.cursor() as cursor:
+        cursor.execute(f'ANALYZE {Expense._meta.db_table}')
+        cursor.execute(f'ANALYZE {UserIncome._meta.db_table}')
+
+
+def default_range(years):
+    end = datetime.date.today()
+    return end.replace(year=end.year - years), end
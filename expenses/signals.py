@@ -0,0 +1,135 @@
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from userincome.models import Source, UserIncome
+from userpreferences.models import UserPreference
+
+from . import counters, imports, rates, reference, rollups, versioning
+from .models import Category, ExchangeRate, Expense
+
+
+def _rollup_values(owner_id, date, category_id, currency, amount_minor):
+    # Form views assign raw POST strings, so normalise before keying on them.
+    date = Expense._meta.get_field('date').to_python(date)
+    return rollups.rollup_key(owner_id, date, int(category_id), currency), int(amount_minor)
+
+
+def _owner_deleted(origin):
+    # Rows removed because their user is being deleted need no bookkeeping;
+    # rollups, versions and counters go with the user.
+    if isinstance(origin, QuerySet):
+        return origin.model is User
+    return isinstance(origin, User)
+
+
+@receiver(pre_save, sender=Expense)
+@receiver(pre_save, sender=UserIncome)
+def set_content_hash(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    date = sender._meta.get_field('date').to_python(instance.date)
+    instance.content_hash = imports.content_hash(date, int(instance.amount_minor), instance.currency,
+                                                 instance.description)
+
+
+@receiver(pre_save, sender=Expense)
+def remember_previous_expense(sender, instance, raw, **kwargs):
+    instance._rollup_previous = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    instance._rollup_previous = (Expense.objects
+                                 .filter(pk=instance.pk)
+                                 .values_list('owner_id', 'date', 'category_id', 'currency', 'amount_minor')
+                                 .first())
+
+
+@receiver(post_save, sender=Expense)
+def update_rollups_on_save(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    deltas = defaultdict(lambda: (0, 0))
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous is not None:
+        key, amount = _rollup_values(*previous)
+        total, count = deltas[key]
+        deltas[key] = (total - amount, count - 1)
+    key, amount = _rollup_values(instance.owner_id, instance.date, instance.category_id, instance.currency,
+                                 instance.amount_minor)
+    total, count = deltas[key]
+    deltas[key] = (total + amount, count + 1)
+    rollups.apply_deltas(deltas)
+    versioning.bump(instance.owner_id)
+    if previous is None:
+        counters.add(instance.owner_id, 'expenses', 1)
+    elif previous[0] != instance.owner_id:
+        versioning.bump(previous[0])
+        counters.add(previous[0], 'expenses', -1)
+        counters.add(instance.owner_id, 'expenses', 1)
+
+
+@receiver(post_delete, sender=Expense)
+def update_rollups_on_delete(sender, instance, origin=None, **kwargs):
+    if _owner_deleted(origin):
+        return
+    key, amount = _rollup_values(instance.owner_id, instance.date, instance.category_id, instance.currency,
+                                 instance.amount_minor)
+    rollups.apply_deltas({key: (-amount, -1)})
+    versioning.bump(instance.owner_id)
+    counters.add(instance.owner_id, 'expenses', -1)
+
+
+@receiver(pre_save, sender=UserIncome)
+def remember_previous_income_owner(sender, instance, raw, **kwargs):
+    instance._previous_owner_id = None
+    if not raw and not instance._state.adding and instance.pk is not None:
+        instance._previous_owner_id = (UserIncome.objects.filter(pk=instance.pk)
+                                       .values_list('owner_id', flat=True).first())
+
+
+@receiver(post_save, sender=UserIncome)
+def count_income_on_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    previous_owner_id = getattr(instance, '_previous_owner_id', None)
+    versioning.bump(instance.owner_id)
+    if created or previous_owner_id is None:
+        counters.add(instance.owner_id, 'incomes', 1)
+    elif previous_owner_id != instance.owner_id:
+        versioning.bump(previous_owner_id)
+        counters.add(previous_owner_id, 'incomes', -1)
+        counters.add(instance.owner_id, 'incomes', 1)
+
+
+@receiver(post_delete, sender=UserIncome)
+def count_income_on_delete(sender, instance, origin=None, **kwargs):
+    if _owner_deleted(origin):
+        return
+    versioning.bump(instance.owner_id)
+    counters.add(instance.owner_id, 'incomes', -1)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_categories(sender, **kwargs):
+    reference.invalidate('categories')
+
+
+@receiver([post_save, post_delete], sender=Source)
+def invalidate_sources(sender, **kwargs):
+    reference.invalidate('sources')
+
+
+@receiver([post_save, post_delete], sender=ExchangeRate)
+def invalidate_rates(sender, **kwargs):
+    rates.invalidate()
+
+
+@receiver([post_save, post_delete], sender=UserPreference)
+def invalidate_preferences(sender, instance, raw=False, origin=None, **kwargs):
+    # The cached preference keys on the data version, and the preferred
+    # currency changes what summaries and exports show
+    if not raw and not _owner_deleted(origin):
+        versioning.bump(instance.user_id)
@@ -1,3 +1,1369 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import parse_qs, urlencode
+from xml.etree import ElementTree
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Q, QuerySet, Sum
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from userincome.models import Source, UserIncome
+from userpreferences.models import UserPreference
+
+from . import (aio, benchmark, budgets, counters, exports, filters, fragments, imports, jobs, money, pagination, query,
+               rates, reference, reports, rollups, search, timing, versioning)
+from .models import Budget, BudgetStatus, Category, DataVersion, ExchangeRate, Expense, ExpenseRollup, ExportJob
+
+CATEGORIES = ['Food', 'Rent', 'Travel', 'Fun', 'Health', 'Books', 'Gifts', 'Bills']
+SOURCES = ['Salary', 'Business', 'Side hustles', 'Gifts']
+
+
+def shared(model, name):
+    # A shared category or source, by name
+    return model.objects.get_or_create(owner=None, name=name)[0]
+
+
+def forget_choices():
+    # The cached versions are rolled back after each test, but not the
+    # entries cached under them, and ids are reused
+    cache.clear()
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    Runs EXPLAIN on the queries a view issues against a seeded dataset and
+    fails on a full table scan or an explicit sort of the listed tables.
+
+    On PostgreSQL sequential scans and sorts are priced out
+    (``enable_seqscan``, ``enable_sort``) so the plan does not depend on
+    table statistics: a Seq Scan that still shows up means no index can
+    serve the query, and a Sort that no index can deliver the order.
+    """
+    tables = ('expenses_expense', 'userincome_userincome')
+    users = 20
+    rows_per_user = 300
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = Category.objects.bulk_create(Category(name=name) for name in CATEGORIES)
+        sources = Source.objects.bulk_create(Source(name=name) for name in SOURCES)
+        owners = [User.objects.create(username=f'plan{n}') for n in range(cls.users)]
+        cls.user = owners[0]
+        start = datetime.date(2022, 1, 1)
+        expenses = []
+        incomes = []
+        for owner in owners:
+            for n in range(cls.rows_per_user):
+                date = start + datetime.timedelta(days=(n * 7 + owner.pk) % 900)
+                expenses.append(Expense(owner=owner, amount_minor=n % 97 * 100 + 50, currency='USD', date=date,
+                                        description=f'expense {n}', category=categories[n % len(categories)]))
+                if n % 3 == 0:
+                    incomes.append(UserIncome(owner=owner, amount_minor=(n + 100) * 100, currency='USD', date=date,
+                                              description=f'income {n}', source=sources[n % len(sources)]))
+        Expense.objects.bulk_create(expenses, batch_size=1000)
+        UserIncome.objects.bulk_create(incomes, batch_size=1000)
+        rollups.rebuild()
+        counters.rebuild()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        # The list pages would be served from fragments cached by earlier tests
+        fragments.cache().clear()
+        forget_choices()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute('SET enable_sort = off')
+
+    def capture(self, method, url, **kwargs):
+        """Request ``url`` and return the SQL of the queries touching the listed tables."""
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(url, **kwargs)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, url)
+        # Server-side cursors (QuerySet.iterator on PostgreSQL) show up as DECLARE ... FOR SELECT
+        queries = [re.sub(r'^DECLARE .*? CURSOR .*?FOR (?=SELECT)', '', query['sql'])
+                   for query in captured.captured_queries]
+        queries = [sql for sql in queries
+                   if sql.startswith('SELECT') and any(table in sql for table in self.tables)]
+        self.assertTrue(queries, f'{url} ran no queries against {self.tables}')
+        return queries
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return '\n'.join(row[-1] for row in cursor.fetchall())
+            cursor.execute(f'EXPLAIN {sql}')
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def assertIndexedPlans(self, method, url, **kwargs):
+        for sql in self.capture(method, url, **kwargs):
+            plan = self.explain(sql)
+            for table in self.tables:
+                if connection.vendor == 'sqlite':
+                    scans = re.findall(rf'\bSCAN {table}\b(.*)', plan)
+                    self.assertFalse([scan for scan in scans if 'INDEX' not in scan],
+                                     f'Full scan of {table} for {url}:\n{sql}\n{plan}')
+                else:
+                    self.assertNotIn(f'Seq Scan on {table}', plan, f'Full scan for {url}:\n{sql}\n{plan}')
+            if connection.vendor == 'sqlite':
+                self.assertNotIn('TEMP B-TREE FOR ORDER BY', plan, f'Sort for {url}:\n{sql}\n{plan}')
+            elif ' LIMIT ' in sql:
+                self.assertNotRegex(plan, r'(?m)^\s*(->\s*)?Sort\b', f'Sort for {url}:\n{sql}\n{plan}')
+
+
+class ExpenseQueryPlanTests(QueryPlanTestCase):
+    def test_list_pages(self):
+        self.assertIndexedPlans('get', '/')
+        html = self.client.get('/?per_page=10').content.decode()
+        for label in ('Next', str(self.rows_per_user // 10)):
+            link = re.search(rf'href="([^"]*)"\s*>{label}', html).group(1).replace('&amp;', '&')
+            self.assertIndexedPlans('get', '/' + link)
+
+    def test_category_summary(self):
+        self.assertIndexedPlans('get', '/expense_category_summary?start=2022-01-15&end=2023-06-20')
+
+    def test_filtered_search(self):
+        for text in ('category:food', 'date:2022-03', 'category:rent date:2022-01..2022-06'):
+            self.assertIndexedPlans('post', '/search-expenses', data={'searchText': text},
+                                    content_type='application/json')
+
+    def test_exports(self):
+        for url in ('/export-csv', '/export-csv?start=2022-01-01&end=2022-12-31', '/export-csv?q=category:fun'):
+            self.assertIndexedPlans('get', url)
+
+
+class MoneyTests(SimpleTestCase):
+    def test_to_minor_rounds_half_up_per_currency(self):
+        self.assertEqual(money.to_minor('19.995', 'USD'), 2000)
+        self.assertEqual(money.to_minor('0.1', 'USD'), 10)
+        self.assertEqual(money.to_minor('1234.5', 'JPY'), 1235)
+        self.assertEqual(money.to_minor('1.2345', 'KWD'), 1235)
+
+    def test_to_minor_rejects_non_amounts(self):
+        for value in ('', 'abc', 'NaN', 'Infinity', '1e400', '12,50'):
+            with self.assertRaises(ValueError):
+                money.to_minor(value, 'USD')
+
+    def test_from_minor_keeps_currency_precision(self):
+        self.assertEqual(str(money.from_minor(5, 'USD')), '0.05')
+        self.assertEqual(str(money.from_minor(5, 'JPY')), '5')
+        self.assertEqual(money.from_minor(10, 'USD') + money.from_minor(20, 'USD'), Decimal('0.30'))
+
+    def test_currency_code(self):
+        self.assertEqual(money.currency_code('EUR - Euro'), 'EUR')
+        self.assertEqual(money.currency_code(None), 'USD')
+
+
+class QueryTests(SimpleTestCase):
+    def conditions(self, text):
+        return [(c.field, c.lookup, c.value) for c in query.parse(text).conditions]
+
+    def test_amount_terms(self):
+        self.assertEqual(self.conditions('amount:12.50'), [('amount', 'exact', Decimal('12.50'))])
+        self.assertEqual(self.conditions('amount >= 100'), [('amount', 'gte', Decimal('100'))])
+        self.assertEqual(self.conditions('amount:<5'), [('amount', 'lt', Decimal('5'))])
+        self.assertEqual(self.conditions('amount:50..200'),
+                         [('amount', 'gte', Decimal('50')), ('amount', 'lte', Decimal('200'))])
+        self.assertEqual(self.conditions('amount:..20'), [('amount', 'lte', Decimal('20'))])
+
+    def test_date_terms(self):
+        d = datetime.date
+        self.assertEqual(self.conditions('date:2024'), [('date', 'gte', d(2024, 1, 1)), ('date', 'lt', d(2025, 1, 1))])
+        self.assertEqual(self.conditions('date:2024-12'),
+                         [('date', 'gte', d(2024, 12, 1)), ('date', 'lt', d(2025, 1, 1))])
+        self.assertEqual(self.conditions('date:2024-02-29'),
+                         [('date', 'gte', d(2024, 2, 29)), ('date', 'lt', d(2024, 3, 1))])
+        self.assertEqual(self.conditions('date:2024-01..2024-03'),
+                         [('date', 'gte', d(2024, 1, 1)), ('date', 'lt', d(2024, 4, 1))])
+        self.assertEqual(self.conditions('date:>2024-06'), [('date', 'gte', d(2024, 7, 1))])
+        self.assertEqual(self.conditions('date:<=2024-06'), [('date', 'lt', d(2024, 7, 1))])
+        self.assertEqual(self.conditions('Sept 2024'), [('date', 'gte', d(2024, 9, 1)), ('date', 'lt', d(2024, 10, 1))])
+
+    def test_key_terms_and_free_text(self):
+        parsed = query.parse('coffee category:"eating out" beans amount:')
+        self.assertEqual(self.conditions('category:"eating out"'), [('category', 'exact', 'eating out')])
+        self.assertEqual((parsed.text, parsed.has_filters, parsed.errors), ('coffee beans', True, ()))
+        self.assertFalse(query.parse('coffee amount:').has_filters)
+
+    def test_bad_terms_are_reported(self):
+        parsed = query.parse('amount:lots date:2024-13 category:>food taxi')
+        self.assertEqual(parsed.errors, ('"lots" is not an amount',
+                                         '"2024-13" is not a date (use YYYY, YYYY-MM or YYYY-MM-DD)',
+                                         'category only supports exact matches'))
+        self.assertEqual((parsed.conditions, parsed.text), ((), 'taxi'))
+
+    def test_compile_query(self):
+        def categories():
+            return [(1, 'Food'), (2, 'Rent'), (3, 'food')]
+        # Names in any case; fields not given are left out
+        compiled = query.compile_query(query.parse('category:FOOD date:2024 source:salary'),
+                                       query.EXPENSE_FIELDS, {'category': categories})
+        self.assertEqual(compiled, Q(category__in=[1, 3]) &
+                         Q(date__gte=datetime.date(2024, 1, 1)) & Q(date__lt=datetime.date(2025, 1, 1)))
+        self.assertEqual(query.compile_query(query.parse('category:boats'), query.EXPENSE_FIELDS,
+                                             {'category': categories}), Q(category__in=[]))
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='rollups')
+        self.other = User.objects.create(username='rollups-other')
+        self.client.force_login(self.user)
+        self.food, self.rent = shared(Category, 'Food'), shared(Category, 'Rent')
+
+    def expense(self, amount_minor, date, category, currency='USD', description='lunch'):
+        return Expense.objects.create(owner=self.user, amount_minor=amount_minor, currency=currency, date=date,
+                                      description=description, category=category)
+
+    def rollup_rows(self):
+        return sorted(ExpenseRollup.objects.values_list('owner_id', 'month', 'category_id', 'currency',
+                                                        'total_minor', 'count'))
+
+    def assert_matches_rebuild(self):
+        # What the signals kept up, after checking it against a rebuild from the expenses
+        maintained = self.rollup_rows()
+        rollups.rebuild()
+        self.assertEqual(maintained, self.rollup_rows())
+        return maintained
+
+    def test_writes_keep_the_rollups_in_step(self):
+        january, february = datetime.date(2024, 1, 1), datetime.date(2024, 2, 1)
+        lunch = self.expense(1000, datetime.date(2024, 1, 31), self.food)
+        snack = self.expense(250, datetime.date(2024, 1, 5), self.food)
+        self.expense(300, datetime.date(2024, 1, 6), self.food, currency='EUR')
+        self.assertEqual(self.assert_matches_rebuild(), [
+            (self.user.pk, january, self.food.pk, 'EUR', 300, 1),
+            (self.user.pk, january, self.food.pk, 'USD', 1250, 2)])
+
+        # The edit form assigns the posted strings: a new amount, month and category
+        response = self.client.post(f'/edit-expense/{lunch.pk}/', {'amount': '12.00', 'description': 'lunch',
+                                                                   'date': '2024-02-01', 'category': self.rent.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.assert_matches_rebuild(), [
+            (self.user.pk, january, self.food.pk, 'EUR', 300, 1),
+            (self.user.pk, january, self.food.pk, 'USD', 250, 1),
+            (self.user.pk, february, self.rent.pk, 'USD', 1200, 1)])
+
+        lunch.refresh_from_db()
+        lunch.owner = self.other
+        lunch.save()
+        self.assertEqual(self.assert_matches_rebuild(), [
+            (self.user.pk, january, self.food.pk, 'EUR', 300, 1),
+            (self.user.pk, january, self.food.pk, 'USD', 250, 1),
+            (self.other.pk, february, self.rent.pk, 'USD', 1200, 1)])
+
+        # Months left without expenses lose their row
+        self.client.get(f'/delete-expense/{snack.pk}')
+        lunch.delete()
+        self.assertEqual(self.assert_matches_rebuild(), [(self.user.pk, january, self.food.pk, 'EUR', 300, 1)])
+
+    def test_category_totals_add_partial_months_to_whole_ones(self):
+        days = [datetime.date(2024, 1, 10), datetime.date(2024, 1, 31), datetime.date(2024, 2, 15),
+                datetime.date(2024, 3, 1), datetime.date(2024, 3, 20)]
+        for n, day in enumerate(days):
+            self.expense(100 * (n + 1), day, self.food if n % 2 else self.rent)
+        start, end = datetime.date(2024, 1, 20), datetime.date(2024, 3, 10)
+        expected = {}
+        for category_id, total in (Expense.objects.filter(owner=self.user, date__range=(start, end))
+                                   .values_list('category_id').annotate(Sum('amount_minor'))):
+            expected[category_id, 'USD'] = total
+        self.assertEqual(dict(rollups.category_totals(self.user.pk, start, end)), expected)
+        self.assertEqual(rollups.category_totals(self.user.pk, end, start), {})
+
+
+class RateTests(TestCase):
+    def setUp(self):
+        # Series read by earlier tests are kept under the same, rolled back, version
+        rates._series.cache_clear()
+        ExchangeRate.objects.bulk_create([
+            ExchangeRate(currency='EUR', date=datetime.date(2024, 1, 1), rate=Decimal('0.5')),
+            ExchangeRate(currency='EUR', date=datetime.date(2024, 2, 1), rate=Decimal('0.8')),
+            ExchangeRate(currency='JPY', date=datetime.date(2024, 1, 1), rate=Decimal('150')),
+        ])
+
+    def test_convert_uses_latest_rate_on_or_before_date(self):
+        converted, missing = rates.convert(
+            [1000, 1000, 1000, 300, 1000, 555],
+            ['EUR', 'EUR', 'EUR', 'JPY', 'EUR', 'USD'],
+            [datetime.date(2024, 1, 15), datetime.date(2024, 2, 1), datetime.date(2024, 6, 1),
+             datetime.date(2024, 3, 3), datetime.date(2023, 12, 31), datetime.date(2020, 1, 1)], 'USD')
+        self.assertEqual(converted.tolist(), [2000, 1250, 1250, 200, 0, 555])
+        self.assertEqual(missing.tolist(), [False, False, False, False, True, False])
+
+    def test_convert_between_non_base_currencies(self):
+        converted, missing = rates.convert([1000], ['EUR'], [datetime.date(2024, 1, 2)], 'JPY')
+        self.assertEqual(converted.tolist(), [3000])
+        self.assertFalse(missing.any())
+
+    def test_rates_are_read_once_per_currency(self):
+        dates = [datetime.date(2024, 1, 1) + datetime.timedelta(days=n % 60) for n in range(10000)]
+        rates.convert([100, 100], ['EUR', 'JPY'], dates[:2], 'USD')
+        # Only the rate table's version
+        with self.assertNumQueries(1):
+            rates.convert([100] * 10000, ['EUR', 'JPY'] * 5000, dates, 'USD')
+
+    def test_import_replaces_rates_and_invalidates(self):
+        rates.convert([100], ['EUR'], [datetime.date(2024, 1, 1)], 'USD')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write('Date,EUR,GBP\n2024-01-01,0.25,N/A\n2024-01-02,0.4,0.75\n')
+        try:
+            call_command('import_exchange_rates', csv_file.name, stdout=open(os.devnull, 'w'))
+        finally:
+            os.remove(csv_file.name)
+        self.assertEqual(ExchangeRate.objects.count(), 5)
+        converted, _ = rates.convert([100, 75], ['EUR', 'GBP'], [datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)],
+                                     'USD')
+        self.assertEqual(converted.tolist(), [400, 100])
+
+    def test_saved_rates_move_the_stored_version(self):
+        # As from the admin; the series read before must not be used again
+        rates.convert([100], ['EUR'], [datetime.date(2024, 1, 1)], 'USD')
+        version = rates.version()
+        rate = ExchangeRate.objects.get(currency='EUR', date=datetime.date(2024, 1, 1))
+        rate.rate = Decimal('0.25')
+        rate.save()
+        self.assertEqual(rates.version(), version + 1)
+        converted, _ = rates.convert([100], ['EUR'], [datetime.date(2024, 1, 1)], 'USD')
+        self.assertEqual(converted.tolist(), [400])
+        rate.delete()
+        _, missing = rates.convert([100], ['EUR'], [datetime.date(2024, 1, 1)], 'USD')
+        self.assertTrue(missing.all())
+
+    def test_import_rejects_bad_rows(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write('date,currency,rate\n2024-01-01,EUR,0.9\n2024-01-02,XXX,1\n')
+        try:
+            with self.assertRaisesMessage(CommandError, 'Line 3'):
+                call_command('import_exchange_rates', csv_file.name)
+        finally:
+            os.remove(csv_file.name)
+        self.assertEqual(ExchangeRate.objects.count(), 3)
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='pages')
+        food = shared(Category, 'Food')
+        # Seven rows over four days, so pages split rows of the same date
+        for n, day in enumerate([1, 1, 1, 2, 2, 3, 4]):
+            Expense.objects.create(owner=self.user, amount_minor=n + 1, currency='USD',
+                                   date=datetime.date(2024, 3, day), description=f'row {n + 1}', category=food)
+        self.expenses = Expense.objects.filter(owner=self.user)
+        self.newest_first = list(self.expenses.order_by('-date', '-id').values_list('amount_minor', flat=True))
+
+    def follow(self, query, per_page=3):
+        cursor = parse_qs(query.lstrip('?')).get('cursor', [None])[0]
+        page = pagination.paginate(self.expenses, 7, cursor, per_page)
+        return page, [row.amount_minor for row in page]
+
+    def test_links_walk_the_pages_both_ways(self):
+        first, rows = self.follow('')
+        self.assertEqual((first.number, first.num_pages, first.has_previous, first.has_next), (1, 3, False, True))
+        self.assertEqual(rows, self.newest_first[:3])
+        second, rows = self.follow(first.next_query)
+        self.assertEqual((second.number, rows), (2, self.newest_first[3:6]))
+        third, rows = self.follow(second.next_query)
+        self.assertEqual((third.number, third.has_next, rows), (3, False, self.newest_first[6:]))
+
+        back, rows = self.follow(third.previous_query)
+        self.assertEqual((back.number, back.has_previous, back.has_next), (2, True, True))
+        self.assertEqual(rows, self.newest_first[3:6])
+        self.assertEqual(back.previous_query, back.first_query)
+        self.assertEqual(self.follow(back.previous_query)[1], self.newest_first[:3])
+
+        last, rows = self.follow(first.last_query)
+        self.assertEqual((last.number, last.has_previous, last.has_next), (3, True, False))
+        self.assertEqual(rows, self.newest_first[6:])
+        self.assertEqual(self.follow(last.previous_query)[1], self.newest_first[3:6])
+
+    def test_page_size_carries_over(self):
+        page, rows = self.follow('', per_page=5)
+        self.assertIn('per_page=5', page.next_query)
+        self.assertEqual(self.follow(page.next_query, per_page=5)[1], self.newest_first[5:])
+
+    def test_bad_cursors_show_the_first_page(self):
+        page, first = self.follow('')
+        cursor = parse_qs(page.next_query.lstrip('?'))['cursor'][0]
+        forged = signing.dumps(['next', 2, '2024-03-02', 1], salt='another salt')
+        for cursor in ['garbage', cursor[:-2], forged,
+                       signing.dumps(['next', 2, 'March', 1], salt=pagination.CURSOR_SALT)]:
+            page = pagination.paginate(self.expenses, 7, cursor, 3)
+            self.assertEqual(([row.amount_minor for row in page], page.number), (first, 1), cursor)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/', {'cursor': 'garbage'}).status_code, 200)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='searcher')
+        self.client.force_login(self.user)
+        travel = shared(Category, 'Travel')
+        for description in ['taxi', 'taxi taxi taxi', 'airport taxi', 'bus', 'taxi home', 'late taxi']:
+            Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 3, 1),
+                                   description=description, category=travel)
+
+    def search(self, **params):
+        response = self.client.get('/search-expenses', {'searchText': 'taxi', **params})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [row['description'] for row in data['results']], data['next']
+
+    def test_amounts_match_in_each_rows_currency(self):
+        owner = User.objects.create(username='travelling')
+        UserPreference.objects.create(user=owner, currency='USD - United States Dollar')
+        travel = Category.objects.get(name='Travel')
+        for currency, amount_minor in [('USD', 10000), ('JPY', 100), ('JPY', 10000), ('KWD', 100000),
+                                       ('EUR', 1250), ('JPY', 12), ('JPY', 13)]:
+            Expense.objects.create(owner=owner, amount_minor=amount_minor, currency=currency,
+                                   date=datetime.date(2024, 3, 1), description='fare', category=travel)
+
+        def matches(text):
+            rows = filters.filter_expenses(owner, query.parse(text)).values_list('currency', 'amount_minor')
+            return sorted(rows)
+
+        self.assertEqual(matches('amount:100'), [('JPY', 100), ('KWD', 100000), ('USD', 10000)])
+        # No yen amount is 12.5; either side of it compares as expected
+        self.assertEqual(matches('amount:12.5'), [('EUR', 1250)])
+        self.assertEqual(matches('amount:>12.5 amount:<1000'),
+                         [('JPY', 13), ('JPY', 100), ('KWD', 100000), ('USD', 10000)])
+        self.assertEqual(matches('amount:<=12.5'), [('EUR', 1250), ('JPY', 12)])
+        # Finer than any currency's minor unit
+        self.assertEqual(matches('amount:0.00001'), [])
+
+    def test_pages_continue_the_ranking(self):
+        ranked, cursor = self.search()
+        self.assertEqual(ranked[0], 'taxi taxi taxi')
+        self.assertEqual(sorted(ranked), ['airport taxi', 'late taxi', 'taxi', 'taxi home', 'taxi taxi taxi'])
+        self.assertIsNone(cursor)
+
+        paged = []
+        while True:
+            page, cursor = self.search(limit=2, **({'cursor': cursor} if cursor else {}))
+            self.assertLessEqual(len(page), 2)
+            paged += page
+            if cursor is None:
+                break
+        self.assertEqual(paged, ranked)
+
+    def test_tampered_cursors_are_refused(self):
+        _, cursor = self.search(limit=2)
+        score, pk = search.load_cursor(cursor)
+        forged = signing.dumps([score, pk + 1], salt='another salt', compress=True)
+        for bad in [cursor[:-2] + ('AA' if cursor[-2:] != 'AA' else 'BB'), forged, json.dumps([score, pk]),
+                    search.dump_cursor(['nan?', pk])]:
+            response = self.client.get('/search-expenses', {'searchText': 'taxi', 'cursor': bad})
+            self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid cursor'}), bad)
+
+
+class CategoryKeyTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='keys')
+        self.client.force_login(self.user)
+
+    def test_renaming_a_category_leaves_expenses_alone(self):
+        food = shared(Category, 'Food')
+        Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 3, 1),
+                               description='lunch', category=food)
+        with CaptureQueriesContext(connection) as captured:
+            Category.objects.filter(pk=food.pk).update(name='Groceries')
+            Category.objects.get(pk=food.pk).save()
+        self.assertFalse([query for query in captured.captured_queries if 'expenses_expense"' in query['sql']])
+        response = self.client.get('/search-expenses', {'searchText': 'category:groceries'})
+        self.assertEqual([row['category'] for row in response.json()['results']], ['Groceries'])
+
+    def test_free_text_matches_category_names(self):
+        food, rent = shared(Category, 'Food'), shared(Category, 'Rent')
+        eating_out = Category.objects.create(owner=self.user, name='Eating out')
+        for description, category in (('groceries', food), ('food for the party', rent), ('rent', rent),
+                                      ('pizza', eating_out), ('out of office lunch', food)):
+            Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 3, 1),
+                                   description=description, category=category)
+
+        def found(text):
+            response = self.client.get('/search-expenses', {'searchText': text})
+            return [row['description'] for row in response.json()['results']]
+
+        # The description match first, then the rows filed under Food
+        self.assertEqual(found('foo'), ['food for the party', 'out of office lunch', 'groceries'])
+        self.assertEqual(found('eating out'), ['pizza'])
+        self.assertEqual(found('out lunch'), ['out of office lunch'])
+        self.assertEqual(found('groceries food'), ['groceries'])
+        self.assertEqual(sorted(expense.description for expense in filters.searched_expenses(self.user, 'food')),
+                         ['food for the party', 'groceries', 'out of office lunch'])
+
+    def test_own_categories_are_offered_to_their_owner_only(self):
+        other = User.objects.create(username='other')
+        mine = Category.objects.create(owner=self.user, name='Climbing')
+        theirs = Category.objects.create(owner=other, name='Sailing')
+        shared(Category, 'Food')
+        names = [choice.name for choice in reference.categories(self.user.id)]
+        self.assertIn('Climbing', names)
+        self.assertNotIn('Sailing', names)
+        values = {'amount': '12', 'description': 'rope', 'date': '2024-03-01'}
+        response = self.client.post('/add-expense', {**values, 'category': theirs.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Expense.objects.exists())
+        response = self.client.post('/add-expense', {**values, 'category': mine.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Expense.objects.get().category, mine)
+
+
+class ReferenceCacheTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='reference')
+        self.client.force_login(self.user)
+        shared(Category, 'Food')
+        shared(Source, 'Salary')
+
+    def test_repeated_page_loads_read_each_version_once(self):
+        # Session and user, then the user's data version and the reference
+        # versions, one read each however many keys use them
+        for url, queries in [('/', 4), ('/add-expense', 3), ('/income/income', 4), ('/income/add-income/', 3),
+                             ('/preferences/', 3)]:
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+            with self.assertNumQueries(queries):
+                self.assertEqual(self.client.get(url).status_code, 200, url)
+
+    def test_a_request_rereads_the_versions_it_bumps(self):
+        seen = []
+
+        def view(request):
+            with self.assertNumQueries(2):
+                seen.extend([versioning.current(self.user.id), versioning.current(self.user.id),
+                             reference.version('categories'), reference.version('sources')])
+            versioning.bump(self.user.id)
+            Category.objects.create(owner=self.user, name='Climbing')
+            seen.extend([versioning.current(self.user.id), reference.version('categories')])
+            return HttpResponse()
+
+        versioning.VersionMiddleware(view)(RequestFactory().get('/'))
+        data, categories = seen[0], seen[2]
+        self.assertEqual(seen, [data, data, categories, seen[3], data + 1, categories + 1])
+
+    def test_changes_move_the_stored_versions(self):
+        # Keys come from the database, so the change reaches every process
+        # without a signal to their caches
+        self.assertEqual(reference.user_currency_code(self.user.id), settings.DEFAULT_CURRENCY)
+        self.client.post('/preferences/', {'currency': 'EUR - Euro'})
+        self.assertEqual(reference.user_currency_code(self.user.id), 'EUR')
+        version = reference.version('categories')
+        self.assertNotIn('Climbing', [choice.name for choice in reference.categories(self.user.id)])
+        Category.objects.create(owner=self.user, name='Climbing')
+        self.assertEqual(reference.version('categories'), version + 1)
+        self.assertIn('Climbing', [choice.name for choice in reference.categories(self.user.id)])
+
+
+STATEMENT ="""Date,Amount,Description,Category
+2024-03-01,-12.50,Coffee shop,food
+2024-03-01,-12.50,coffee  SHOP,
+2024-03-02,2500.00,Salary March,
+2024-03-03,-40,"Tab\there, back\\slash",Rent
+2024-03-04,nothing,Broken,
+2024-03-05,-3,Unknown,Boats
+"""
+
+SGML_OFX = """OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><CURDEF>EUR
+<BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240301120000[-5:EST]<TRNAMT>-7,25<FITID>1<NAME>Bakery &amp; Co<MEMO>card 1234
+</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240302<TRNAMT>100.00<FITID>2<NAME>Refund
+</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='imports')
+        self.client.force_login(self.user)
+        self.food, self.bills = shared(Category, 'Food'), shared(Category, 'Bills')
+        shared(Category, 'Rent')
+        self.salary = shared(Source, 'Salary')
+
+    def run_import(self, text, format='csv', **options):
+        rows = imports.read(io.StringIO(text), format, **options)
+        return imports.run(self.user.pk, rows, self.bills.pk, self.salary.pk)
+
+    def test_csv_rows_become_expenses_and_incomes_once(self):
+        # One of the statement's two coffees, entered by hand before it came in
+        Expense.objects.create(owner=self.user, amount_minor=1250, currency='USD', date=datetime.date(2024, 3, 1),
+                               description='Coffee shop', category=self.food)
+        summary = self.run_import(STATEMENT, columns={'label': 'category'})
+        self.assertEqual(summary, {'rows': 6, 'expenses': 2, 'incomes': 1, 'duplicates': 1, 'rejected': 2,
+                                   'errors': [{'line': 6, 'error': 'amount not understood'},
+                                              {'line': 7, 'error': "unknown category 'Boats'"}]})
+        imported = Expense.objects.get(owner=self.user, amount_minor=4000)
+        self.assertEqual((imported.description, imported.category.name), ('Tab\there, back\\slash', 'Rent'))
+        self.assertEqual(UserIncome.objects.get(owner=self.user).source, self.salary)
+        self.assertEqual(counters.get(self.user.pk, 'expenses'), 3)
+        self.assertEqual(counters.get(self.user.pk, 'incomes'), 1)
+        applied = sorted(ExpenseRollup.objects.values_list('category_id', 'total_minor', 'count'))
+        rollups.rebuild()
+        self.assertEqual(applied, sorted(ExpenseRollup.objects.values_list('category_id', 'total_minor', 'count')))
+
+        with override_settings(IMPORT_CHUNK_SIZE=2):
+            summary = self.run_import(STATEMENT, columns={'label': 'category'})
+        self.assertEqual((summary['expenses'], summary['incomes'], summary['duplicates']), (0, 0, 4))
+
+    def test_identical_rows_are_kept_and_imported_once(self):
+        lines = ['date,amount,description'] + ['2024-03-01,-3.00,Coffee'] * 3 + ['2024-03-01,3.00,Coffee']
+        with override_settings(IMPORT_CHUNK_SIZE=2):
+            summary = self.run_import('\n'.join(lines))
+        self.assertEqual((summary['expenses'], summary['incomes'], summary['duplicates']), (3, 1, 0))
+        self.assertEqual(len(set(Expense.objects.filter(owner=self.user).values_list('content_hash', flat=True))), 3)
+        with override_settings(IMPORT_CHUNK_SIZE=1):
+            summary = self.run_import('\n'.join(lines))
+        self.assertEqual((summary['expenses'], summary['incomes'], summary['duplicates']), (0, 0, 4))
+        # A corrected statement showing six coffees that day: three are new
+        summary = self.run_import('\n'.join(lines[:1] + lines[1:4] * 2))
+        self.assertEqual((summary['expenses'], summary['duplicates']), (3, 3))
+
+    def test_ofx_statements_in_any_chunking(self):
+        elements = list(imports._ofx_elements(io.StringIO(SGML_OFX)))
+        self.assertEqual(list(imports._ofx_elements(io.StringIO(SGML_OFX), size=5)), elements)
+        rows = list(imports.read(io.StringIO(SGML_OFX), 'ofx'))
+        self.assertEqual([(row.line, row.date, row.amount, row.description, row.currency) for row in rows], [
+            (6, datetime.date(2024, 3, 1), '-7.25', 'Bakery & Co card 1234', 'EUR'),
+            (8, datetime.date(2024, 3, 2), '100.00', 'Refund', 'EUR')])
+        summary = self.run_import(SGML_OFX, 'ofx')
+        self.assertEqual((summary['expenses'], summary['incomes']), (1, 1))
+        self.assertEqual(Expense.objects.get(owner=self.user).currency, 'EUR')
+
+    def test_upload_and_command(self):
+        statement = io.BytesIO(STATEMENT.encode())
+        statement.name = 'march.csv'
+        response = self.client.post('/import-statement', {'statement': statement, 'category': self.bills.pk,
+                                                          'label_column': 'category'})
+        self.assertEqual(response.json()['expenses'], 3)
+        response = self.client.post('/import-statement', {'statement': io.BytesIO(b'when,what\n'),
+                                                          'format': 'csv'})
+        self.assertEqual(response.status_code, 400)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.ofx', delete=False) as statement:
+            statement.write(SGML_OFX)
+        self.addCleanup(os.remove, statement.name)
+        out = io.StringIO()
+        call_command('import_statement', statement.name, user='imports', category='food', source='salary', stdout=out)
+        self.assertIn('Imported 1 expenses and 1 incomes from 2 rows', out.getvalue())
+        with self.assertRaisesMessage(CommandError, "No category named 'boats'"):
+            call_command('import_statement', statement.name, user='imports', category='boats')
+
+
+def xlsx_sheets(data):
+    # {title: rows} of a workbook, strings as str and numbers (dates too) as float
+    main = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        workbook = ElementTree.fromstring(book.read('xl/workbook.xml'))
+        titles = [sheet.get('name') for sheet in workbook.iter(f'{main}sheet')]
+        sheets = {}
+        for number, title in enumerate(titles, 1):
+            rows = ElementTree.fromstring(book.read(f'xl/worksheets/sheet{number}.xml')).iter(f'{main}row')
+            sheets[title] = [[cell.findtext(f'{main}is/{main}t') if cell.get('t') == 'inlineStr'
+                              else float(cell.findtext(f'{main}v')) for cell in row.iter(f'{main}c')] for row in rows]
+        return sheets
+
+
+def excel_day(day):
+    return float((day - datetime.date(1899, 12, 30)).days)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='exports')
+        self.client.force_login(self.user)
+        food, rent = shared(Category, 'Food'), shared(Category, 'Rent')
+        for amount, currency, day, description, category in [
+                (1250, 'USD', datetime.date(2024, 3, 1), 'lunch, with "friends"', food),
+                (90000, 'USD', datetime.date(2024, 3, 2), 'March rent', rent),
+                (500, 'JPY', datetime.date(2023, 12, 31), 'onigiri', food)]:
+            Expense.objects.create(owner=self.user, amount_minor=amount, currency=currency, date=day,
+                                   description=description, category=category)
+
+    def test_csv_is_streamed_newest_first(self):
+        response = self.client.get('/export-csv')
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="Expenses', response['Content-Disposition'])
+        chunks = iter(response.streaming_content)
+        # The header goes out before the query runs
+        with self.assertNumQueries(0):
+            header = next(chunks)
+        self.assertEqual(header, b'Amount,Currency,Description,Category,Date,Amount (USD)\r\n')
+        rows = list(csv.reader(io.StringIO(b''.join(chunks).decode())))
+        self.assertEqual(rows, [['900.00', 'USD', 'March rent', 'Rent', '2024-03-02', '900.00'],
+                                ['12.50', 'USD', 'lunch, with "friends"', 'Food', '2024-03-01', '12.50'],
+                                ['500', 'JPY', 'onigiri', 'Food', '2023-12-31', '']])
+
+    def test_csv_filters_and_flushes_in_chunks(self):
+        with mock.patch.object(exports, 'CSV_FLUSH_BYTES', 1):
+            response = self.client.get('/export-csv', {'q': 'category:food', 'start': '2024-01-01',
+                                                       'end': '2024-12-31'})
+            chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[1].decode().split(',')[:2], ['12.50', 'USD'])
+
+
+    def test_xlsx_cells_keep_their_types(self):
+        UserIncome.objects.create(owner=self.user, amount_minor=250000, currency='USD', description='pay',
+                                  date=datetime.date(2024, 3, 1), source=shared(Source, 'Salary'))
+        response = self.client.get('/export-excel')
+        sheets = xlsx_sheets(b''.join(response.streaming_content))
+        self.assertEqual(list(sheets), ['Expenses', 'Incomes'])
+        self.assertEqual(sheets['Expenses'], [
+            ['Amount', 'Currency', 'Description', 'Category', 'Date', 'Amount (USD)'],
+            [900.0, 'USD', 'March rent', 'Rent', excel_day(datetime.date(2024, 3, 2)), 900.0],
+            [12.5, 'USD', 'lunch, with "friends"', 'Food', excel_day(datetime.date(2024, 3, 1)), 12.5],
+            # No rate: the converted cell is left empty rather than written
+            [500.0, 'JPY', 'onigiri', 'Food', excel_day(datetime.date(2023, 12, 31))]])
+        self.assertEqual(sheets['Incomes'][1], [2500.0, 'USD', 'pay', 'Salary', excel_day(datetime.date(2024, 3, 1)),
+                                                2500.0])
+
+    def test_xlsx_splits_long_sheets_by_year(self):
+        with override_settings(EXPORT_XLSX_SPLIT_ROWS=2):
+            response = self.client.get('/export-excel')
+            sheets = xlsx_sheets(b''.join(response.streaming_content))
+        self.assertEqual(list(sheets), ['Expenses 2024', 'Expenses 2023', 'Incomes'])
+        self.assertEqual([len(rows) for rows in sheets.values()], [3, 2, 1])
+        self.assertEqual(sheets['Expenses 2023'][1][2], 'onigiri')
+
+
+class ReportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='reports')
+        self.client.force_login(self.user)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(EXPORT_CACHE_DIR=directory.name))
+        for n, name in enumerate(['Food', 'Rent', 'Food']):
+            Expense.objects.create(owner=self.user, amount_minor=100 + n, currency='USD',
+                                   date=datetime.date(2024, 3, 1 + n), description=f'row {n}',
+                                   category=shared(Category, name))
+
+    def test_detail_rows_are_laid_out_as_they_are_read(self):
+        alive = []
+
+        def more():
+            for n in range(300):
+                alive.append(list.__len__(story))
+                yield reports.Paragraph(f'row {n}')
+        story = reports._Story([], more(), ahead=4)
+        reports.SimpleDocTemplate(io.BytesIO()).build(story)
+        self.assertEqual(len(alive), 300)
+        self.assertLessEqual(max(alive), 4)
+
+        read = []
+        path = os.path.join(settings.EXPORT_CACHE_DIR, 'report.pdf')
+        with mock.patch.object(reports, 'TABLE_CHUNK_ROWS', 1):
+            reports.render_expense_report(path, Expense.objects.filter(owner=self.user), {}, read.append)
+        self.assertEqual(sum(read), 3)
+        with open(path, 'rb') as report:
+            self.assertEqual(report.read(5), b'%PDF-')
+
+    def test_reports_are_cached_per_data_version(self):
+        def download(**params):
+            response = self.client.get('/export-pdf', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content)[:5], b'%PDF-')
+
+        with mock.patch.object(reports, 'render_expense_report', wraps=reports.render_expense_report) as render:
+            download()
+            download()
+            self.assertEqual(render.call_count, 1)
+            download(start='2024-03-02', end='2024-03-31')
+            self.assertEqual(render.call_count, 2)
+            self.assertEqual(len(os.listdir(settings.EXPORT_CACHE_DIR)), 2)
+
+            Expense.objects.create(owner=self.user, amount_minor=5, currency='USD', description='late',
+                                   date=datetime.date(2024, 3, 9), category=shared(Category, 'Food'))
+            download()
+            download()
+            self.assertEqual(render.call_count, 3)
+        # Files of the older version go when the new one is rendered
+        version = versioning.current(self.user.pk)
+        self.assertEqual([name.split('-')[2] for name in os.listdir(settings.EXPORT_CACHE_DIR)], [str(version)])
+
+    def test_long_reports_are_queued_as_jobs(self):
+        with override_settings(EXPORT_PDF_INLINE_ROWS=2):
+            response = self.client.get('/export-pdf')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('no-store', response['Cache-Control'])
+        job = ExportJob.objects.get(owner=self.user)
+        self.assertEqual((response.json()['id'], job.format, job.status), (job.pk, 'pdf', ExportJob.PENDING))
+        with override_settings(EXPORT_PDF_INLINE_ROWS=3):
+            response = self.client.get('/export-pdf')
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'application/pdf'))
+        b''.join(response.streaming_content)
+
+
+class ExportJobTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='jobs')
+        self.client.force_login(self.user)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(EXPORT_JOB_DIR=directory.name))
+        for day in range(1, 4):
+            Expense.objects.create(owner=self.user, amount_minor=100 * day, currency='USD', description=f'day {day}',
+                                   date=datetime.date(2024, 3, day), category=shared(Category, 'Food'))
+
+    def submit(self, format='csv', **params):
+        response = self.client.post(f'/export-jobs/{format}' + (f'?{urlencode(params)}' if params else ''))
+        return response.status_code, response.json()
+
+    def test_requests_for_the_same_export_share_a_job(self):
+        status, job = self.submit()
+        self.assertEqual((status, job['status'], job['download_url']), (201, 'pending', None))
+        self.assertEqual(self.submit(), (200, job))
+        self.assertNotEqual(self.submit(start='2024-03-02')[1]['id'], job['id'])
+        self.assertNotEqual(self.submit('xlsx')[1]['id'], job['id'])
+        # A request that missed the live job loses the race on exportjob_live_unique and gets it anyway
+        first = QuerySet.first
+        with mock.patch.object(QuerySet, 'first', lambda rows: None if rows.model is ExportJob else first(rows)):
+            self.assertEqual(self.submit(), (200, job))
+        Expense.objects.filter(owner=self.user).first().delete()
+        self.assertEqual(self.submit()[0], 201)
+        self.assertEqual(self.client.post('/export-jobs/docx').status_code, 404)
+
+    def test_claimed_jobs_run_once_and_report_progress(self):
+        pk = self.submit()[1]['id']
+        self.assertEqual(jobs.claim(2), [pk])
+        self.assertEqual(jobs.claim(2), [])
+        with override_settings(EXPORT_CHUNK_SIZE=1), CaptureQueriesContext(connection) as captured:
+            jobs.run(pk)
+        progress = [int(value) for query in captured.captured_queries
+                    for value in re.findall(r'"progress" = (\d+)', query['sql'])]
+        self.assertEqual(progress, [33, 66, 99, 100])
+        job = ExportJob.objects.get(pk=pk)
+        self.assertEqual((job.status, job.progress), (ExportJob.DONE, 100))
+        with open(job.file_path) as output:
+            self.assertEqual(len(output.read().splitlines()), 4)
+
+    def test_failed_jobs_say_why(self):
+        pk = self.submit()[1]['id']
+        jobs.claim(1)
+        with mock.patch.object(exports, 'write_csv', side_effect=OSError('disk full')):
+            with self.assertLogs('expenses.jobs'):
+                jobs.run(pk)
+        self.assertEqual(self.client.get(f'/export-jobs/{pk}/status').json()['error'], 'disk full')
+        self.assertEqual(self.submit()[0], 201)
+
+    def test_downloads_are_the_owners_until_they_expire(self):
+        pk = self.submit()[1]['id']
+        self.assertEqual(self.client.get(f'/export-jobs/{pk}/download').status_code, 409)
+        jobs.claim(1)
+        jobs.run(pk)
+        response = self.client.get(f'/export-jobs/{pk}/download')
+        self.assertEqual(b''.join(response.streaming_content).splitlines()[1][:4], b'3.00')
+
+        self.client.force_login(User.objects.create(username='someone-else'))
+        self.assertEqual(self.client.get(f'/export-jobs/{pk}/download').status_code, 404)
+        self.assertEqual(self.client.get(f'/export-jobs/{pk}/status').status_code, 404)
+
+        self.client.force_login(self.user)
+        path = ExportJob.objects.get(pk=pk).file_path
+        jobs.purge(timezone.now() + datetime.timedelta(seconds=settings.EXPORT_JOB_TTL + 1))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.client.get(f'/export-jobs/{pk}/download').status_code, 410)
+        self.assertEqual(self.submit()[0], 201)
+
+
+class ETagTests(TestCase):
+    urls = ('/expense_category_summary?start=2024-01-01&end=2024-12-31', '/search-expenses?searchText=food',
+            '/income/search-income?searchText=pay', '/export-csv', '/income/export-csv')
+
+    def setUp(self):
+        self.user = User.objects.create(username='etag')
+        self.client.force_login(self.user)
+        Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 3, 1),
+                               description='lunch', category=shared(Category, 'Food'))
+
+    def etags(self):
+        responses = [self.client.get(url) for url in self.urls]
+        for response in responses:
+            if response.streaming:
+                b''.join(response.streaming_content)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('no-cache', response['Cache-Control'])
+        return [response['ETag'] for response in responses]
+
+    def test_if_none_match_skips_the_data_tables(self):
+        for url, etag in zip(self.urls, self.etags()):
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response['ETag'], etag)
+            touched = [query['sql'] for query in captured.captured_queries
+                       if 'expenses_expense' in query['sql'] or 'userincome_userincome' in query['sql']]
+            self.assertEqual(touched, [], url)
+
+    def test_writes_change_the_etag(self):
+        etags = self.etags()
+        UserIncome.objects.create(owner=self.user, amount_minor=100, currency='USD', description='pay',
+                                  source=shared(Source, 'Salary'))
+        after_income = self.etags()
+        self.assertTrue(set(etags).isdisjoint(after_income))
+        UserPreference.objects.create(user=self.user, currency='EUR - Euro')
+        self.assertTrue(set(after_income).isdisjoint(self.etags()))
+
+    def test_other_users_writes_keep_the_etag(self):
+        etags = self.etags()
+        other = User.objects.create(username='other')
+        Expense.objects.create(owner=other, amount_minor=100, currency='USD', description='x',
+                               category=shared(Category, 'Food'))
+        self.assertEqual(self.etags(), etags)
+
+    def test_deleting_a_user_leaves_no_bookkeeping_rows(self):
+        UserIncome.objects.create(owner=self.user, amount_minor=100, currency='USD', description='pay',
+                                  source=shared(Source, 'Salary'))
+        UserPreference.objects.create(user=self.user, currency='USD - United States Dollar')
+        self.user.delete()
+        self.assertFalse(DataVersion.objects.exists())
+        self.assertFalse(ExpenseRollup.objects.exists())
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='async')
+        Expense.objects.create(owner=self.user, amount_minor=1250, currency='USD', date=datetime.date(2024, 3, 1),
+                               description='lunch', category=shared(Category, 'Food'))
+
+    async def test_views_under_the_async_client(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/search-expenses', {'searchText': 'lunch'})
+        self.assertEqual([row['description'] for row in response.json()['results']], ['lunch'])
+        response = await self.async_client.get('/expense_category_summary', {'start': '2024-01-01', 'end': '2024-12-31'})
+        self.assertEqual(response.json()['expense_category_data'], {'Food': 12.5})
+        response = await self.async_client.get('/expense_category_summary', {'start': '2024-01-01', 'end': '2024-12-31'},
+                                               headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_cancelling_the_view_cancels_its_query(self):
+        started = threading.Event()
+        finished = threading.Event()
+
+        def slow_query():
+            started.set()
+            finished.wait(5)
+
+        with mock.patch.object(aio, '_cancel_query', side_effect=lambda wrapper: finished.set()) as cancel:
+            task = asyncio.ensure_future(aio.run_cancellable(slow_query))
+            await asyncio.to_thread(started.wait, 5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        cancel.assert_called_once()
+
+
+class RequestTimingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='timing')
+        self.expenses = [Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', description=f'e{n}',
+                                                category=shared(Category, 'Food')) for n in range(6)]
+
+    def test_server_timing_header(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/')
+        metrics = dict(metric.split(';', 1)[0:2] for metric in response['Server-Timing'].split(', '))
+        self.assertEqual(set(metrics) - {'dup'}, {'total', 'view', 'db', 'tpl'})
+        self.assertRegex(metrics['db'], r'^dur=[0-9.]+;desc="[1-9][0-9]* queries"$')
+
+    async def test_server_timing_header_of_async_views(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/search-expenses', {'searchText': 'e1'})
+        self.assertRegex(response['Server-Timing'], r'view;dur=[0-9.]+, db;dur=[0-9.]+;desc="[1-9][0-9]* queries')
+
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=1, REQUEST_TIMING_SLOW_MS=0, REQUEST_TIMING_REPEAT_THRESHOLD=5,
+                       REQUEST_TIMING_STACKS=True)
+    def test_slow_request_log_reports_repeated_queries(self):
+        def view(request):
+            for expense in self.expenses:
+                Expense.objects.get(pk=expense.pk)
+            User.objects.get(pk=self.user.pk)
+            User.objects.get(pk=self.user.pk)
+            return HttpResponse(render_to_string('partials/_messages.html'))
+
+        with self.assertLogs('expenses.timing') as logs:
+            response = timing.RequestTimingMiddleware(view)(RequestFactory().get('/somewhere'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['path'], '/somewhere')
+        self.assertEqual(record['queries'], 8)
+        self.assertEqual(record['duplicates'], 1)
+        self.assertTrue(record['sampled'])
+        self.assertIn('dup;desc="1 duplicate queries"', response['Server-Timing'])
+        self.assertGreater(record['template_ms'], 0)
+        repeated = {pattern['count']: pattern for pattern in record['repeated']}
+        self.assertEqual(set(repeated), {6, 2})
+        self.assertTrue(repeated[6]['n_plus_one'])
+        self.assertEqual((repeated[2]['duplicates'], repeated[2]['n_plus_one']), (1, False))
+        self.assertIn('expenses/tests.py', repeated[2]['stack'][-1])
+
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=0, REQUEST_TIMING_SLOW_MS=0)
+    def test_unsampled_requests_only_count(self):
+        def view(request):
+            Expense.objects.get(pk=self.expenses[0].pk)
+            Expense.objects.get(pk=self.expenses[0].pk)
+            return HttpResponse()
+
+        with self.assertLogs('expenses.timing') as logs:
+            response = timing.RequestTimingMiddleware(view)(RequestFactory().get('/'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['queries'], record['sampled']), (2, False))
+        self.assertNotIn('repeated', record)
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+        self.assertNotIn('dup;', response['Server-Timing'])
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        forget_choices()
+        self.user = User.objects.create(username='batch')
+        self.other = User.objects.create(username='other-batch')
+        self.client.force_login(self.user)
+        self.food, self.rent = shared(Category, 'Food'), shared(Category, 'Rent')
+        self.kept, self.dropped = [
+            Expense.objects.create(owner=self.user, amount_minor=amount_minor, currency='USD',
+                                   date=datetime.date(2024, 3, day), description='x', category=self.food)
+            for amount_minor, day in [(1000, 1), (2500, 2)]]
+        self.theirs = Expense.objects.create(owner=self.other, amount_minor=700, currency='USD',
+                                             date=datetime.date(2024, 3, 1), description='x', category=self.food)
+
+    def post(self, operations, **headers):
+        return self.client.post('/batch-expenses', {'operations': operations}, content_type='application/json',
+                                headers=headers)
+
+    def rollups(self):
+        return sorted(ExpenseRollup.objects.values_list('owner_id', 'month', 'category_id', 'currency',
+                                                        'total_minor', 'count'))
+
+    def test_batch_is_applied_with_rollups_and_counts(self):
+        version = versioning.current(self.user.pk)
+        response = self.post([
+            {'op': 'create', 'amount': '4.20', 'date': '2024-04-02', 'description': 'taxi', 'category': self.rent.pk},
+            {'op': 'update', 'id': self.kept.pk, 'amount': '12', 'category': self.rent.pk},
+            {'op': 'delete', 'id': self.dropped.pk},
+        ])
+        self.assertEqual(response.status_code, 200)
+        created = Expense.objects.get(description='taxi')
+        self.assertEqual(response.json()['results'], [{'status': 'created', 'id': created.pk},
+                                                      {'status': 'updated', 'id': self.kept.pk},
+                                                      {'status': 'deleted', 'id': self.dropped.pk}])
+        self.assertEqual((created.amount_minor, created.currency, created.owner), (420, 'USD', self.user))
+        self.kept.refresh_from_db()
+        self.assertEqual((self.kept.amount_minor, self.kept.category, self.kept.description), (1200, self.rent, 'x'))
+        self.assertFalse(Expense.objects.filter(pk=self.dropped.pk).exists())
+        self.assertGreater(versioning.current(self.user.pk), version)
+        self.assertEqual(counters.get(self.user.pk, 'expenses'), 2)
+        applied = self.rollups()
+        rollups.rebuild()
+        self.assertEqual(applied, self.rollups())
+
+    def test_one_bad_operation_rejects_the_batch(self):
+        before = self.rollups()
+        response = self.post([
+            {'op': 'create', 'amount': '4.20', 'date': '2024-04-02', 'description': 'taxi', 'category': self.rent.pk},
+            {'op': 'delete', 'id': self.theirs.pk},
+            {'op': 'update', 'id': self.kept.pk, 'amount': 'lots'},
+            {'op': 'create', 'amount': '1', 'date': '2024-04-31', 'description': 'x', 'category': self.rent.pk},
+            {'op': 'create', 'amount': '1', 'date': '2024-04-01', 'description': 'x',
+             'category': Category.objects.create(owner=self.other, name='Theirs').pk},
+            {'op': 'delete', 'id': self.dropped.pk},
+            {'op': 'update', 'id': self.dropped.pk, 'description': ''},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result.get('error', result['status']) for result in response.json()['results']], [
+            'not_applied', 'None of your expenses has this id', 'amount must be a number',
+            'date must be in YYYY-MM-DD format', 'Unknown category', 'id appears more than once in the batch',
+            'id appears more than once in the batch'])
+        self.assertEqual(Expense.objects.filter(owner=self.user).count(), 2)
+        self.assertTrue(Expense.objects.filter(pk=self.theirs.pk).exists())
+        self.assertEqual(self.rollups(), before)
+
+    def test_idempotency_key_replays_the_first_results(self):
+        operations = [{'op': 'create', 'amount': '3', 'date': '2024-04-02', 'description': 'coffee',
+                       'category': self.food.pk}]
+        first = self.post(operations, **{'Idempotency-Key': 'sync-1'})
+        retry = self.post(operations, **{'Idempotency-Key': 'sync-1'})
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Expense.objects.filter(description='coffee').count(), 1)
+        self.assertEqual(self.post(operations + operations, **{'Idempotency-Key': 'sync-1'}).status_code, 422)
+        # Keys are per user
+        self.client.force_login(self.other)
+        self.assertFalse(self.post(operations, **{'Idempotency-Key': 'sync-1'}).has_header('Idempotent-Replayed'))
+        self.assertEqual(Expense.objects.filter(description='coffee').count(), 2)
+
+    def test_single_row_views_check_the_owner(self):
+        self.assertEqual(self.client.get(f'/delete-expense/{self.theirs.pk}').status_code, 404)
+        self.assertEqual(self.client.get(f'/edit-expense/{self.theirs.pk}/').status_code, 404)
+        self.assertTrue(Expense.objects.filter(pk=self.theirs.pk).exists())
+        self.assertEqual(self.client.get(f'/delete-expense/{self.dropped.pk}').status_code, 302)
+
+
+class BudgetTests(TestCase):
+    def setUp(self):
+        rates._series.cache_clear()
+        ExchangeRate.objects.create(currency='EUR', date=datetime.date(2024, 1, 1), rate=Decimal('0.9'))
+        self.user = User.objects.create(username='budgets')
+        self.other = User.objects.create(username='other-budgets')
+        march = datetime.date(2024, 3, 1)
+        for owner, category, amount_minor, currency, day in [
+                (self.user, 'Food', 4000, 'USD', 2), (self.user, 'Rent', 6000, 'USD', 1),
+                (self.user, 'Food', 1000, 'USD', 20), (self.other, 'Food', 2000, 'USD', 5),
+                (self.user, 'Food', 9999, 'USD', 40)]:
+            Expense.objects.create(owner=owner, category=shared(Category, category), amount_minor=amount_minor,
+                                   currency=currency, date=march + datetime.timedelta(days=day - 1), description='x')
+        rollups.rebuild()
+        for owner, category, amount_minor, currency in [
+                (self.user, 'Food', 10000, 'USD'), (self.user, 'Rent', 5000, 'USD'), (self.user, 'Fun', 3000, 'USD'),
+                (self.other, 'Food', 1500, 'EUR')]:
+            Budget.objects.create(owner=owner, category=shared(Category, category), month=march,
+                                  amount_minor=amount_minor, currency=currency)
+
+    def statuses(self, owner):
+        return {status.budget.category.name: (status.spent_minor, status.projected_minor, status.state)
+                for status in BudgetStatus.objects.filter(budget__owner=owner).select_related('budget__category')}
+
+    def test_evaluate_flags_over_and_at_risk_budgets(self):
+        # 50.00 spent on Food in March (not the April one), 31/10 of it projected
+        self.assertEqual(budgets.evaluate(datetime.date(2024, 3, 1), today=datetime.date(2024, 3, 10)), 4)
+        self.assertEqual(self.statuses(self.user), {'Food': (5000, 15500, 'at_risk'), 'Rent': (6000, 18600, 'over'),
+                                                    'Fun': (0, 0, 'ok')})
+        # 20.00 USD at 0.9 EUR per USD
+        self.assertEqual(self.statuses(self.other), {'Food': (1800, 5580, 'over')})
+
+        Budget.objects.filter(category__name='Food', owner=self.user).update(amount_minor=20000)
+        budgets.evaluate(datetime.date(2024, 3, 1), today=datetime.date(2024, 4, 2))
+        self.assertEqual(self.statuses(self.user)['Food'], (5000, 5000, 'ok'))
+        self.assertEqual(BudgetStatus.objects.count(), 4)
+
+    def test_status_endpoint_reads_no_expense_tables(self):
+        call_command('evaluate_budgets', '--month', '2024-03', '--date', '2024-03-10', stdout=io.StringIO())
+        Budget.objects.create(owner=self.user, category=shared(Category, 'Books'), month=datetime.date(2024, 3, 1),
+                              amount_minor=100, currency='USD')
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/budgets/status', {'month': '2024-03'})
+        self.assertFalse([query['sql'] for query in captured.captured_queries
+                          if 'expenses_expense' in query['sql']])
+        data = response.json()
+        self.assertEqual(data['month'], '2024-03')
+        self.assertEqual([(row['category'], row['state']) for row in data['budgets']],
+                         [('Books', None), ('Food', 'at_risk'), ('Fun', 'ok'), ('Rent', 'over')])
+        self.assertEqual(data['budgets'][1]['spent'], '50.00')
+        self.assertEqual(self.client.get('/budgets/status', {'month': 'March'}).status_code, 400)
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        fragments.cache().clear()
+        self.user = User.objects.create(username='fragments')
+        self.client.force_login(self.user)
+        for n in range(4):
+            Expense.objects.create(owner=self.user, amount_minor=100 + n, currency='USD',
+                                   date=datetime.date(2024, 3, 1 + n), description=f'expense {n}',
+                                   category=shared(Category, 'Food'))
+        UserIncome.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 3, 1),
+                                  description='pay', source=shared(Source, 'Salary'))
+
+    def list_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        tables = ('expenses_expense', 'userincome_userincome', 'expenses_recordcount')
+        queries = [query['sql'] for query in captured.captured_queries if any(table in query['sql'] for table in tables)]
+        # The page around the fragment carries a fresh CSRF token every time
+        return re.sub(r'name="csrfmiddlewaretoken" value="\w+"', '', response.content.decode()), queries
+
+    def test_hits_skip_the_list_queries(self):
+        for url in ('/', '/income/income'):
+            hits = REGISTRY.get_sample_value('expensesweb_cache_requests_total', {'cache': 'fragment', 'result': 'hit'}) or 0
+            html, queries = self.list_queries(url)
+            self.assertTrue(queries)
+            cached_html, queries = self.list_queries(url)
+            self.assertEqual(queries, [])
+            self.assertEqual(cached_html, html)
+            self.assertEqual(REGISTRY.get_sample_value('expensesweb_cache_requests_total',
+                                                       {'cache': 'fragment', 'result': 'hit'}) - hits, 1)
+
+    def test_pages_are_cached_apart(self):
+        first, _ = self.list_queries('/')
+        link = re.search(r'href="([^"]*)"\s*>Next', first).group(1).replace('&amp;', '&')
+        second, queries = self.list_queries('/' + link)
+        self.assertTrue(queries)
+        self.assertIn('expense 0', second)
+        self.assertNotIn('expense 0', first)
+
+    def test_writes_and_preference_changes_invalidate(self):
+        self.list_queries('/')
+        Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 4, 1),
+                               description='brand new', category=shared(Category, 'Food'))
+        html, queries = self.list_queries('/')
+        self.assertTrue(queries)
+        self.assertIn('brand new', html)
+        Expense.objects.filter(description='brand new').get().delete()
+        self.assertNotIn('brand new', self.list_queries('/')[0])
+
+        self.list_queries('/income/income')
+        with self.captureOnCommitCallbacks(execute=True):
+            UserPreference.objects.create(user=self.user, currency='EUR - Euro')
+        self.assertIn('Amount(EUR - Euro)', self.list_queries('/income/income')[0])
+
+    def test_other_users_do_not_share_fragments(self):
+        self.list_queries('/')
+        other = User.objects.create(username='someone-else')
+        self.client.force_login(other)
+        html, queries = self.list_queries('/')
+        self.assertNotIn('expense 0', html)
+        self.assertNotIn('expense 3', html)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='metrics')
+        self.client.force_login(self.user)
+        Expense.objects.create(owner=self.user, amount_minor=100, currency='USD', date=datetime.date(2024, 3, 1),
+                               description='lunch', category=shared(Category, 'Food'))
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_exports_and_caches_are_counted(self):
+        requests = self.sample('expensesweb_request_duration_seconds_count', route='expense_category_summary',
+                               method='GET')
+        exports = self.sample('expensesweb_export_size_bytes_count', format='csv')
+        hits = self.sample('expensesweb_cache_requests_total', cache='etag', result='hit')
+        response = self.client.get('/expense_category_summary')
+        self.client.get('/expense_category_summary', HTTP_IF_NONE_MATCH=response['ETag'])
+        b''.join(self.client.get('/export-csv').streaming_content)
+
+        self.assertEqual(self.sample('expensesweb_request_duration_seconds_count', route='expense_category_summary',
+                                     method='GET') - requests, 2)
+        self.assertEqual(self.sample('expensesweb_export_size_bytes_count', format='csv') - exports, 1)
+        self.assertEqual(self.sample('expensesweb_cache_requests_total', cache='etag', result='hit') - hits, 1)
+        self.assertEqual(self.sample('expensesweb_requests_in_flight'), 0)
+
+    def test_endpoint(self):
+        self.client.get('/stats')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'expensesweb_request_duration_seconds_bucket{le="0.005",method="GET",route="stats"}',
+                      response.content)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 404)
+
+    def test_processes_add_up_in_multiprocess_mode(self):
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+
+            def python(code):
+                return subprocess.run([sys.executable, '-c', code], env=env, check=True, cwd=settings.BASE_DIR,
+                                      capture_output=True, text=True).stdout
+
+            # Stays up, like a web worker, while the others come and go
+            serve = 'import sys; from expenses import metrics; print("up", flush=True); sys.stdin.read()'
+            server = subprocess.Popen([sys.executable, '-c', serve], env=env, cwd=settings.BASE_DIR,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            self.assertEqual(server.stdout.readline(), 'up\n')
+            record = 'from expenses import metrics; metrics.email_outcome("sent"); metrics.export_finished("pdf", 1, 10)'
+            for _ in range(2):
+                python(record)
+            exposition = 'from expenses import metrics; print(metrics.exposition()[0].decode())'
+            output = python(exposition)
+            server.communicate('')
+            # Nothing running any more: the next process starts a restarted site
+            restarted = python(exposition)
+        self.assertIn('expensesweb_outbox_emails_total{outcome="sent"} 2.0', output)
+        self.assertIn('expensesweb_export_size_bytes_sum{format="pdf"} 20.0', output)
+        self.assertNotIn('expensesweb_outbox_emails_total{outcome="sent"}', restarted)
+
+
+@override_settings(EMAIL_CHECK_DELIVERABILITY=False, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        forget_choices()
+
+    def test_scenarios_cover_every_route(self):
+        users = benchmark.seed(2, 60)
+        # As after seeding with DEBUG on: the capped query log is full
+        connection.queries_log.extend({'sql': '', 'time': '0'} for _ in range(connection.queries_limit))
+        recorder = benchmark.run(sorted(benchmark.SCENARIOS), users, 1)
+        self.assertEqual(benchmark.uncovered(recorder), [])
+        results = recorder.results()
+        self.assertEqual(results['GET expense_category_summary']['requests'], 2)
+        self.assertEqual(results['GET stats']['queries'], 0)
+        self.assertGreater(results['POST add-expense']['queries'], 0)
+
+    def test_compare_flags_more_queries_and_slower_routes(self):
+        baseline = {'GET expenses': {'p50': 10.0, 'queries': 5}, 'GET stats': {'p50': 1.0, 'queries': 0}}
+        results = {'GET expenses': {'p50': 12.0, 'queries': 6}, 'GET stats': {'p50': 2.5, 'queries': 0}}
+        self.assertEqual(benchmark.compare(results, baseline), ['GET expenses: 6 queries per request, was 5'])
+        results['GET expenses']['queries'] = 5
+        results['GET expenses']['p50'] = 20.0
+        self.assertEqual(benchmark.compare(results, baseline), ['GET expenses: p50 20.0ms, was 10.0ms'])
+        results['GET budget-status'] = {'p50': 1.0, 'queries': 1}
+        self.assertEqual(benchmark.compare(results, baseline)[0],
+                         'GET budget-status: not in the baseline, record it with --save-baseline')
+
+
+class SeedLedgerTests(TransactionTestCase):
+    # The command hands its connection over to worker processes
+    def seed(self, prefix, workers):
+        call_command('seed_ledger', '--users', '5', '--rows', '30', '--years', '1', '--block-size', '2',
+                     '--workers', str(workers), '--prefix', prefix, stdout=io.StringIO())
+        ledgers = []
+        for n in range(5):
+            owner = User.objects.get(username=f'{prefix}{n}')
+            ledgers.append(sorted(Expense.objects.filter(owner=owner).values_list(
+                'amount_minor', 'currency', 'date', 'description', 'category')))
+        return ledgers
+
+    def test_same_seed_same_ledgers_whatever_the_workers(self):
+        self.assertEqual(self.seed('one', 1), self.seed('two', 3))
+
+    def test_bookkeeping_matches_the_rows(self):
+        self.seed('seeded', 2)
+        for owner in User.objects.filter(username__startswith='seeded'):
+            expenses = Expense.objects.filter(owner=owner)
+            self.assertEqual(counters.get(owner.pk, 'expenses'), expenses.count())
+            self.assertEqual(counters.get(owner.pk, 'incomes'), UserIncome.objects.filter(owner=owner).count())
+            self.assertEqual(ExpenseRollup.objects.filter(owner=owner).aggregate(total=Sum('total_minor'))['total'],
+                             expenses.aggregate(total=Sum('amount_minor'))['total'])
+            self.assertTrue(DataVersion.objects.filter(owner=owner).exists())
+        with self.assertRaises(CommandError):
+            call_command('seed_ledger', '--users', '1', '--prefix', 'seeded', stdout=io.StringIO())
@@ -0,0 +1,229 @@
+"""
+Per-request timing, for finding out why a page is slow.
+
+``RequestTimingMiddleware`` times every request: the whole of it, the view,
+the SQL (counted and timed by an execute wrapper installed on each database
+connection) and template rendering (timed by the ``DjangoTemplates``
+backend below). The numbers go out in a ``Server-Timing`` header, which the
+browser's dev tools show next to the request, and a request slower than
+``REQUEST_TIMING_SLOW_MS`` is logged as one JSON object to the
+``expenses.timing`` logger. The same numbers feed ``expenses.metrics``.
+
+A sample of the requests (``REQUEST_TIMING_SAMPLE_RATE``) also keeps every
+statement, to report the repeated ones: duplicates, run again with the same
+parameters, and N+1 patterns, the same statement run with
+``REQUEST_TIMING_REPEAT_THRESHOLD`` or more different parameters. Where
+they came from is only captured with ``REQUEST_TIMING_STACKS`` on. An
+unsampled request costs a context variable lookup and two clock reads per
+query.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+import traceback
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.template.backends import django as django_backend
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+# Repeated statements kept for the log, slowest first
+MAX_REPEATED = 10
+
+
+class _Statement:
+    __slots__ = ('count', 'seconds', 'params', 'stack')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.params = {}
+        self.stack = None
+
+
+def _stack():
+    base = str(settings.BASE_DIR)
+    frames = [frame for frame in traceback.extract_stack()
+              if frame.filename.startswith(base) and 'site-packages' not in frame.filename
+              and frame.filename != __file__]
+    return [f'{os.path.relpath(frame.filename, base)}:{frame.lineno} in {frame.name}' for frame in frames[-5:]]
+
+
+class Timing:
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.queries = 0
+        self.db = 0.0
+        self.templates = 0.0
+        self.statements = {}
+
+    def query(self, sql, params, many, seconds):
+        self.queries += 1
+        self.db += seconds
+        if not self.sampled:
+            return
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements[sql] = _Statement()
+        statement.count += 1
+        statement.seconds += seconds
+        # executemany batches are never the same twice
+        key = statement.count if many else repr(params)
+        statement.params[key] = statement.params.get(key, 0) + 1
+        if statement.count == 2 and settings.REQUEST_TIMING_STACKS:
+            statement.stack = _stack()
+
+    def duplicates(self):
+        return sum(statement.count - len(statement.params) for statement in self.statements.values())
+
+    def repeated(self):
+        """The statements run more than once with the same parameters or too often with different ones."""
+        threshold = settings.REQUEST_TIMING_REPEAT_THRESHOLD
+        found = []
+        for sql, statement in self.statements.items():
+            duplicates = statement.count - len(statement.params)
+            if duplicates or len(statement.params) >= threshold:
+                found.append({'sql': sql[:500], 'count': statement.count, 'duplicates': duplicates,
+                              'n_plus_one': len(statement.params) >= threshold,
+                              'ms': round(statement.seconds * 1000, 2), 'stack': statement.stack})
+        found.sort(key=lambda pattern: pattern['ms'], reverse=True)
+        return found[:MAX_REPEATED]
+
+
+def _record(execute, sql, params, many, context):
+    timing = _current.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timing.query(sql, params, many, time.perf_counter() - started)
+
+
+def install(sender, connection, **kwargs):
+    """``connection_created`` receiver; a wrapper keeps its wrappers across reconnects."""
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+class _TimedTemplate(django_backend.Template):
+    def render(self, context=None, request=None):
+        timing = _current.get()
+        if timing is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timing.templates += time.perf_counter() - started
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing each render for ``RequestTimingMiddleware``."""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name).template, self)
+
+
+def _view_started():
+    timing = _current.get()
+    if timing is not None:
+        timing.view_started = time.perf_counter()
+
+
+class RequestTimingMiddleware:
+    """Put first in MIDDLEWARE, so the total covers the other middleware too."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Django would run a sync process_view in a thread of its own
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timing = Timing(random.random() < settings.REQUEST_TIMING_SAMPLE_RATE)
+        token = _current.set(timing)
+        metrics.IN_FLIGHT.inc()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.IN_FLIGHT.dec()
+            _current.reset(token)
+        self.finish(request, response, timing)
+        return response
+
+    async def __acall__(self, request):
+        timing = Timing(random.random() < settings.REQUEST_TIMING_SAMPLE_RATE)
+        token = _current.set(timing)
+        metrics.IN_FLIGHT.inc()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.IN_FLIGHT.dec()
+            _current.reset(token)
+        self.finish(request, response, timing)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _view_started()
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        _view_started()
+
+    def finish(self, request, response, timing):
+        # For a streamed response this is the time to its first byte
+        finished = time.perf_counter()
+        total = (finished - timing.started) * 1000
+        view = (finished - timing.view_started) * 1000 if timing.view_started is not None else None
+        entries = [f'total;dur={total:.1f}', f'db;dur={timing.db * 1000:.1f};desc="{timing.queries} queries"',
+                   f'tpl;dur={timing.templates * 1000:.1f}']
+        if view is not None:
+            entries.insert(1, f'view;dur={view:.1f}')
+        if timing.sampled:
+            entries.append(f'dup;desc="{timing.duplicates()} duplicate queries"')
+        if response.has_header('Server-Timing'):
+            entries.insert(0, response['Server-Timing'])
+        response['Server-Timing'] = ', '.join(entries)
+
+        match = request.resolver_match
+        route = match.view_name if match else None
+        metrics.request_finished(route or 'unmatched', request.method, response.status_code, total / 1000,
+                                 timing.queries, timing.db)
+        if total < settings.REQUEST_TIMING_SLOW_MS:
+            return
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'total_ms': round(total, 2),
+            'view_ms': round(view, 2) if view is not None else None,
+            'db_ms': round(timing.db * 1000, 2),
+            'queries': timing.queries,
+            'template_ms': round(timing.templates * 1000, 2),
+            'sampled': timing.sampled,
+        }
+        if timing.sampled:
+            record['duplicates'] = timing.duplicates()
+            record['repeated'] = timing.repeated()
+        logger.warning(json.dumps(record))
@@ -9,11 +9,18 @@ urlpatterns = [
     path('edit-expense/<int:id>/', views.edit_expense, name='edit-expense'),
     path('delete-expense/<int:id>', views.delete_expense, name='delete-expense'),
     path('search-expenses', csrf_exempt(views.search_expenses), name='search-expenses'),
+    path('batch-expenses', csrf_exempt(views.batch_expenses), name='batch-expenses'),
+    path('import-statement', views.import_statement, name='import-statement'),
     path('expense_category_summary', views.expense_category_summary, name='expense_category_summary'),
     path('stats', views.stats_view, name='stats'),
     path('export-csv', views.export_csv, name='export-csv'),
     path('export-excel', views.export_excel, name='export-excel'),
     path('export-pdf', views.export_pdf, name='export-pdf'),
+    path('export-jobs/<str:format>', views.create_export_job, name='create-export-job'),
+    path('export-jobs/<int:id>/status', views.export_job_status, name='export-job-status'),
+    path('export-jobs/<int:id>/download', views.download_export_job, name='export-job-download'),
+    path('budgets/status', views.budget_status, name='budget-status'),
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
 
 
@@ -0,0 +1,18 @@
+import datetime
+
+
+def parse_date_range(request):
+    # Optional ?start=YYYY-MM-DD&end=YYYY-MM-DD, raises ValueError on bad input
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    start = datetime.date.fromisoformat(start) if start else None
+    end = datetime.date.fromisoformat(end) if end else None
+    return start, end
+
+
+def filter_date_range(queryset, start, end):
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    return queryset
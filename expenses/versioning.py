@@ -0,0 +1,149 @@
+"""
+Per-user data versions.
+
+``DataVersion`` is bumped by ``expenses.signals`` in the same transaction
+as every write to a user's expenses, incomes or preferences, so the number
+moves exactly when what the user can see changes, and every app node reads
+the same value from the shared database. It is used as a cache key (PDF
+reports, export jobs) and as the ETag of the JSON and export endpoints.
+
+Within a request each version, this one and those of ``expenses.reference``,
+is read at most once: ``VersionMiddleware`` gives the request a memo that
+``remembered`` fills, so the fragment key, the ETag and the cached
+preferences of one page share a single read. A version the request itself
+bumps is read afresh from then on. Outside requests (commands, the export
+worker) every call reads the database.
+"""
+import contextvars
+import hashlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from . import metrics
+from .models import DataVersion
+
+_memo = contextvars.ContextVar('versions', default=None)
+
+
+def remembered(key, read):
+    """Return ``read()``, read once per request under ``key``."""
+    memo = _memo.get()
+    if memo is None:
+        return read()
+    value = memo.get(key)
+    if value is None:
+        value = read()
+        if key not in memo:
+            memo[key] = value
+    return value
+
+
+def forget(key):
+    """Read ``key`` afresh for the rest of the request, which has just changed it."""
+    memo = _memo.get()
+    if memo is not None:
+        # Not dropped: the change may yet be rolled back, so never memoise it
+        memo[key] = None
+
+
+class VersionMiddleware:
+    """Give each request its memo of versions."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = _memo.set({})
+        try:
+            return self.get_response(request)
+        finally:
+            _memo.reset(token)
+
+    async def __acall__(self, request):
+        token = _memo.set({})
+        try:
+            return await self.get_response(request)
+        finally:
+            _memo.reset(token)
+
+
+def bump(owner_id):
+    """Increment ``owner_id``'s data version, creating the counter on first use."""
+    forget(('data', owner_id))
+    rows = DataVersion.objects.filter(owner_id=owner_id)
+    if rows.update(version=F('version') + 1):
+        return
+    try:
+        with transaction.atomic():
+            DataVersion.objects.create(owner_id=owner_id, version=1)
+    except IntegrityError:
+        rows.update(version=F('version') + 1)
+
+
+def current(owner_id):
+    def read():
+        return DataVersion.objects.filter(owner_id=owner_id).values_list('version', flat=True).first() or 0
+    return remembered(('data', owner_id), read)
+
+
+def stamp(owner_id, *parts):
+    """
+    Return ``'<version>-<digest>'`` for ``owner_id``'s current data and
+    whatever else (filters, other versions) ``parts`` holds, for keying
+    caches of anything rendered from it.
+    """
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+    return f'{current(owner_id)}-{digest}'
+
+
+def conditional(*inputs):
+    """
+    Decorate a view whose response depends only on the user's data, the
+    request's path and query string, and what the ``inputs`` callables
+    return (the exchange rate table's version, today's date...). Responses
+    get a strong ETag from ``stamp`` and a matching If-None-Match is
+    answered with 304 before the view runs.
+    """
+    def etag(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return None
+        return stamp(request.user.id, request.get_full_path(), [value() for value in inputs])
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                # The stamp reads the session and the database, which async code must not do directly
+                tag = await sync_to_async(etag)(request)
+                response = await condition(etag_func=lambda *args, **kwargs: tag)(view)(request, *args, **kwargs)
+                return _revalidate(response)
+            return async_wrapper
+
+        conditional_view = condition(etag_func=etag)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return _revalidate(conditional_view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def _revalidate(response):
+    # Revalidate every time rather than let the browser reuse stale data
+    if response.has_header('ETag'):
+        patch_cache_control(response, private=True, no_cache=True)
+        metrics.cache_lookup('etag', response.status_code == 304)
+    return response
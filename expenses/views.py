@@ -1,62 +1,78 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from .models import Category, Expense
+from .models import Expense, ExportJob
 from django.contrib import messages
-from django.core.paginator import Paginator
-import json
-from django.http import JsonResponse, HttpResponse
-from userpreferences.models import UserPreference
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, FileResponse, Http404
 import datetime
-import csv
-import xlwt
-
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from io import BytesIO
+from collections import defaultdict
+import io
+import os
 import tempfile
-from django.db.models import Sum
+import time
+from django.db import transaction
+from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
+from django.utils.cache import add_never_cache_headers
+from django.utils.functional import SimpleLazyObject
+from . import (aio, batch, budgets, counters, exports, filters, fragments, imports, jobs, metrics, money, pagination,
+               query, rates, reference, reports, rollups, search, versioning)
+from .utils import parse_date_range
 # from django.template.loader import render_to_string
 # from weasyprint import HTML
 
 # Create your views here.
 
-def search_expenses(request):
-    if request.method=='POST':
-        search_str=json.loads(request.body).get('searchText','')
-
-        expenses=Expense.objects.filter(
-            amount__startswith=search_str, owner=request.user) | Expense.objects.filter(
-            date__startswith=search_str, owner=request.user) | Expense.objects.filter(
-            description__icontains=search_str, owner=request.user) | Expense.objects.filter(
-            category__icontains=search_str, owner=request.user) 
-        
-        data=expenses.values()
-        return JsonResponse(list(data), safe=False)
+@versioning.conditional(lambda: reference.version('categories'))
+async def search_expenses(request):
+    if request.method in ('GET', 'POST'):
+        body=search.request_params(request)
+        parsed=query.parse(body.get('searchText',''))
+        user=await request.auser()
+
+        def run():
+            choices=reference.categories(user.id)
+            data=search.search(
+                filters.filter_expenses(user, parsed), search.EXPENSE_SEARCH,
+                parsed.text, fields=('amount_minor', 'currency', 'category', 'description', 'date'),
+                limit=body.get('limit'), cursor=body.get('cursor'), match_all=parsed.has_filters, choices=choices)
+            reference.with_names(data['results'], 'category', choices)
+            return data
+
+        try:
+            # Cancelled along with its query when the typeahead moves on
+            data=await aio.run_cancellable(run)
+        except search.InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        money.with_amounts(data['results'])
+        data['errors']=list(parsed.errors)
+        return JsonResponse(data)
         
 
 @login_required(login_url='/authentication/login')
 def index(request):
-    categories = Category.objects.all()
-    expenses=Expense.objects.filter(owner=request.user)
-    paginator = Paginator(expenses, 3)
-    page_number = request.GET.get('page')
-    page_obj=paginator.get_page(page_number)
-    try:
-        currency = UserPreference.objects.get(user=request.user).currency
-    except ObjectDoesNotExist:
-        currency = "Default"
+    expenses=Expense.objects.filter(owner=request.user).select_related('category')
+    cursor, per_page = request.GET.get('cursor'), request.GET.get('per_page')
+    currency = reference.user_currency(request.user.id) or "Default"
+    currency_code = reference.user_currency_code(request.user.id)
+
+    def page():
+        page_obj = pagination.paginate(expenses, counters.get(request.user.id, 'expenses'), cursor, per_page)
+        rates.annotate(page_obj.object_list, currency_code)
+        return page_obj
+
     context = {
         'expenses': expenses,
-        'page_obj': page_obj,
+        # Only read if the table isn't cached
+        'page_obj': SimpleLazyObject(page),
+        'fragment_key': fragments.key('expenses', request.user.id, reference.version('categories'), cursor, per_page),
         'currency': currency,
+        'currency_code': currency_code,
     }
     return render(request, 'expenses/index.html', context)
 
 def add_expense(request):
-    categories = Category.objects.all()
+    categories = reference.categories(request.user.id)
     context = {
         'categories': categories,
         'values': request.POST,
@@ -68,7 +84,7 @@ def add_expense(request):
         amount = request.POST['amount']
         description = request.POST['description']
         date = request.POST['date']
-        categories = request.POST['category']
+        category_id = reference.choice_id(categories, request.POST.get('category'))
 
         if not amount:
             messages.error(request, 'Amount is required')
@@ -78,13 +94,26 @@ def add_expense(request):
         if not description:
             messages.error(request, 'Description is required')
             return render(request, 'expenses/add_expense.html', context)
-        Expense.objects.create(owner=request.user, amount=amount, date=date, description=description, category=categories)
+
+        if category_id is None:
+            messages.error(request, 'Category is required')
+            return render(request, 'expenses/add_expense.html', context)
+        currency = reference.user_currency_code(request.user.id)
+        try:
+            amount_minor = money.to_minor(amount, currency)
+        except ValueError:
+            messages.error(request, 'Amount must be a number')
+            return render(request, 'expenses/add_expense.html', context)
+        with transaction.atomic():
+            Expense.objects.create(owner=request.user, amount_minor=amount_minor, currency=currency, date=date,
+                                   description=description, category_id=category_id)
         messages.success(request, 'Expense saved successfully')
         return redirect('expenses')
 
+@login_required(login_url='/authentication/login')
 def edit_expense (request, id):
-    expense=Expense.objects.get(pk=id)
-    categories = Category.objects.all()
+    expense=get_object_or_404(Expense.objects.select_related('category'), pk=id, owner=request.user)
+    categories = reference.categories(request.user.id)
     context = {
         'expense': expense,
         'values': expense,
@@ -96,7 +125,7 @@ def edit_expense (request, id):
         amount = request.POST['amount']
         description = request.POST['description']
         date = request.POST['date']
-        category = request.POST['category']
+        category_id = reference.choice_id(categories, request.POST.get('category'))
 
         if not amount:
             messages.error(request, 'Amount is required')
@@ -105,13 +134,24 @@ def edit_expense (request, id):
         if not description:
             messages.error(request, 'Description is required')
             return render(request, 'expenses/edit_expense.html', context)
+
+        if category_id is None:
+            messages.error(request, 'Category is required')
+            return render(request, 'expenses/edit_expense.html', context)
+
+        try:
+            amount_minor = money.to_minor(amount, expense.currency)
+        except ValueError:
+            messages.error(request, 'Amount must be a number')
+            return render(request, 'expenses/edit_expense.html', context)
                 
         expense.owner=request.user
-        expense.amount=amount 
+        expense.amount_minor=amount_minor
         expense.date=date 
         expense.description=description 
-        expense.category=category
-        expense.save()
+        expense.category_id=category_id
+        with transaction.atomic():
+            expense.save()
         messages.success(request, 'Expense updated successfully')
         return redirect('expenses')
     
@@ -119,128 +159,168 @@ def edit_expense (request, id):
         messages.info(request, 'Handling post form')
     return render(request, 'expenses/edit_expense.html', context)
 
+@login_required(login_url='/authentication/login')
 def delete_expense(request, id):
-    expense=Expense.objects.get(pk=id)
-    expense.delete()
+    expense=get_object_or_404(Expense, pk=id, owner=request.user)
+    with transaction.atomic():
+        expense.delete()
     messages.success(request, 'Expense removed')
     return redirect('expenses')
 
-def expense_category_summary(request):
-    todays_date = datetime.date.today()
-    six_months_ago=todays_date-datetime.timedelta(days=30*6)
-    expenses=Expense.objects.filter(owner=request.user, date__gte=six_months_ago, date__lte=todays_date)
-    finalrep={}
-
-    def get_category(expense):
-        return expense.category
-    category_list = list(set(map(get_category, expenses)))
+@require_POST
+def batch_expenses(request):
+    return batch.respond(request, batch.EXPENSES)
 
-    def get_expense_category_amount(category):
-        amount=0
-        filtered_by_category=expenses.filter(category=category)
+@require_POST
+@login_required(login_url='/authentication/login')
+def import_statement(request):
+    statement = request.FILES.get('statement')
+    if statement is None:
+        return JsonResponse({'error': 'Attach the statement as "statement"'}, status=400)
+    category_id = reference.choice_id(reference.categories(request.user.id), request.POST.get('category'))
+    source_id = reference.choice_id(reference.sources(request.user.id), request.POST.get('source'))
+    columns = {field: request.POST.get(f'{field}_column') for field in imports.CSV_COLUMNS}
+    try:
+        # Large uploads are on disk already and are read from there a line at a time
+        stream = io.TextIOWrapper(statement.file, encoding=request.POST.get('encoding') or 'utf-8-sig', newline='')
+        rows = imports.read(stream, request.POST.get('format') or imports.guess_format(statement.name), columns,
+                            request.POST.get('date_format'))
+        summary = imports.run(request.user.id, rows, category_id, source_id)
+    except imports.InvalidStatement as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except LookupError:
+        return JsonResponse({'error': 'Unknown encoding'}, status=400)
+    return JsonResponse(summary)
+
+@versioning.conditional(rates.version, lambda: reference.version('categories'), datetime.date.today)
+async def expense_category_summary(request):
+    try:
+        start, end = parse_date_range(request)
+    except ValueError:
+        return JsonResponse({'error': 'start and end must be dates in YYYY-MM-DD format'}, status=400)
+    end = end or datetime.date.today()
+    start = start or end-datetime.timedelta(days=30*6)
+
+    # Monthly totals in each currency are converted to the user's currency in
+    # one pass; anything without a rate is reported in its own currency
+    user = await request.auser()
+    currency = await sync_to_async(reference.user_currency_code)(user.id)
+    names = dict(await sync_to_async(reference.categories)(user.id))
+    totals = await rollups.acategory_totals(user.id, start, end, by_month=True)
+    keys = list(totals)
+    amounts = [totals[key] for key in keys]
+    # Each month is converted at the rate of its last day in the window
+    days = [min(rollups.next_month(month) - datetime.timedelta(days=1), end) for _, _, month in keys]
+    converted, missing = await sync_to_async(rates.convert)(amounts, [code for _, code, _ in keys], days, currency)
+    finalrep = defaultdict(int)
+    other_currencies = defaultdict(lambda: defaultdict(int))
+    for (category_id, code, _), total, amount, unknown in zip(keys, amounts, converted, missing):
+        if unknown:
+            other_currencies[code][names[category_id]] += total
+        else:
+            finalrep[names[category_id]] += int(amount)
+    finalrep = {category: float(money.from_minor(total, currency)) for category, total in finalrep.items()}
+    other_currencies = {code: {category: float(money.from_minor(total, code)) for category, total in by_category.items()}
+                        for code, by_category in other_currencies.items()}
+    return JsonResponse({'expense_category_data': finalrep, 'other_currencies': other_currencies,
+                         'currency': currency, 'start': start, 'end': end}, safe=False)
 
-        for item in filtered_by_category:
-            amount+=item.amount
-        return amount
-    
-    for x in expenses:
-        for y in category_list:
-            finalrep[y]=get_expense_category_amount(y)
-    
-    return JsonResponse({'expense_category_data': finalrep}, safe=False
-                        )
 def stats_view(request):
     return render(request, 'expenses/stats.html') 
 
+@versioning.conditional(rates.version, lambda: reference.version('categories'))
 def export_csv(request):
-    response=HttpResponse(content_type='text/csv')
-    response['Content-Disposition']='attachment; filename=Expenses' + \
-        str(datetime.datetime.now())+ '.csv'
-    
-    writer=csv.writer(response)
-    writer.writerow(['Amount', 'Description', 'Category', 'Date'])
-
-    expenses=Expense.objects.filter(owner=request.user)
-
-    for expense in expenses:
-        writer.writerow([expense.amount,expense.description, expense.category, expense.date])
-
-    return response
-
+    try:
+        params = filters.export_params(request)
+    except ValueError:
+        return HttpResponse('start and end must be dates in YYYY-MM-DD format', status=400)
+    expenses, _ = filters.export_querysets(request.user, params)
+    currency = params['currency']
+    return exports.stream_csv('Expenses' + str(datetime.datetime.now()) + '.csv',
+                              exports.converted(exports.EXPENSE_COLUMNS, currency), expenses, currency)
+
+@versioning.conditional(rates.version, lambda: reference.version('categories'), lambda: reference.version('sources'))
 def export_excel(request):
-    response=HttpResponse(content_type='application/ms-excel')
-    response['Content-Disposition'] = 'attachment; filename=Expenses' +\
-        str(datetime.datetime.now())+'.xls'
-    wb=xlwt.Workbook(encoding='utf-8')
-    ws=wb.add_sheet('Expenses')
-    row_num = 0
-    font_style=xlwt.XFStyle()
-    font_style.font.bold=True
-
-    columns=['Amount', 'Description', 'Category', 'Date']
-    for col_num in range(len(columns)):
-        ws.write(row_num, col_num, columns[col_num], font_style)
-    font_style = xlwt.XFStyle()
-
-    rows=Expense.objects.filter(owner=request.user).values_list('amount', 'description', 'category','date')
-
-    for row in rows:
-        row_num +=1
-
-        for col_num in range(len(row)):
-            ws.write(row_num,col_num,str(row[col_num]), font_style)
-    
-    wb.save(response)
-    return response
-
+    try:
+        params = filters.export_params(request)
+    except ValueError:
+        return HttpResponse('start and end must be dates in YYYY-MM-DD format', status=400)
+    expenses, incomes = filters.export_querysets(request.user, params)
+
+    # The workbook is built on disk and streamed back from there, never held in memory
+    output=tempfile.TemporaryFile()
+    currency = params['currency']
+    started = time.perf_counter()
+    exports.write_xlsx(output, [('Expenses', exports.converted(exports.EXPENSE_COLUMNS, currency), expenses),
+                                ('Incomes', exports.converted(exports.INCOME_COLUMNS, currency), incomes)],
+                       currency=currency)
+    metrics.export_finished('xlsx', time.perf_counter() - started, output.tell())
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, content_type=exports.XLSX_CONTENT_TYPE,
+                        filename='Expenses' + str(datetime.datetime.now()) + '.xlsx')
+
+@versioning.conditional(rates.version, lambda: reference.version('categories'))
 def export_pdf(request):
-    response=HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'inline; attachment; filename=Expenses' + \
-        str(datetime.datetime.now())+'.pdf'
-    
-    buffer = BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=letter)
-    pdf.setTitle("Expenses Report")
-
-    expenses= Expense.objects.filter(owner=request.user)
-    sum = expenses.aggregate(Sum('amount'))
-    total = sum['amount__sum']
-
-    #Set font for the company name
-    pdf.setFont("Helvetica-Bold", 16)
-    pdf.drawCentredString(4.25 * inch, 10.5*inch, "TRULY EXPENSE MANAGEMENT")
-
-    #Add title
-    pdf.setFont("Helvetica-Bold", 12)
-    pdf.drawString(100, 700, "Expenses Report")
-    pdf.setFont("Helvetica", 10)
-
-    # Table header
-    pdf.drawString(100, 680, "Amount")
-    pdf.drawString(200, 680, "Description")
-    pdf.drawString(300, 680, "Category")
-    pdf.drawString(400, 680, "Date")
-
-    y = 660
-    for expense in expenses:
-        pdf.drawString(100, y, str(expense.amount))
-        pdf.drawString(200, y, expense.description)
-        pdf.drawString(300, y, expense.category)
-        pdf.drawString(400, y, str(expense.date))
-        y -= 20
-        if y < 50:
-            pdf.showPage()
-            pdf.setFont("Helvetica", 10)
-            y = 750
-    
+    try:
+        params = filters.export_params(request)
+    except ValueError:
+        return HttpResponse('start and end must be dates in YYYY-MM-DD format', status=400)
+    expenses, _ = filters.export_querysets(request.user, params)
+
+    path=reports.cached_expense_report(request.user.id, expenses, params, max_rows=settings.EXPORT_PDF_INLINE_ROWS)
+    if path is None:
+        # Too long to render in the request, see expenses.reports
+        job, _ = jobs.submit(request.user.id, 'pdf', params)
+        response = JsonResponse(jobs.describe(job), status=202)
+        # Tells of the job, not the data the ETag stands for
+        add_never_cache_headers(response)
+        return response
+    return FileResponse(open(path, 'rb'), content_type='application/pdf',
+                        filename='Expenses' + str(datetime.datetime.now()) + '.pdf')
+
+@require_POST
+@login_required(login_url='/authentication/login')
+def create_export_job(request, format):
+    if format not in jobs.CONTENT_TYPES:
+        return JsonResponse({'error': 'Unknown export format'}, status=404)
+    try:
+        params = filters.export_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'start and end must be dates in YYYY-MM-DD format'}, status=400)
+    job, created = jobs.submit(request.user.id, format, params)
+    return JsonResponse(jobs.describe(job), status=201 if created else 200)
 
-    
-    pdf.drawString(100, y-10, 'Total: ' + str(total))
+@login_required(login_url='/authentication/login')
+def export_job_status(request, id):
+    job = get_object_or_404(ExportJob, pk=id, owner=request.user)
+    return JsonResponse(jobs.describe(job))
+
+@login_required(login_url='/authentication/login')
+def download_export_job(request, id):
+    job = get_object_or_404(ExportJob, pk=id, owner=request.user)
+    if job.status == ExportJob.EXPIRED or (job.status == ExportJob.DONE and not os.path.exists(job.file_path)):
+        return JsonResponse({'error': 'This export has expired'}, status=410)
+    if job.status != ExportJob.DONE:
+        return JsonResponse(jobs.describe(job), status=409)
+    return FileResponse(open(job.file_path, 'rb'), as_attachment=True, content_type=jobs.CONTENT_TYPES[job.format],
+                        filename=f'Expenses{job.finished_at:%Y-%m-%d %H%M%S}.{job.format}')
 
-    pdf.save()
-    buffer.seek(0)
-    response.write(buffer.read())
-    return response
+@login_required(login_url='/authentication/login')
+def budget_status(request):
+    # Precomputed nightly by evaluate_budgets; the expense tables aren't read here
+    value = request.GET.get('month') or f'{datetime.date.today():%Y-%m}'
+    try:
+        month = datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        return JsonResponse({'error': 'month must be in YYYY-MM format'}, status=400)
+    return JsonResponse({'month': f'{month:%Y-%m}', 'budgets': budgets.status(request.user.id, month)})
+
+def prometheus_metrics(request):
+    # For a scraper on the same host or network; nobody else should see it
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    body, content_type = metrics.exposition()
+    return HttpResponse(body, content_type=content_type)
 
 # def export_pdf(request):
 #     response=HttpResponse(content_type='application/pdf')
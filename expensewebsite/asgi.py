@@ -2,6 +2,13 @@
 ASGI config for expensewebsite project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+This is how the site is served (see the Procfile):
+
+    uvicorn expensewebsite.asgi:application --workers 2
+
+The search, summary and validation endpoints are async views, so slow
+clients and long searches don't hold a worker thread, and a search whose
+client disconnects is cancelled together with its database query.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
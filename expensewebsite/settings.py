@@ -46,10 +46,13 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'expenses',
     'userpreferences',
-    'userincome'
+    'userincome',
+    'authentication',
 ]
 
 MIDDLEWARE = [
+    'expenses.timing.RequestTimingMiddleware',
+    'expenses.versioning.VersionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,7 +66,7 @@ ROOT_URLCONF = 'expensewebsite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'expenses.timing.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -149,5 +152,88 @@ EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_USE_TLS = True
 EMAIL_PORT = 587
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
+EMAIL_TIMEOUT = 30
+
+# email outbox, see authentication.outbox
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_RETRY_DELAY = 60
+EMAIL_OUTBOX_LEASE = 5 * 60
+EMAIL_OUTBOX_RETENTION = 7 * 24 * 60 * 60
+
+# registration form checks, see authentication.availability
+AVAILABILITY_REFRESH_INTERVAL = 5
+AVAILABILITY_REBUILD_INTERVAL = 10 * 60
+EMAIL_CHECK_CACHE_TIMEOUT = 5 * 60
+
+
+# request timing, see expenses.timing
+REQUEST_TIMING_SAMPLE_RATE = 0.1
+REQUEST_TIMING_SLOW_MS = 500
+REQUEST_TIMING_REPEAT_THRESHOLD = 5
+REQUEST_TIMING_STACKS = False
+
+# /metrics, see expenses.metrics
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'expenses.timing': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+
+# search
+SEARCH_RESULT_LIMIT = 25
+
+# exports
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_XLSX_SPLIT_ROWS = 50000
+EXPORT_PDF_INLINE_ROWS = 10000
+EXPORT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'exports')
+EXPORT_JOB_DIR = os.path.join(BASE_DIR, 'cache', 'export-jobs')
+EXPORT_JOB_TTL = 60 * 60
+EXPORT_JOB_TIMEOUT = 60 * 60
+EXPORT_WORKER_CONCURRENCY = 2
+
+# lists
+LIST_PAGE_SIZE = 3
+
+# the batch endpoints, see expenses.batch
+BATCH_MAX_OPERATIONS = 5000
+BATCH_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# statement imports, see expenses.imports
+IMPORT_CHUNK_SIZE = 10000
+IMPORT_MAX_ERRORS = 100
+
+# The list pages' table fragments, see expenses.fragments. Local memory is
+# per process; with several nodes point this at a shared cache, e.g.
+# FRAGMENT_CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache and
+# FRAGMENT_CACHE_LOCATION=fragment_cache (then run createcachetable), or
+# django.core.cache.backends.filebased.FileBasedCache and a shared directory.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': os.environ.get('FRAGMENT_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('FRAGMENT_CACHE_LOCATION', 'fragments'),
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+FRAGMENT_CACHE_ALIAS = 'fragments'
+
+# reference data (categories, sources, preferences), see expenses.reference
+REFERENCE_CACHE_TIMEOUT = 60 * 60
 
+# money: amounts are stored in minor units of a currency, see expenses.money
+DEFAULT_CURRENCY = 'USD'
 
+# exchange rates are quoted per one unit of this currency, see expenses.rates
+EXCHANGE_RATE_BASE = 'USD'
@@ -0,0 +1,40 @@
+// Exports are queued as background jobs: poll the job until the file is
+// ready, then download it. The plain link still works without JavaScript.
+const exportStatus = document.querySelector(".export-status");
+
+const csrfToken = () => {
+  const cookie = document.cookie.split("; ").find((c) => c.startsWith("csrftoken="));
+  return cookie ? decodeURIComponent(cookie.split("=")[1]) : "";
+};
+
+const pollExportJob = (job) => {
+  if (job.status === "done") {
+    exportStatus.textContent = "";
+    window.location = job.download_url;
+    return;
+  }
+  if (job.status !== "pending" && job.status !== "running") {
+    exportStatus.textContent = job.error ? `Export failed: ${job.error}` : "Export failed";
+    return;
+  }
+  exportStatus.textContent = `Preparing ${job.format.toUpperCase()} export… ${job.progress}%`;
+  setTimeout(() => {
+    fetch(job.status_url).then((res) => res.json()).then(pollExportJob);
+  }, 1000);
+};
+
+document.querySelectorAll(".export-link[data-job]").forEach((link) => {
+  link.addEventListener("click", (e) => {
+    e.preventDefault();
+    const query = new URL(link.href, window.location.origin).search;
+    fetch(link.dataset.job + query, {
+      method: "POST",
+      headers: { "X-CSRFToken": csrfToken() },
+    })
+      .then((res) => res.json())
+      .then(pollExportJob)
+      .catch(() => {
+        exportStatus.textContent = "Export failed";
+      });
+  });
+});
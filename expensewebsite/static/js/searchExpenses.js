@@ -5,42 +5,84 @@ tableOutput.style.display = "none";
 const paginationCotainer = document.querySelector(".pagination-container");
 const tbody = document.querySelector(".table-body");
 
+const moreButton = document.createElement("button");
+moreButton.className = "btn btn-link btn-sm";
+moreButton.textContent = "More results";
+moreButton.style.display = "none";
+tableOutput.appendChild(moreButton);
+let nextCursor = null;
+
+const renderRows = (rows) => {
+  rows.forEach((item) => {
+    tbody.innerHTML += `
+    <tr>
+    <td>${item.amount}</td>
+    <td>${item.category}</td>
+    <td>${item.description}</td>
+    <td>${item.date}</td>
+    <td>
+        <a href="/edit-expense/${item.id}/" class="btn btn-secondary btn-sm">Edit</a>
+    </td>
+    </tr>
+    `;
+  });
+};
+
+let pending = null;
+
+const fetchResults = (searchValue, cursor, signal) => {
+  // GET so the browser can revalidate with If-None-Match and get a 304
+  const params = new URLSearchParams({ searchText: searchValue });
+  if (cursor) params.set("cursor", cursor);
+  return fetch("/search-expenses?" + params.toString(), { signal }).then((res) => res.json());
+};
+
+moreButton.addEventListener("click", () => {
+  fetchResults(searchField.value, nextCursor).then((data) => {
+    renderRows(data.results);
+    nextCursor = data.next;
+    moreButton.style.display = nextCursor ? "inline-block" : "none";
+  });
+});
+
+const exportLinks = document.querySelectorAll(".export-link");
+
+const updateExportLinks = (searchValue) => {
+  exportLinks.forEach((link) => {
+    link.href = searchValue.trim()
+      ? `${link.dataset.base}?q=${encodeURIComponent(searchValue)}`
+      : link.dataset.base;
+  });
+};
+
 searchField.addEventListener("keyup", (e) => {
   const searchValue = e.target.value;
+  updateExportLinks(searchValue);
 
   if (searchValue.trim().length > 0) {
     console.log("searchValue", searchValue);
     paginationCotainer.style.display = "none";
     tbody.innerHTML = "";
-    fetch("/search-expenses", {
-      body: JSON.stringify({ searchText: searchValue }),
-      method: "POST",
-    })
-      .then((res) => res.json())
-      .then((data) => {
-        console.log("Data: ", data);
-        appTable.style.display = "none";
-        tableOutput.style.display = "block";
-
-        if (data.length === 0) {
-          tableOutput.innerHTML = "No results found!";
-        } else {
-          data.forEach((item) => {
-            tbody.innerHTML += `
-            <tr>
-            <td>${item.amount}</td>
-            <td>${item.category}</td>
-            <td>${item.description}</td>
-            <td>${item.date}</td>
-            <td>
-                <a href="/edit-expense/${item.id}/" class="btn btn-secondary btn-sm">Edit</a>
-            </td>
-            </tr>
-            `;
-          });
-        }
-      });
+    // Each keystroke supersedes the last search; aborting it lets the server stop the query
+    if (pending) pending.abort();
+    pending = new AbortController();
+    fetchResults(searchValue, null, pending.signal).then((data) => {
+      console.log("Data: ", data);
+      appTable.style.display = "none";
+      tableOutput.style.display = "block";
+      nextCursor = data.next;
+      moreButton.style.display = nextCursor ? "inline-block" : "none";
+
+      if (data.results.length === 0) {
+        tableOutput.innerHTML = "No results found!";
+      } else {
+        renderRows(data.results);
+      }
+    }).catch((err) => {
+      if (err.name !== "AbortError") throw err;
+    });
   } else {
+    if (pending) pending.abort();
     tableOutput.style.display = "none";
     appTable.style.display = "block";
     paginationCotainer.style.display = "block";
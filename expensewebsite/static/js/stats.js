@@ -1,13 +1,21 @@
+let chart = null;
+const rangeForm = document.querySelector("#summaryRange");
+const startField = document.querySelector("#summaryStart");
+const endField = document.querySelector("#summaryEnd");
+
 const renderChart = (data, labels) => {
   const ctx = document.getElementById("myChart");
 
-  new Chart(ctx, {
+  if (chart) {
+    chart.destroy();
+  }
+  chart = new Chart(ctx, {
     type: "doughnut",
     data: {
       labels: labels,
       datasets: [
         {
-          label: "Last six months expenses",
+          label: "Expenses",
           data: data,
           backgroundColor: [
             "rgba(255, 99, 132, 0.2)",
@@ -41,10 +49,15 @@ const renderChart = (data, labels) => {
 };
 const getChartData = () => {
   console.log("fetching");
-  fetch("/expense_category_summary").then((res) =>
+  const params = new URLSearchParams();
+  if (startField.value) params.set("start", startField.value);
+  if (endField.value) params.set("end", endField.value);
+  fetch("/expense_category_summary?" + params.toString()).then((res) =>
     res.json().then((results) => {
       console.log("results", results);
       const category_data = results.expense_category_data;
+      startField.value = results.start;
+      endField.value = results.end;
       const [labels, data] = [
         Object.keys(category_data),
         Object.values(category_data),
@@ -53,4 +66,8 @@ const getChartData = () => {
     })
   );
 };
+rangeForm.addEventListener("submit", (e) => {
+  e.preventDefault();
+  getChartData();
+});
 document.onload = getChartData();
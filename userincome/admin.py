@@ -3,4 +3,9 @@ from .models import UserIncome, Source
 
 # Register your models here.
 admin.site.register(UserIncome)
-admin.site.register(Source)
\ No newline at end of file
+
+class SourceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner')
+    search_fields = ('name',)
+    raw_id_fields = ('owner',)
+admin.site.register(Source, SourceAdmin)
\ No newline at end of file
@@ -0,0 +1,17 @@
+from django.db import migrations
+
+from expenses.search import SearchIndex
+
+# Description and the source name column, as it was here
+INCOME_SEARCH = SearchIndex('userincome_userincome', ('description', 'source'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userincome', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(INCOME_SEARCH.install, INCOME_SEARCH.uninstall),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from expenses.search import SearchIndex
+
+INCOME_SEARCH = SearchIndex('userincome_userincome', ('description', 'source'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userincome', '0003_owner_date_amount_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userincome',
+            index=models.Index(fields=['owner', '-date', '-id'], name='income_owner_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userincome',
+            index=models.Index(fields=['owner', 'source', '-date', '-id'], name='income_owner_source_date_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='userincome',
+            name='income_owner_date_idx',
+        ),
+        # Reinstall the FTS triggers the SQLite table remake drops (expenses 0009)
+        migrations.RunPython(migrations.RunPython.noop, INCOME_SEARCH.install),
+        migrations.AlterField(
+            model_name='userincome',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(INCOME_SEARCH.install, migrations.RunPython.noop),
+    ]
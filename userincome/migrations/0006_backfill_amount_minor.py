@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from expenses.money import backfill_minor_units
+
+
+def backfill(apps, schema_editor):
+    backfill_minor_units(apps.get_model('userincome', 'UserIncome'),
+                         apps.get_model('userpreferences', 'UserPreference'))
+
+
+class Migration(migrations.Migration):
+    # Batches commit separately, see expenses 0011
+    atomic = False
+
+    dependencies = [
+        ('userincome', '0005_amount_minor'),
+        ('userpreferences', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
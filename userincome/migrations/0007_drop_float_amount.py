@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.db import migrations, models
+
+from expenses.money import restore_float_amounts
+from expenses.search import SearchIndex
+
+INCOME_SEARCH = SearchIndex('userincome_userincome', ('description', 'source'))
+
+
+def restore_amounts(apps, schema_editor):
+    restore_float_amounts(apps.get_model('userincome', 'UserIncome'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userincome', '0006_backfill_amount_minor'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Reinstall the FTS triggers the SQLite table remake drops, both ways
+        migrations.RunPython(migrations.RunPython.noop, INCOME_SEARCH.install),
+        migrations.AlterField(
+            model_name='userincome',
+            name='amount',
+            field=models.FloatField(null=True),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore_amounts),
+        migrations.RemoveIndex(
+            model_name='userincome',
+            name='income_owner_amount_idx',
+        ),
+        migrations.RemoveField(
+            model_name='userincome',
+            name='amount',
+        ),
+        migrations.AlterField(
+            model_name='userincome',
+            name='amount_minor',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='userincome',
+            name='currency',
+            field=models.CharField(max_length=3),
+        ),
+        migrations.AddIndex(
+            model_name='userincome',
+            index=models.Index(fields=['owner', 'amount_minor'], name='income_owner_amount_minor_idx'),
+        ),
+        migrations.RunPython(INCOME_SEARCH.install, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def drop_duplicate_names(apps, schema_editor):
+    # Nothing points at sources by key yet; keep the first of each shared name
+    Source = apps.get_model('userincome', 'Source')
+    first = Source.objects.values('name').annotate(first=Min('pk')).values_list('first', flat=True)
+    Source.objects.exclude(pk__in=list(first)).delete()
+
+
+class Migration(migrations.Migration):
+    # Three steps like expenses 0015-0017: the empty key column, the batched
+    # backfill, then dropping the name.
+
+    dependencies = [
+        ('userincome', '0007_drop_float_amount'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='source',
+            name='id',
+            field=models.AutoField(primary_key=True, serialize=False),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='source',
+            constraint=models.UniqueConstraint(fields=('owner', 'name'), name='source_owner_name'),
+        ),
+        migrations.AddConstraint(
+            model_name='source',
+            constraint=models.UniqueConstraint(condition=models.Q(('owner', None)), fields=('name',),
+                                               name='source_shared_name'),
+        ),
+        # The text column keeps its name, so only the migration state changes
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='userincome',
+                name='source',
+                field=models.CharField(db_column='source', max_length=266),
+            ),
+            migrations.RemoveIndex(model_name='userincome', name='income_owner_source_date_idx'),
+            migrations.RenameField(model_name='userincome', old_name='source', new_name='source_name'),
+            migrations.AddIndex(
+                model_name='userincome',
+                index=models.Index(fields=['owner', 'source_name', '-date', '-id'], name='income_owner_source_date_idx'),
+            ),
+        ]),
+        migrations.AddField(
+            model_name='userincome',
+            name='source',
+            field=models.ForeignKey(null=True, db_index=False, on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='+', to='userincome.source'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+from expenses.operations import AddIndexConcurrently
+from expenses.reference import backfill_keys
+
+
+def backfill(apps, schema_editor):
+    backfill_keys(apps.get_model('userincome', 'UserIncome'), apps.get_model('userincome', 'Source'), 'source')
+
+
+class Migration(migrations.Migration):
+    # Batches commit separately and the index doesn't block writes, see expenses 0016
+    atomic = False
+
+    dependencies = [
+        ('userincome', '0008_source_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='userincome',
+            index=models.Index(fields=['owner', 'source', '-date', '-id'], name='income_owner_src_id_date_idx'),
+        ),
+    ]
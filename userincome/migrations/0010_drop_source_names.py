@@ -0,0 +1,47 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+from expenses.reference import backfill_keys, restore_names
+from expenses.search import SearchIndex
+
+# The search index before and after this migration, frozen here
+NAMED_SEARCH = SearchIndex('userincome_userincome', ('description', 'source'))
+INCOME_SEARCH = SearchIndex('userincome_userincome', ('description',))
+
+
+def backfill(apps, schema_editor):
+    # Rows written by the old code since 0009 ran
+    backfill_keys(apps.get_model('userincome', 'UserIncome'), apps.get_model('userincome', 'Source'), 'source')
+
+
+def restore(apps, schema_editor):
+    restore_names(apps.get_model('userincome', 'UserIncome'), apps.get_model('userincome', 'Source'), 'source')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userincome', '0009_backfill_source_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        # The search column comes back over descriptions only
+        migrations.RunPython(NAMED_SEARCH.uninstall, NAMED_SEARCH.install),
+        migrations.RemoveIndex(model_name='userincome', name='income_owner_source_date_idx'),
+        # Nullable first, so that unapplying can add the column back and refill it
+        migrations.AlterField(
+            model_name='userincome',
+            name='source_name',
+            field=models.CharField(db_column='source', max_length=266, null=True),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore),
+        migrations.RemoveField(model_name='userincome', name='source_name'),
+        migrations.AlterField(
+            model_name='userincome',
+            name='source',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                                    to='userincome.source'),
+        ),
+        migrations.RunPython(INCOME_SEARCH.install, INCOME_SEARCH.uninstall),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+from expenses.imports import backfill_hashes
+from expenses.operations import AddIndexConcurrently
+
+
+def backfill(apps, schema_editor):
+    backfill_hashes(apps.get_model('userincome', 'UserIncome'))
+
+
+class Migration(migrations.Migration):
+    # Like expenses 0019
+    atomic = False
+
+    dependencies = [
+        ('userincome', '0010_drop_source_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userincome',
+            name='content_hash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='userincome',
+            index=models.Index(fields=['owner', 'content_hash'], name='income_owner_hash_idx'),
+        ),
+    ]
@@ -2,21 +2,46 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 
+from expenses import money
+
 # Create your models here.
 class UserIncome(models.Model):
-    amount = models.FloatField() #DECIMAL
+    # Minor units of `currency`, see expenses.money
+    amount_minor = models.BigIntegerField()
+    currency = models.CharField(max_length=3)
     date=models.DateField(default=now)
     description=models.TextField()
-    owner=models.ForeignKey(User, on_delete=models.CASCADE)
-    source=models.CharField(max_length=266)
+    # Indexed through the composite (owner, ...) indexes in Meta
+    owner=models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    source=models.ForeignKey('Source', on_delete=models.PROTECT, db_index=False, related_name='+')
+    content_hash=models.BigIntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
-        return self.source
+        return self.source.name
+
+    @property
+    def amount(self):
+        return money.from_minor(self.amount_minor, self.currency)
+
     class Meta:
         ordering= ['-date']
+        indexes = [
+            models.Index(fields=['owner', '-date', '-id'], name='income_owner_date_id_idx'),
+            models.Index(fields=['owner', 'source', '-date', '-id'], name='income_owner_src_id_date_idx'),
+            models.Index(fields=['owner', 'amount_minor'], name='income_owner_amount_minor_idx'),
+            models.Index(fields=['owner', 'content_hash'], name='income_owner_hash_idx'),
+        ]
 
 class Source(models.Model):
+        # Like expenses.models.Category: 4-byte keys, shared or one user's own
+        id=models.AutoField(primary_key=True)
         name=models.CharField(max_length=255)
+        owner=models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+        class Meta:
+             constraints = [
+                 models.UniqueConstraint(fields=['owner', 'name'], name='source_owner_name'),
+                 models.UniqueConstraint(fields=['name'], condition=models.Q(owner=None), name='source_shared_name'),
+             ]
 
         def __str__(self):
-             return self.name
\ No newline at end of file
+             return self.name
@@ -1,3 +1,55 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from expenses import counters, filters
+from expenses.tests import QueryPlanTestCase, forget_choices, shared
+
+from .models import Source, UserIncome
+
+
+class IncomeQueryPlanTests(QueryPlanTestCase):
+    def test_list_page(self):
+        self.assertIndexedPlans('get', '/income/income')
+
+    def test_filtered_search(self):
+        for text in ('source:salary', 'date:2022', 'source:gifts date:2022-01..2022-06'):
+            self.assertIndexedPlans('post', '/income/search-income', data={'searchText': text},
+                                    content_type='application/json')
+
+    def test_export(self):
+        self.assertIndexedPlans('get', '/income/export-csv?start=2022-01-01&end=2022-12-31')
+
+
+class IncomeBatchTests(TestCase):
+    def setUp(self):
+        forget_choices()
+
+    def test_batch_creates_and_counts_incomes(self):
+        user = User.objects.create(username='income-batch')
+        self.client.force_login(user)
+        salary = shared(Source, 'Salary')
+        operations = [{'op': 'create', 'amount': '1500', 'date': '2024-04-01', 'description': 'pay',
+                       'source': salary.pk}] * 3
+        response = self.client.post('/income/batch-income', {'operations': operations}, content_type='application/json')
+        self.assertEqual([result['status'] for result in response.json()['results']], ['created'] * 3)
+        self.assertEqual(UserIncome.objects.filter(owner=user, source=salary, amount_minor=150000).count(), 3)
+        self.assertEqual(counters.get(user.pk, 'incomes'), 3)
+        response = self.client.post('/income/batch-income', {'operations': operations}, content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
+
+class IncomeExportTests(TestCase):
+    def setUp(self):
+        forget_choices()
+
+    def test_export_search_applies_to_incomes(self):
+        user = User.objects.create(username='income-export')
+        salary, gifts = shared(Source, 'Salary'), shared(Source, 'Gifts')
+        for description, source, date in (('march pay', salary, '2024-03-28'), ('april pay', salary, '2024-04-28'),
+                                          ('birthday', gifts, '2024-03-10')):
+            UserIncome.objects.create(owner=user, amount_minor=1000, currency='USD', date=date,
+                                      description=description, source=source)
+        _, incomes = filters.export_querysets(user, {'q': 'pay date:2024-03'})
+        self.assertEqual([income.description for income in incomes], ['march pay'])
+        _, incomes = filters.export_querysets(user, {'q': 'source:gifts'})
+        self.assertEqual([income.description for income in incomes], ['birthday'])
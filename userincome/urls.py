@@ -9,6 +9,8 @@ urlpatterns = [
     path('edit-income/<int:id>/', views.edit_income, name='edit-income'),
     path('delete-income/<int:id>/', views.delete_income, name='delete-income'),
     path('search-income', csrf_exempt(views.search_income), name='search-income'),
+    path('batch-income', csrf_exempt(views.batch_income), name='batch-income'),
+    path('export-csv', views.export_csv, name='export-income-csv'),
 ]
 
 
@@ -1,50 +1,67 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from .models import Source, UserIncome
-from django.core.paginator import Paginator
-from userpreferences.models import UserPreference
+from .models import UserIncome
 from django.contrib import messages
-from django.core.exceptions import ObjectDoesNotExist
-import json
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.db import transaction
+from django.views.decorators.http import require_POST
+from django.utils.functional import SimpleLazyObject
+from expenses import aio, batch, counters, exports, filters, fragments, money, pagination, query, rates, reference, search, versioning
+from expenses.utils import filter_date_range, parse_date_range
+import datetime
 
 # Create your views here.
 
-def search_income(request):
-    if request.method=='POST':
-        search_str=json.loads(request.body).get('searchText','')
+@versioning.conditional(lambda: reference.version('sources'))
+async def search_income(request):
+    if request.method in ('GET', 'POST'):
+        body=search.request_params(request)
+        parsed=query.parse(body.get('searchText',''))
+        user=await request.auser()
 
-        incomes=UserIncome.objects.filter(
-            amount__startswith=search_str, owner=request.user) | UserIncome.objects.filter(
-            date__startswith=search_str, owner=request.user) | UserIncome.objects.filter(
-            description__icontains=search_str, owner=request.user) | UserIncome.objects.filter(
-            source__icontains=search_str, owner=request.user) 
-        
-        data=incomes.values()
-        return JsonResponse(list(data), safe=False)
+        def run():
+            choices=reference.sources(user.id)
+            data=search.search(
+                filters.filter_incomes(user, parsed), search.INCOME_SEARCH,
+                parsed.text, fields=('amount_minor', 'currency', 'source', 'description', 'date'),
+                limit=body.get('limit'), cursor=body.get('cursor'), match_all=parsed.has_filters, choices=choices)
+            reference.with_names(data['results'], 'source', choices)
+            return data
+
+        try:
+            # Cancelled along with its query when the typeahead moves on
+            data=await aio.run_cancellable(run)
+        except search.InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        money.with_amounts(data['results'])
+        data['errors']=list(parsed.errors)
+        return JsonResponse(data)
 
 
 @login_required(login_url='/authentication/login')
 def index(request):
-    sources = Source.objects.all()
-    incomes= UserIncome.objects.filter(owner=request.user)
-    paginator = Paginator(incomes, 3)
+    incomes= UserIncome.objects.filter(owner=request.user).select_related('source')
+    cursor, per_page = request.GET.get('cursor'), request.GET.get('per_page')
+    currency = reference.user_currency(request.user.id) or "Default"
+    currency_code = reference.user_currency_code(request.user.id)
+
+    def page():
+        page_obj = pagination.paginate(incomes, counters.get(request.user.id, 'incomes'), cursor, per_page)
+        rates.annotate(page_obj.object_list, currency_code)
+        return page_obj
 
-    page_number = request.GET.get('page')
-    page_obj=paginator.get_page(page_number)
-    try:
-        currency = UserPreference.objects.get(user=request.user).currency
-    except ObjectDoesNotExist:
-        currency = "Default"
     context = {
         'incomes': incomes,
-        'page_obj': page_obj,
+        # Only read if the table isn't cached
+        'page_obj': SimpleLazyObject(page),
+        'fragment_key': fragments.key('income', request.user.id, reference.version('sources'), cursor, per_page),
         'currency': currency,
+        'currency_code': currency_code,
     }
     return render(request, 'income/index.html', context)
 
 def add_income(request):
-    sources = Source.objects.all()
+    sources = reference.sources(request.user.id)
     context = {
         'sources': sources,
         'values': request.POST,
@@ -56,7 +73,7 @@ def add_income(request):
         amount = request.POST['amount']
         description = request.POST['description']
         date = request.POST['income_date']
-        sources = request.POST['source']
+        source_id = reference.choice_id(sources, request.POST.get('source'))
 
         if not amount:
             messages.error(request, 'Amount is required')
@@ -66,13 +83,26 @@ def add_income(request):
         if not description:
             messages.error(request, 'Description is required')
             return render(request, 'income/add_income.html', context)
-        UserIncome.objects.create(owner=request.user, amount=amount, date=date, description=description, source=sources)
+
+        if source_id is None:
+            messages.error(request, 'Source is required')
+            return render(request, 'income/add_income.html', context)
+        currency = reference.user_currency_code(request.user.id)
+        try:
+            amount_minor = money.to_minor(amount, currency)
+        except ValueError:
+            messages.error(request, 'Amount must be a number')
+            return render(request, 'income/add_income.html', context)
+        with transaction.atomic():
+            UserIncome.objects.create(owner=request.user, amount_minor=amount_minor, currency=currency, date=date,
+                                      description=description, source_id=source_id)
         messages.success(request, 'Record saved successfully')
         return redirect('income')
 
+@login_required(login_url='/authentication/login')
 def edit_income (request, id):
-    income=UserIncome.objects.get(pk=id)
-    sources = Source.objects.all()
+    income=get_object_or_404(UserIncome.objects.select_related('source'), pk=id, owner=request.user)
+    sources = reference.sources(request.user.id)
     context = {
         'income': income,
         'values': income,
@@ -84,7 +114,7 @@ def edit_income (request, id):
         amount = request.POST['amount']
         description = request.POST['description']
         date = request.POST['income_date']
-        source = request.POST['source']
+        source_id = reference.choice_id(sources, request.POST.get('source'))
 
         if not amount:
             messages.error(request, 'Amount is required')
@@ -93,13 +123,24 @@ def edit_income (request, id):
         if not description:
             messages.error(request, 'Description is required')
             return render(request, 'income/edit_income.html', context)
+
+        if source_id is None:
+            messages.error(request, 'Source is required')
+            return render(request, 'income/edit_income.html', context)
+
+        try:
+            amount_minor = money.to_minor(amount, income.currency)
+        except ValueError:
+            messages.error(request, 'Amount must be a number')
+            return render(request, 'income/edit_income.html', context)
                 
         # income.owner=request.user
-        income.amount=amount 
+        income.amount_minor=amount_minor
         income.date=date 
         income.description=description 
-        income.source=source
-        income.save()
+        income.source_id=source_id
+        with transaction.atomic():
+            income.save()
         messages.success(request, 'Record updated successfully')
         return redirect('income')
     
@@ -107,8 +148,25 @@ def edit_income (request, id):
         messages.info(request, 'Handling post form')
     return render(request, 'income/edit_income.html', context)
 
+@login_required(login_url='/authentication/login')
 def delete_income(request, id):
-    income=UserIncome.objects.get(pk=id)
-    income.delete()
+    income=get_object_or_404(UserIncome, pk=id, owner=request.user)
+    with transaction.atomic():
+        income.delete()
     messages.success(request, 'Record removed')
-    return redirect('income')
\ No newline at end of file
+    return redirect('income')
+
+@require_POST
+def batch_income(request):
+    return batch.respond(request, batch.INCOMES)
+
+@versioning.conditional(rates.version, lambda: reference.version('sources'))
+def export_csv(request):
+    try:
+        start, end = parse_date_range(request)
+    except ValueError:
+        return HttpResponse('start and end must be dates in YYYY-MM-DD format', status=400)
+    incomes=filter_date_range(filters.searched_incomes(request.user, request.GET.get('q', '')), start, end)
+    currency=reference.user_currency_code(request.user.id)
+    return exports.stream_csv('Incomes' + str(datetime.datetime.now()) + '.csv',
+                              exports.converted(exports.INCOME_COLUMNS, currency), incomes, currency)
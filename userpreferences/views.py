@@ -1,41 +1,17 @@
 from django.shortcuts import render
-import os
-import json
-from django.conf import settings
 from .models import UserPreference
 from django.contrib import messages
+from expenses import reference
 
 # Create your views here.
 def index(request):
-    currency_data = []
-    file_path = os.path.join(settings.BASE_DIR, 'currencies.json')
-
-    with open(file_path, 'r') as json_file:
-        data = json.load(json_file)
-        for k, v in data.items():
-            currency_data.append({'key':k, 'value':v})
-
-    exists = UserPreference.objects.filter(user=request.user).exists()
-    user_preferences = None
-    
-    if exists:        
-        user_preferences = UserPreference.objects.get(user=request.user)
-    # import pdb
-    # pdb.set_trace()
+    currency_data = reference.currency_choices()
+    user_preferences = UserPreference(user=request.user, currency=reference.user_currency(request.user.id))
 
     if request.method == 'GET':
-        
-            # import pdb
-            # pdb.set_trace()
         return render(request, 'preferences/index.html', {'currencies': currency_data, 'user_preferences': user_preferences})
     else:
         currency=request.POST['currency']
-        if exists:
-            user_preferences.currency = currency
-            user_preferences.save()
-        else:
-            UserPreference.objects.create(user=request.user, currency=request.POST['currency'])
+        user_preferences, _ = UserPreference.objects.update_or_create(user=request.user, defaults={'currency': currency})
         messages.success(request, 'Changes saved')
         return render(request, 'preferences/index.html', {'currencies': currency_data, 'user_preferences': user_preferences})
-
-